@@ -0,0 +1,298 @@
+"""Benchmark of the calendar-to-grid engine of hcloud_calendar with synthetic calendars
+
+Reports fetch (from cache file), parse (with and without filter_ical_data), recurrence expansion, grid build (cold,
+from the compiled schedule file, after editing one event and cached, and cold over every window), lookup time and
+peak memory.
+Results are compared to benchmarks/baseline.json, if it was measured alike; use --save-baseline to store a new one.
+Every run also checks, that an advanced RollingSchedule matches one rebuilt from scratch (check_rolling).
+
+    python benchmarks/bench_calendar.py [--quick] [--save-baseline]
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import icalendar
+import recurring_ical_events
+
+import hcloud_calendar
+import hcloud_logging
+from ics_generator import generate_ics
+
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline.json"
+REGRESSION_FACTOR = 1.5
+''' a result is a regression, if it is this many times slower (or bigger) than the baseline '''
+REGRESSION_MIN_SECONDS = 0.001
+''' and, for timings, also at least this much slower; sub-millisecond timings vary more than REGRESSION_FACTOR '''
+
+CALENDARS = {
+    "small": dict(one_off_events=200, recurring_events=20),
+    "large": dict(one_off_events=5000, recurring_events=500),
+}
+GRID_INTERVALS = [1, 5, 15]
+''' minutes '''
+WINDOW_DAYS = [1, 2, 7]
+''' days of recurrence expansion and of the rolling schedule built from it '''
+WINDOW_GRID_INTERVAL = 15
+''' minutes of the grid, the rolling schedule is built with for every window '''
+ROLLING_TICKS = 100
+''' randomized ticks of check_rolling '''
+
+
+def measure(function, repeat: int = 3) -> float:
+    """
+    :return: fastest of repeat runs in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        duration = time.perf_counter() - started
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def measure_peak_memory(function) -> int:
+    """
+    :return: peak of allocated memory in bytes while function runs
+    """
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def run(calendars: dict, repeat: int = 3) -> dict:
+    results = {}
+    timezone_name = "Europe/Berlin"
+
+    for name, kwargs in calendars.items():
+        ical_data = generate_ics(**kwargs)
+        results[name + "/ics_bytes"] = len(ical_data)
+
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                Path("benchmark.cache").write_bytes(ical_data)
+                results[name + "/fetch_from_cache"] = measure(
+                    lambda: hcloud_calendar.get_ical_data(url="http://127.0.0.1:9/", token="benchmark"), repeat)
+            finally:
+                os.chdir(cwd)
+
+        results[name + "/parse"] = measure(lambda: icalendar.Calendar.from_ical(ical_data), repeat)
+        calendar = icalendar.Calendar.from_ical(ical_data)
+
+        start = hcloud_calendar.get_grid_start(timezone_name=timezone_name, timeslice_grid_interval=15)
+        not_before = (start - hcloud_calendar.PREFILTER_MARGIN).date()
+        results[name + "/prefilter"] = measure(lambda: hcloud_calendar.filter_ical_data(ical_data, not_before), repeat)
+        results[name + "/parse_prefiltered"] = measure(
+            lambda: icalendar.Calendar.from_ical(hcloud_calendar.filter_ical_data(ical_data, not_before)), repeat)
+        results[name + "/peak_memory_parse"] = measure_peak_memory(lambda: icalendar.Calendar.from_ical(ical_data))
+        results[name + "/peak_memory_parse_prefiltered"] = measure_peak_memory(
+            lambda: icalendar.Calendar.from_ical(hcloud_calendar.filter_ical_data(ical_data, not_before)))
+        for days in WINDOW_DAYS:
+            stop = start + datetime.timedelta(days=days)
+            results[name + "/expand_" + str(days) + "d"] = measure(
+                lambda: list(recurring_ical_events.of(a_calendar=calendar).between(start=start, stop=stop)), repeat)
+
+        for interval in GRID_INTERVALS:
+            prefix = name + "/grid_" + str(interval) + "min"
+
+            def build_cold():
+                hcloud_calendar.clear_caches()
+                return hcloud_calendar.get_schedule_for_now(ical_data=ical_data, timezone_name=timezone_name,
+                                                            timeslice_grid_interval=interval,
+                                                            start_advanced_time=10, end_lag_time=30)
+
+            def build_cached():
+                return hcloud_calendar.get_schedule_for_now(ical_data=ical_data, timezone_name=timezone_name,
+                                                            timeslice_grid_interval=interval,
+                                                            start_advanced_time=10, end_lag_time=30)
+
+            def build_compiled():
+                # a restart: nothing in memory, but the compiled schedule file of the last run
+                hcloud_calendar.clear_caches()
+                return hcloud_calendar.get_schedule_for_now(ical_data=ical_data, timezone_name=timezone_name,
+                                                            timeslice_grid_interval=interval,
+                                                            start_advanced_time=10, end_lag_time=30,
+                                                            compiled_file=compiled_file)
+
+            edits = []
+
+            def build_incremental():
+                # the calendar changed: one recurring series was edited since the last build
+                edits.append(b"SUMMARY:recurring 0 edit " + str(len(edits)).encode() + b"\r\n")
+                return hcloud_calendar.get_schedule_for_now(ical_data=ical_data.replace(b"SUMMARY:recurring 0\r\n",
+                                                                                        edits[-1]),
+                                                            timezone_name=timezone_name,
+                                                            timeslice_grid_interval=interval,
+                                                            start_advanced_time=10, end_lag_time=30)
+
+            results[prefix + "/build_cold"] = measure(build_cold, repeat)
+            with tempfile.TemporaryDirectory() as directory:
+                compiled_file = os.path.join(directory, "benchmark.schedule")
+                build_compiled()
+                results[prefix + "/build_compiled"] = measure(build_compiled, repeat)
+            build_cold()
+            results[prefix + "/build_incremental"] = measure(build_incremental, repeat)
+            build_cold()
+            results[prefix + "/build_cached"] = measure(build_cached, repeat)
+            results[prefix + "/peak_memory_cold"] = measure_peak_memory(build_cold)
+
+            if interval == WINDOW_GRID_INTERVAL:
+                for days in WINDOW_DAYS:
+                    def build_window_cold():
+                        hcloud_calendar.clear_caches()
+                        return hcloud_calendar.get_rolling_schedule(ical_data=ical_data, name="benchmark",
+                                                                    timezone_name=timezone_name,
+                                                                    timeslice_grid_interval=interval,
+                                                                    start_advanced_time=10, end_lag_time=30,
+                                                                    horizon_days=days)
+
+                    results[prefix + "/build_cold_" + str(days) + "d"] = measure(build_window_cold, repeat)
+
+            grids = hcloud_calendar.get_datetime_and_timeslice_grid_for_now(
+                ical_data=ical_data, timezone_name=timezone_name, timeslice_grid_interval=interval,
+                start_advanced_time=10, end_lag_time=30)
+            schedule = build_cached()
+            lookups = 1000
+            results[prefix + "/lookup_grids"] = measure(
+                lambda: [hcloud_calendar.check_should_run_now(*grids, timezone_name=timezone_name,
+                                                              timeslice_grid_interval=interval)
+                         for _ in range(lookups)], repeat) / lookups
+            results[prefix + "/lookup_schedule"] = measure(
+                lambda: [hcloud_calendar.check_schedule_should_run_now(schedule, timezone_name=timezone_name,
+                                                                       timeslice_grid_interval=interval)
+                         for _ in range(lookups)], repeat) / lookups
+    return results
+
+
+def check_rolling(ical_data: bytes, timeslice_grid_interval: int, ticks: int = ROLLING_TICKS, seed: int = 42) -> int:
+    """
+    Advance a RollingSchedule over randomized ticks and compare it with a schedule built from scratch at every tick
+
+    :return: number of slots, which differ in run state or server_type
+    """
+    rnd = random.Random(seed)
+    get_grid_start = hcloud_calendar.get_grid_start
+    now = get_grid_start(timeslice_grid_interval=timeslice_grid_interval)
+    mismatches = 0
+    try:
+        for tick in range(ticks):
+            hcloud_calendar.get_grid_start = lambda timezone_name="Europe/Berlin", timeslice_grid_interval=15: now
+            schedules = [hcloud_calendar.get_rolling_schedule(ical_data, name=name, start_advanced_time=10,
+                                                              end_lag_time=30,
+                                                              timeslice_grid_interval=timeslice_grid_interval)
+                         for name in ("rolled", "rebuilt-" + str(tick))]
+            rolled, rebuilt = [(bytes(schedule.timeslice), [schedule.server_types[idx] for idx in schedule.server_type])
+                               for schedule in schedules]
+            mismatches += sum(1 for idx in range(len(rolled[0]))
+                              if rolled[0][idx] != rebuilt[0][idx] or rolled[1][idx] != rebuilt[1][idx])
+            now += datetime.timedelta(minutes=timeslice_grid_interval * rnd.randint(1, 8 * 60 // timeslice_grid_interval))
+    finally:
+        hcloud_calendar.get_grid_start = get_grid_start
+        hcloud_calendar.clear_caches()
+    return mismatches
+
+
+def format_value(key: str, value) -> str:
+    if not is_timing(key):
+        return "%10.1f KiB" % (value / 1024)
+    return "%10.3f ms " % (value * 1000)
+
+
+def is_timing(key: str) -> bool:
+    return not key.endswith("_bytes") and "/peak_memory" not in key
+
+
+def compare(results: dict, baseline: dict) -> list:
+    """
+    :return: list of keys which are more than REGRESSION_FACTOR worse than the baseline, timings also at least
+    REGRESSION_MIN_SECONDS slower
+    """
+    regressions = []
+    for key, value in results.items():
+        if key in baseline and not key.endswith("ics_bytes") and baseline[key] > 0:
+            if value > baseline[key] * REGRESSION_FACTOR and \
+                    (not is_timing(key) or value - baseline[key] >= REGRESSION_MIN_SECONDS):
+                regressions.append(key)
+    return regressions
+
+
+def missing_from_baseline(results: dict, baseline: dict) -> list:
+    """
+    :return: list of keys without a baseline, e.g. metrics added after the baseline was stored
+    """
+    return [key for key in results if key not in baseline]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the calendar-to-grid engine")
+    parser.add_argument("--quick", action="store_true", help="only the small calendar, one repetition")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions per measurement, the fastest is used")
+    parser.add_argument("--save-baseline", action="store_true", help="store results as new baseline")
+    args = parser.parse_args()
+
+    # the benchmark measures the engine, not the debug logging
+    hcloud_logging.setup(types.SimpleNamespace(LOG_LEVEL="WARNING"))
+
+    calendars = CALENDARS
+    repeat = args.repeat
+    if args.quick:
+        calendars = {"small": CALENDARS["small"]}
+        repeat = 1
+
+    results = run(calendars, repeat=repeat)
+
+    # an advanced RollingSchedule has to match a rebuilt one, the resident loop and cli.py tick decide alike
+    mismatches = {name + "/grid_" + str(interval) + "min": check_rolling(generate_ics(**kwargs), interval)
+                  for name, kwargs in calendars.items() for interval in GRID_INTERVALS}
+
+    # results are only compared with a baseline measured alike, the fastest of 1 run is no match for that of 3
+    mode = {"repeat": repeat, "calendars": sorted(calendars)}
+    baseline = {}
+    if BASELINE_FILE.exists():
+        stored = json.loads(BASELINE_FILE.read_text())
+        if stored.get("mode") == mode:
+            baseline = stored["results"]
+        elif not args.save_baseline:
+            print("baseline was measured with " + json.dumps(stored.get("mode")) + ", not with " + json.dumps(mode) +
+                  ", results are not compared")
+
+    for key, value in results.items():
+        line = "%-45s %s" % (key, format_value(key, value))
+        if key in baseline and baseline[key] > 0 and not key.endswith("ics_bytes"):
+            line += "  (baseline %s, x%.2f)" % (format_value(key, baseline[key]).strip(), value / baseline[key])
+        print(line)
+
+    for key, count in mismatches.items():
+        if count:
+            print("ROLLING MISMATCH: " + key + " advanced schedule differs in " + str(count) + " slots")
+
+    if args.save_baseline:
+        BASELINE_FILE.write_text(json.dumps({"mode": mode, "results": results}, indent=2, sort_keys=True) + "\n")
+        print("baseline stored in " + str(BASELINE_FILE))
+    elif not baseline:
+        sys.exit(1 if any(mismatches.values()) else 0)
+    else:
+        regressions = compare(results, baseline)
+        for key in regressions:
+            print("REGRESSION: " + key)
+        # an unchecked metric would hide its regressions, the baseline has to be stored again
+        missing = missing_from_baseline(results, baseline)
+        for key in missing:
+            print("NO BASELINE: " + key)
+        sys.exit(1 if regressions or missing or any(mismatches.values()) else 0)
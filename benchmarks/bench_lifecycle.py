@@ -0,0 +1,172 @@
+"""Lifecycle latency harness against a local stand-in of the Hetzner Cloud API
+
+Drives destroy_first_server, create_server_from_snapshot and the reconciliation of main.py (hcloud_reconcile)
+against benchmarks/fake_hcloud_api.py and reports request counts per endpoint, per-phase latencies and the
+action-polling overhead. No real api is used, nothing costs money.
+
+    python benchmarks/bench_lifecycle.py [--poll-interval 0.1] [--action-delay 0.5] [--request-latency 0.02] [--json]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_hcloud_api import FakeHcloudApi
+
+TOKEN = "benchmark"
+''' label token of all resources of the harness '''
+
+
+def install_config(args) -> types.ModuleType:
+    """hcloud_automation and hcloud_reconcile read config.py, the harness provides its own"""
+    config = types.ModuleType("config")
+    config.API_TOKEN = "fake"
+    config.IMAGE_TOKEN = TOKEN
+    config.ICAL_URL = "http://127.0.0.1:9/calendar.ics"
+    config.TIMESLICE_GRID_INTERVAL = 15
+    config.START_ADVANCED_TIME = 10
+    config.END_LAG_TIME = 30
+    config.TIMEZONE_NAME = "Europe/Berlin"
+    config.HCLOUD_POOL_INTERVAL = args.poll_interval
+    # the harness measures the api traffic, not the debug logging
+    config.LOG_LEVEL = "WARNING"
+    sys.modules["config"] = config
+    return config
+
+
+def seed(api: FakeHcloudApi, snapshots: int = 3):
+    labels = {"token": TOKEN, "server_name": "app", "server_type": "cx11", "server_location": "nbg1"}
+    api.add_server("app", labels, server_type="cx11", location="nbg1")
+    for idx in range(snapshots):
+        created = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=idx + 1)).isoformat()
+        api.add_snapshot("creation was automated for token " + TOKEN, labels, created=created)
+    api.add_floating_ip("192.0.2.10", {"token": TOKEN})
+    api.add_ssh_key("admin", {"token": TOKEN})
+
+
+def write_calendar(running: bool):
+    """Write the calendar cache-file, with one event around now if running"""
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//hcloud-calendar-automation//harness//EN"]
+    if running:
+        now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+        lines += ["BEGIN:VEVENT", "UID:harness", "DTSTAMP:20200101T000000Z",
+                  "DTSTART:" + (now - datetime.timedelta(hours=1)).strftime("%Y%m%dT%H%M%SZ"),
+                  "DTEND:" + (now + datetime.timedelta(hours=1)).strftime("%Y%m%dT%H%M%SZ"),
+                  "SUMMARY:harness", "END:VEVENT"]
+    lines.append("END:VCALENDAR")
+    Path(TOKEN + ".cache").write_bytes(("\r\n".join(lines) + "\r\n").encode())
+
+
+def run_phase(name: str, api: FakeHcloudApi, function) -> dict:
+    """Run function and collect wall time, requests and action-polling overhead"""
+    api.reset_counters()
+    history_file = Path("duration_history.json")
+    if history_file.exists():
+        history_file.unlink()
+
+    started = time.perf_counter()
+    result = function()
+    wall = time.perf_counter() - started
+
+    with api.lock:
+        requests = dict(api.requests)
+        request_seconds = dict(api.request_seconds)
+
+    phases = {}
+    if history_file.exists():
+        for key, durations in json.loads(history_file.read_text()).items():
+            phases[key.split("|")[0]] = sum(durations)
+
+    polls = requests.get("GET /actions/{id}", 0) + requests.get("GET /actions", 0)
+    return {
+        "name": name,
+        "result": str(result),
+        "wall_seconds": wall,
+        "requests_total": sum(requests.values()),
+        "requests": requests,
+        "request_seconds": sum(request_seconds.values()),
+        "action_polls": polls,
+        "action_poll_seconds": request_seconds.get("GET /actions/{id}", 0) + request_seconds.get("GET /actions", 0),
+        "phase_seconds": phases,
+    }
+
+
+def print_report(report: dict):
+    print("== " + report["name"] + " -> " + report["result"])
+    print("   wall time:        %8.3f s" % report["wall_seconds"])
+    print("   api requests:     %8d (%.3f s in handler)" % (report["requests_total"], report["request_seconds"]))
+    print("   action polls:     %8d (%.3f s in handler)" % (report["action_polls"], report["action_poll_seconds"]))
+    for phase, seconds in sorted(report["phase_seconds"].items()):
+        print("   phase %-18s %8.3f s" % (phase + ":", seconds))
+    for endpoint, count in sorted(report["requests"].items()):
+        print("   %-34s %4d" % (endpoint, count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="lifecycle latency harness against a local fake hcloud api")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="poll interval of the hcloud client")
+    parser.add_argument("--action-delay", type=float, default=0.5, help="seconds until every action is finished")
+    parser.add_argument("--request-latency", type=float, default=0.0, help="simulated round-trip per request")
+    parser.add_argument("--json", action="store_true", help="print reports as json")
+    args = parser.parse_args()
+
+    config = install_config(args)
+
+    import hcloud_logging
+    hcloud_logging.setup(config)
+
+    from hcloud import Client
+    import hcloud_automation
+    import hcloud_reconcile
+
+    reports = []
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        api = FakeHcloudApi(request_latency=args.request_latency)
+        api.action_delays = {command: args.action_delay for command in
+                             ("shutdown_server", "poweroff_server", "start_server", "create_image", "create_server",
+                              "delete_server", "assign_floating_ip", "change_server_type")}
+        api.start()
+        seed(api)
+        client = Client(token="fake", api_endpoint=api.url, poll_interval=args.poll_interval, poll_max_retries=300)
+
+        def destroy():
+            result = hcloud_automation.destroy_first_server(client, snapshot_token=TOKEN)
+            hcloud_automation.wait_for_background_cleanups()
+            return result
+
+        reports.append(run_phase("destroy_first_server", api, destroy))
+        reports.append(run_phase("create_server_from_snapshot", api,
+                                 lambda: hcloud_automation.create_server_from_snapshot(client, snapshot_token=TOKEN)))
+
+        state = {"running": True, "running_as": "cx11"}
+
+        def tick(running: bool):
+            write_calendar(running)
+            result = hcloud_reconcile.reconcile(client, server_is_running=state["running"],
+                                                server_is_running_as=state["running_as"])
+            state["running"], state["running_as"] = result[0], result[1]
+            hcloud_automation.wait_for_background_cleanups()
+            return state["running"]
+
+        reports.append(run_phase("reconcile idle (should run, is running)", api, lambda: tick(True)))
+        reports.append(run_phase("reconcile stop (main.py loop)", api, lambda: tick(False)))
+        reports.append(run_phase("reconcile idle (should not run, is not running)", api, lambda: tick(False)))
+        reports.append(run_phase("reconcile start (main.py loop)", api, lambda: tick(True)))
+
+        api.stop()
+        os.chdir("/")
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print_report(report)
@@ -0,0 +1,405 @@
+"""Local stand-in for the subset of the Hetzner Cloud API used by hcloud_automation
+
+Covers servers (incl. power and image actions), images/snapshots, actions, floating ips, ssh keys, server types and
+locations. Actions finish after a configurable delay per command, every request is counted per endpoint.
+Like the real api, a graceful shutdown action finishes once the ACPI request is sent; the server goes "off" only
+after the guest shut down (guest_shutdown_delay).
+
+    api = FakeHcloudApi(action_delays={"create_server": 2.0})
+    api.start()
+    client = Client(token="fake", api_endpoint=api.url)
+    ...
+    api.stop()
+"""
+import datetime
+import json
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ACTION_DELAY = 0.5
+''' seconds until an action without configured delay is finished '''
+
+SERVER_TYPES = [
+    {"id": 1, "name": "cx11", "description": "CX11", "cores": 1, "memory": 2.0, "disk": 20},
+    {"id": 2, "name": "cx21", "description": "CX21", "cores": 2, "memory": 4.0, "disk": 40},
+    {"id": 3, "name": "cpx31", "description": "CPX31", "cores": 4, "memory": 8.0, "disk": 160},
+    {"id": 4, "name": "ccx31", "description": "CCX31", "cores": 8, "memory": 32.0, "disk": 240},
+]
+LOCATIONS = [
+    {"id": 1, "name": "fsn1", "description": "Falkenstein DC Park 1", "country": "DE", "city": "Falkenstein",
+     "latitude": 50.47612, "longitude": 12.370071, "network_zone": "eu-central"},
+    {"id": 2, "name": "nbg1", "description": "Nuremberg DC Park 1", "country": "DE", "city": "Nuremberg",
+     "latitude": 49.452102, "longitude": 11.076665, "network_zone": "eu-central"},
+]
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _matches_label_selector(labels: dict, label_selector: str) -> bool:
+    for expression in label_selector.split(","):
+        if "=" in expression:
+            key, value = expression.split("=", 1)
+            if labels.get(key.strip()) != value.strip():
+                return False
+        elif expression.strip() and expression.strip() not in labels:
+            return False
+    return True
+
+
+class FakeHcloudApi:
+    """In-memory Hetzner Cloud API served over HTTP on localhost"""
+
+    def __init__(self, action_delays: dict = None, request_latency: float = 0.0,
+                 guest_shutdown_delay: float = DEFAULT_ACTION_DELAY):
+        """
+        :param action_delays: seconds until an action is finished, per command, e.g. {"shutdown_server": 2}
+        :param request_latency: seconds every request is delayed, to simulate the round-trip to the real api
+        :param guest_shutdown_delay: seconds from the finished shutdown action until the server is off,
+        None never shuts down (the guest ignores ACPI)
+        """
+        self.action_delays = action_delays or {}
+        self.request_latency = request_latency
+        self.guest_shutdown_delay = guest_shutdown_delay
+        self.guest_shutdowns = {}
+        ''' server id -> time the guest is off after a shutdown '''
+        self.lock = threading.RLock()
+        self.next_id = 1000
+        self.servers = {}
+        self.images = {}
+        self.floating_ips = {}
+        self.ssh_keys = {}
+        self.actions = {}
+        self.requests = Counter()
+        ''' number of requests per "METHOD /endpoint/{id}" '''
+        self.request_seconds = Counter()
+        ''' seconds spent handling requests per endpoint '''
+        self._server = None
+
+    # ---------------------------------------------------------------- setup
+
+    def _id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def _server_type(self, id_or_name) -> dict:
+        for server_type in SERVER_TYPES:
+            if server_type["id"] == id_or_name or server_type["name"] == id_or_name:
+                return server_type
+        raise KeyError(id_or_name)
+
+    def _location(self, id_or_name) -> dict:
+        for location in LOCATIONS:
+            if location["id"] == id_or_name or location["name"] == id_or_name:
+                return location
+        raise KeyError(id_or_name)
+
+    def add_server(self, name: str, labels: dict, server_type: str = "cx11", location: str = "nbg1",
+                   status: str = "running") -> dict:
+        with self.lock:
+            location = self._location(location)
+            server = {
+                "id": self._id(), "name": name, "status": status, "created": _now(),
+                "public_net": {"ipv4": None, "ipv6": None, "floating_ips": [], "firewalls": []},
+                "server_type": dict(self._server_type(server_type)),
+                "location": dict(location),
+                "datacenter": {"id": location["id"], "name": location["name"] + "-dc3", "location": dict(location)},
+                "image": None, "iso": None, "rescue_enabled": False, "locked": False, "backup_window": None,
+                "outgoing_traffic": 0, "ingoing_traffic": 0, "included_traffic": 0,
+                "protection": {"delete": False, "rebuild": False}, "labels": dict(labels), "volumes": [],
+                "private_net": [], "primary_disk_size": self._server_type(server_type)["disk"], "placement_group": None,
+            }
+            self.servers[server["id"]] = server
+            return server
+
+    def add_snapshot(self, description: str, labels: dict, protected: bool = False, created: str = None) -> dict:
+        with self.lock:
+            image = {
+                "id": self._id(), "type": "snapshot", "status": "available", "name": None,
+                "description": description, "image_size": 1.0, "disk_size": 20, "created": created or _now(),
+                "created_from": None, "bound_to": None, "os_flavor": "ubuntu", "os_version": None,
+                "rapid_deploy": False, "protection": {"delete": protected}, "deprecated": None,
+                "labels": dict(labels), "architecture": "x86",
+            }
+            self.images[image["id"]] = image
+            return image
+
+    def add_floating_ip(self, ip: str, labels: dict) -> dict:
+        with self.lock:
+            floating_ip = {
+                "id": self._id(), "name": ip, "description": None, "ip": ip, "type": "ipv4", "server": None,
+                "dns_ptr": [], "home_location": dict(LOCATIONS[1]), "blocked": False,
+                "protection": {"delete": False}, "labels": dict(labels), "created": _now(),
+            }
+            self.floating_ips[floating_ip["id"]] = floating_ip
+            return floating_ip
+
+    def add_ssh_key(self, name: str, labels: dict) -> dict:
+        with self.lock:
+            ssh_key = {"id": self._id(), "name": name, "fingerprint": "00:00", "public_key": "ssh-ed25519 AAAA",
+                       "labels": dict(labels), "created": _now()}
+            self.ssh_keys[ssh_key["id"]] = ssh_key
+            return ssh_key
+
+    # ---------------------------------------------------------------- actions
+
+    def _add_action(self, command: str, resources: list, on_finish=None) -> dict:
+        action = {"id": self._id(), "command": command, "status": "running", "progress": 0, "started": _now(),
+                  "finished": None, "resources": resources, "error": None}
+        self.actions[action["id"]] = {"action": action, "started": time.monotonic(),
+                                      "delay": self.action_delays.get(command, DEFAULT_ACTION_DELAY),
+                                      "on_finish": on_finish}
+        self._advance_action(action["id"])
+        return action
+
+    def _advance_action(self, action_id: int) -> dict:
+        entry = self.actions[action_id]
+        action = entry["action"]
+        if action["status"] == "running":
+            elapsed = time.monotonic() - entry["started"]
+            if entry["delay"] <= 0 or elapsed >= entry["delay"]:
+                action.update(status="success", progress=100, finished=_now())
+                if entry["on_finish"] is not None:
+                    entry["on_finish"]()
+            else:
+                action["progress"] = int(100 * elapsed / entry["delay"])
+        return action
+
+    def _advance_all(self):
+        for action_id in list(self.actions):
+            self._advance_action(action_id)
+        now = time.monotonic()
+        for server_id, off_at in list(self.guest_shutdowns.items()):
+            if now >= off_at:
+                del self.guest_shutdowns[server_id]
+                if server_id in self.servers and self.servers[server_id]["status"] == "running":
+                    self.servers[server_id]["status"] = "off"
+
+    # ---------------------------------------------------------------- http
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:" + str(self._server.server_port) + "/v1"
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method: str):
+                started = time.monotonic()
+                if api.request_latency:
+                    time.sleep(api.request_latency)
+                parsed = urllib.parse.urlsplit(self.path)
+                query = urllib.parse.parse_qs(parsed.query)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                path = parsed.path[len("/v1"):] if parsed.path.startswith("/v1") else parsed.path
+                endpoint = method + " " + re.sub(r"/\d+", "/{id}", path)
+
+                with api.lock:
+                    api.requests[endpoint] += 1
+                    api._advance_all()
+                    try:
+                        status, payload = api.handle(method, path, query, body)
+                    except KeyError:
+                        status, payload = 404, {"error": {"code": "not_found", "message": "not found"}}
+
+                data = b"" if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                with api.lock:
+                    api.request_seconds[endpoint] += time.monotonic() - started
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-hcloud-api", daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests.clear()
+            self.request_seconds.clear()
+
+    # ---------------------------------------------------------------- routing
+
+    @staticmethod
+    def _list(name: str, items: list) -> dict:
+        return {name: items, "meta": {"pagination": {"page": 1, "per_page": max(len(items), 1), "previous_page": None,
+                                                     "next_page": None, "last_page": 1,
+                                                     "total_entries": len(items)}}}
+
+    @staticmethod
+    def _filter(items, query: dict) -> list:
+        result = list(items)
+        if "label_selector" in query:
+            result = [item for item in result if _matches_label_selector(item["labels"], query["label_selector"][0])]
+        if "name" in query:
+            result = [item for item in result if item["name"] == query["name"][0]]
+        if "status" in query:
+            result = [item for item in result if item["status"] in query["status"]]
+        if "type" in query:
+            result = [item for item in result if item["type"] in query["type"]]
+        return result
+
+    def handle(self, method: str, path: str, query: dict, body: dict) -> tuple:
+        """
+        :return: http status and json payload (None for an empty body)
+        """
+        parts = [part for part in path.split("/") if part]
+        resource = parts[0] if parts else ""
+        resource_id = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+
+        if resource == "actions":
+            if resource_id is not None:
+                return 200, {"action": self.actions[resource_id]["action"]}
+            ids = [int(action_id) for action_id in query.get("id", [])]
+            return 200, self._list("actions", [self.actions[action_id]["action"] for action_id in ids])
+
+        if resource == "server_types":
+            return 200, self._list("server_types", self._filter(SERVER_TYPES, query))
+
+        if resource == "locations":
+            return 200, self._list("locations", self._filter(LOCATIONS, query))
+
+        if resource == "ssh_keys":
+            return 200, self._list("ssh_keys", self._filter(self.ssh_keys.values(), query))
+
+        if resource == "images":
+            if method == "DELETE":
+                del self.images[resource_id]
+                return 204, None
+            if resource_id is not None:
+                return 200, {"image": self.images[resource_id]}
+            images = self._filter(self.images.values(), query)
+            if query.get("sort", [""])[0].startswith("created:desc"):
+                images.sort(key=lambda image: (image["created"], image["id"]), reverse=True)
+            return 200, self._list("images", images)
+
+        if resource == "floating_ips":
+            if len(parts) == 4 and parts[3] == "assign":
+                floating_ip = self.floating_ips[resource_id]
+                server_id = body["server"]
+
+                def assign():
+                    floating_ip["server"] = server_id
+
+                return 201, {"action": self._add_action("assign_floating_ip",
+                                                        [{"id": resource_id, "type": "floating_ip"}], assign)}
+            if resource_id is not None:
+                return 200, {"floating_ip": self.floating_ips[resource_id]}
+            return 200, self._list("floating_ips", self._filter(self.floating_ips.values(), query))
+
+        if resource == "servers":
+            return self._handle_servers(method, parts, resource_id, query, body)
+
+        return 404, {"error": {"code": "not_found", "message": "not found"}}
+
+    def _handle_servers(self, method: str, parts: list, server_id, query: dict, body: dict) -> tuple:
+        if method == "GET":
+            if server_id is not None:
+                return 200, {"server": self.servers[server_id]}
+            return 200, self._list("servers", self._filter(self.servers.values(), query))
+
+        if method == "POST" and server_id is None:
+            image = self.images[int(body["image"])]
+            location = body.get("location") or image["labels"].get("server_location", "nbg1")
+            server = self.add_server(body["name"], body.get("labels", {}), server_type=body["server_type"],
+                                     location=location, status="initializing")
+
+            def running():
+                server["status"] = "running"
+
+            action = self._add_action("create_server", [{"id": server["id"], "type": "server"}], running)
+            return 201, {"server": server, "action": action, "next_actions": [], "root_password": None}
+
+        server = self.servers[server_id]
+        resources = [{"id": server_id, "type": "server"}]
+
+        if method == "PUT":
+            server.update({name: body[name] for name in ("name", "labels") if name in body})
+            return 200, {"server": server}
+
+        if method == "DELETE":
+            def delete():
+                self.servers.pop(server_id, None)
+
+            server["status"] = "deleting"
+            return 200, {"action": self._add_action("delete_server", resources, delete)}
+
+        command = parts[3] if len(parts) == 4 else ""
+        if command == "shutdown":
+            def acpi_sent():
+                if self.guest_shutdown_delay is not None:
+                    self.guest_shutdowns[server_id] = time.monotonic() + self.guest_shutdown_delay
+
+            return 201, {"action": self._add_action("shutdown_server", resources, acpi_sent)}
+
+        if command == "poweroff":
+            server["status"] = "stopping"
+            self.guest_shutdowns.pop(server_id, None)
+
+            def off():
+                server["status"] = "off"
+
+            return 201, {"action": self._add_action(command + "_server", resources, off)}
+
+        if command == "poweron":
+            server["status"] = "starting"
+
+            def on():
+                server["status"] = "running"
+
+            return 201, {"action": self._add_action("start_server", resources, on)}
+
+        if command == "create_image":
+            image = self.add_snapshot(body.get("description", ""), body.get("labels", {}))
+            image["status"] = "creating"
+            image["created_from"] = {"id": server_id, "name": server["name"]}
+
+            def available():
+                image["status"] = "available"
+
+            action = self._add_action("create_image", resources, available)
+            return 201, {"image": image, "action": action}
+
+        if command == "change_type":
+            if server["status"] != "off":
+                return 423, {"error": {"code": "server_not_stopped", "message": "server must be stopped"}}
+            server_type = self._server_type(body["server_type"])
+
+            def change_type():
+                server["server_type"] = dict(server_type)
+                if body.get("upgrade_disk", True):
+                    server["primary_disk_size"] = server_type["disk"]
+
+            return 201, {"action": self._add_action("change_server_type", resources, change_type)}
+
+        return 404, {"error": {"code": "not_found", "message": "not found"}}
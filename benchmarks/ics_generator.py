@@ -0,0 +1,86 @@
+import datetime
+import random
+
+TIMEZONES = ["Europe/Berlin", "Europe/London", "America/New_York", "America/Los_Angeles", "Asia/Kolkata",
+             "Asia/Tokyo", "Australia/Sydney", "UTC"]
+''' timezones used for DTSTART/DTEND of the generated events '''
+SERVER_TYPES = ["", "", "", "cx21", "cpx31", "ccx31"]
+''' server_type directives, '' means no directive '''
+
+
+def _format(dt: datetime.datetime) -> str:
+    return dt.strftime("%Y%m%dT%H%M%S")
+
+
+def _event(uid: str, start: datetime.datetime, end: datetime.datetime, timezone_name: str, summary: str,
+           server_type: str = "", extra: list = None) -> list:
+    lines = ["BEGIN:VEVENT",
+             "UID:" + uid,
+             "DTSTAMP:20200101T000000Z",
+             "DTSTART;TZID=" + timezone_name + ":" + _format(start),
+             "DTEND;TZID=" + timezone_name + ":" + _format(end),
+             "SUMMARY:" + summary]
+    if server_type:
+        lines.append("DESCRIPTION:server_type: " + server_type)
+    lines += extra or []
+    lines.append("END:VEVENT")
+    return lines
+
+
+def generate_ics(one_off_events: int = 2000, recurring_events: int = 200, history_days: int = 3 * 365,
+                 future_days: int = 30, seed: int = 42, now: datetime.datetime = None) -> bytes:
+    """Generate a synthetic calendar
+
+    :param one_off_events: number of single events, spread from history_days ago till future_days ahead
+    :param recurring_events: number of recurring series (daily/weekly RRULEs with EXDATEs and overridden occurrences),
+    started within the history
+    :param history_days: days of history
+    :param future_days: days ahead
+    :param seed: seed for random, the same arguments always give the same calendar
+    :param now: reference time, defaults to now
+    :return: ical data
+    """
+    rnd = random.Random(seed)
+    if now is None:
+        now = datetime.datetime.now()
+    now = now.replace(second=0, microsecond=0)
+
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//hcloud-calendar-automation//benchmark//EN"]
+
+    for idx in range(one_off_events):
+        start = now + datetime.timedelta(minutes=rnd.randint(-history_days * 24 * 60, future_days * 24 * 60))
+        end = start + datetime.timedelta(minutes=rnd.choice([5, 15, 30, 60, 90, 120, 240, 480]))
+        lines += _event("one-off-" + str(idx), start, end, rnd.choice(TIMEZONES), "one-off " + str(idx),
+                        server_type=rnd.choice(SERVER_TYPES))
+
+    for idx in range(recurring_events):
+        start = now - datetime.timedelta(days=rnd.randint(1, history_days), minutes=rnd.randint(0, 24 * 60))
+        start = start.replace(minute=rnd.choice([0, 15, 30, 45]))
+        end = start + datetime.timedelta(minutes=rnd.choice([30, 60, 120, 240, 600]))
+        timezone_name = rnd.choice(TIMEZONES)
+        uid = "recurring-" + str(idx)
+
+        if rnd.random() < 0.5:
+            rrule = "RRULE:FREQ=DAILY;INTERVAL=" + str(rnd.choice([1, 1, 2, 3]))
+            step = datetime.timedelta(days=1)
+        else:
+            rrule = "RRULE:FREQ=WEEKLY;BYDAY=" + ",".join(rnd.sample(["MO", "TU", "WE", "TH", "FR"], rnd.randint(1, 5)))
+            step = datetime.timedelta(weeks=1)
+        if rnd.random() < 0.3:
+            rrule += ";UNTIL=" + _format(now + datetime.timedelta(days=rnd.randint(-history_days // 2, future_days))) + "Z"
+
+        # EXDATEs in the past and around now
+        exdates = [start + step * rnd.randint(1, 50) for _ in range(rnd.randint(0, 5))]
+        extra = [rrule] + ["EXDATE;TZID=" + timezone_name + ":" + _format(exdate) for exdate in exdates]
+        lines += _event(uid, start, end, timezone_name, "recurring " + str(idx),
+                        server_type=rnd.choice(SERVER_TYPES), extra=extra)
+
+        # some overridden occurrences
+        for override in range(rnd.randint(0, 2)):
+            recurrence_id = start + step * rnd.randint(1, 100)
+            moved = recurrence_id + datetime.timedelta(minutes=rnd.choice([-60, -30, 30, 60]))
+            lines += _event(uid, moved, moved + (end - start), timezone_name, "moved " + str(idx),
+                            extra=["RECURRENCE-ID;TZID=" + timezone_name + ":" + _format(recurrence_id)])
+
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(lines) + "\r\n").encode()
@@ -0,0 +1,208 @@
+"""One entry point for all commands of hcloud-calendar-automation
+
+    python cli.py run                 # resident loop of main.py
+    python cli.py fleet               # resident loop of fleet.py
+    python cli.py tick                # one reconciliation of every entry, then exit (e.g. from a systemd timer)
+    python cli.py create | destroy | shutdown | snapshot | assign-floating-ip | delete-snapshots
+
+Modules like hcloud, icalendar and recurring_ical_events are only imported by the commands needing them.
+"""
+import argparse
+import sys
+import time
+
+started = time.perf_counter()
+''' start of the cold start measurement of tick '''
+
+
+def _get_client(api_token: str = None):
+    from hcloud import Client
+    import config
+    import hcloud_metrics
+    return hcloud_metrics.instrument_client(Client(token=api_token or config.API_TOKEN,
+                                                   poll_interval=config.HCLOUD_POOL_INTERVAL))
+
+
+def command_run(args) -> int:
+    import runpy
+    runpy.run_module("main", run_name="__main__")
+    return 0
+
+
+def command_fleet(args) -> int:
+    import runpy
+    runpy.run_module("fleet", run_name="__main__")
+    return 0
+
+
+def command_tick(args) -> int:
+    """Reconcile every entry of FLEET (or IMAGE_TOKEN) once, with the server state from the journal, and exit"""
+    import logging
+    import config
+    import fleet
+    import hcloud_automation
+    import hcloud_calendar
+    import hcloud_journal
+    import hcloud_metrics
+    import hcloud_reconcile
+    imported = time.perf_counter()
+
+    logger = logging.getLogger("Application")
+    journal = hcloud_journal.open_journal(config)
+
+    failed = False
+    for fleet_entry in fleet.get_fleet_entries(journal=journal):
+        if args.token and fleet_entry.token not in args.token:
+            continue
+        observed = None
+        if journal is not None:
+            observed = journal.get_observed(fleet_entry.token, max_age=hcloud_reconcile.get_setting(
+                fleet_entry.entry, "HEALTH_CHECK_INTERVAL", hcloud_reconcile.HEALTH_CHECK_INTERVAL))
+        server_is_running, server_is_running_as = observed if observed is not None else (False, '')
+        try:
+            # without a recent journaled state, the tick reads it from the hcloud api
+            server_is_running, server_is_running_as, seconds_until_next_tick = hcloud_reconcile.reconcile(
+                fleet_entry.client,
+                entry=fleet_entry.entry,
+                server_is_running=server_is_running,
+                server_is_running_as=server_is_running_as,
+                cache_token=fleet_entry.cache_token,
+                health_check=observed is None,
+                journal=journal)
+            print(fleet_entry.token + ": server_is_running=" + str(server_is_running) + " " + server_is_running_as +
+                  ", next transition in " + str(int(seconds_until_next_tick)) + " seconds")
+        except Exception:
+            logger.exception("'" + fleet_entry.token + "' Something during processing went wrong")
+            print(fleet_entry.token + ": failed, see log")
+            failed = True
+
+    hcloud_automation.wait_for_background_cleanups()
+    hcloud_calendar.wait_for_background_refreshes()
+    hcloud_metrics.write(config)
+    finished = time.perf_counter()
+    logger.info("tick: imports %.3f s, reconciliation %.3f s", imported - started, finished - imported)
+    if args.timing:
+        print("imports %.3f s, reconciliation %.3f s, total %.3f s" % (
+            imported - started, finished - imported, finished - started))
+    return 1 if failed else 0
+
+
+def command_create(args) -> int:
+    import config
+    import hcloud_automation
+    return 0 if hcloud_automation.create_server_from_snapshot(
+        _get_client(), snapshot_token=config.IMAGE_TOKEN, override_server_type=args.server_type) else 1
+
+
+def command_destroy(args) -> int:
+    import config
+    import hcloud_automation
+    result = hcloud_automation.destroy_first_server(_get_client(), snapshot_token=config.IMAGE_TOKEN)
+    hcloud_automation.wait_for_background_cleanups()
+    return 0 if result else 1
+
+
+def command_shutdown(args) -> int:
+    import config
+    import hcloud_automation
+    return 0 if hcloud_automation.first_server_power_off(_get_client(), snapshot_token=config.IMAGE_TOKEN) else 1
+
+
+def command_snapshot(args) -> int:
+    import config
+    import hcloud_automation
+    snapshot_created, image_id = hcloud_automation.create_snapshot_for_first_server(
+        _get_client(), snapshot_token=config.IMAGE_TOKEN)
+    return 0 if snapshot_created else 1
+
+
+def command_assign_floating_ip(args) -> int:
+    import config
+    import hcloud_automation
+    return 0 if hcloud_automation.first_server_assign_floating_ip(
+        _get_client(), snapshot_token=config.IMAGE_TOKEN) else 1
+
+
+def command_delete_snapshots(args) -> int:
+    import datetime
+    import config
+    import hcloud_automation
+
+    keep_newer_than = None
+    if args.keep_newer_than_hours > 0:
+        keep_newer_than = datetime.timedelta(hours=args.keep_newer_than_hours)
+
+    entries = [{}]
+    if args.all:
+        entries = getattr(config, "FLEET", None) or [{}]
+
+    clients = {}
+    for entry in entries:
+        api_token = entry.get("API_TOKEN", config.API_TOKEN)
+        if api_token not in clients:
+            clients[api_token] = _get_client(api_token)
+        snapshot_token = entry.get("IMAGE_TOKEN", config.IMAGE_TOKEN)
+
+        print("cleanup snapshots for token " + snapshot_token + ": " + str(hcloud_automation.cleanup_snapshots_for_token(
+            clients[api_token],
+            snapshot_token=snapshot_token,
+            keep_snapshots=None,
+            keep_last=args.keep_last,
+            keep_newer_than=keep_newer_than,
+            max_workers=args.max_workers if args.max_workers is not None else getattr(
+                config, "SNAPSHOT_CLEANUP_MAX_WORKERS", 4))))
+    return 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="hetzner cloud automation driven by a calendar")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("run", help="reconcile IMAGE_TOKEN in a resident loop (main.py)").set_defaults(
+        function=command_run)
+    commands.add_parser("fleet", help="reconcile every entry of FLEET in a resident loop (fleet.py)").set_defaults(
+        function=command_fleet)
+
+    tick = commands.add_parser("tick", help="reconcile every entry once and exit, e.g. from a systemd timer")
+    tick.add_argument("--token", action="append", help="only reconcile this IMAGE_TOKEN, may be repeated")
+    tick.add_argument("--timing", action="store_true", help="print the cold start time")
+    tick.set_defaults(function=command_tick)
+
+    create = commands.add_parser("create", help="create the server from its youngest snapshot")
+    create.add_argument("--server-type", default="", help="use this server_type instead of the snapshot's label")
+    create.set_defaults(function=command_create)
+    commands.add_parser("destroy", help="power off, snapshot and delete the server").set_defaults(
+        function=command_destroy)
+    commands.add_parser("shutdown", help="power off the server").set_defaults(function=command_shutdown)
+    commands.add_parser("snapshot", help="create a snapshot of the server").set_defaults(function=command_snapshot)
+    commands.add_parser("assign-floating-ip", help="assign the floating ip to the server").set_defaults(
+        function=command_assign_floating_ip)
+
+    delete_snapshots = commands.add_parser(
+        "delete-snapshots", help="delete snapshots for IMAGE_TOKEN or, with --all, for every token of FLEET")
+    delete_snapshots.add_argument("--all", action="store_true", help="cleanup every token in config.FLEET")
+    delete_snapshots.add_argument("--keep-last", type=int, default=0, help="keep this many youngest snapshots per token")
+    delete_snapshots.add_argument("--keep-newer-than-hours", type=float, default=0,
+                                  help="keep snapshots younger than this")
+    delete_snapshots.add_argument("--max-workers", type=int, default=None,
+                                  help="maximum number of concurrent deletions per token "
+                                       "(default: SNAPSHOT_CLEANUP_MAX_WORKERS)")
+    delete_snapshots.set_defaults(function=command_delete_snapshots)
+    return parser
+
+
+def main(argv: list = None) -> int:
+    """
+    :param argv: command line arguments without the program name, defaults to sys.argv[1:]
+    :return: exit code
+    """
+    args = get_parser().parse_args(argv)
+    import config
+    import hcloud_logging
+    # every command writes to the queued, rotating LOG_FILE with LOG_LEVEL of config.py
+    hcloud_logging.setup(config)
+    return args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,6 @@
-from hcloud import Client
+import sys
 
-import hcloud_automation
-import config
+import cli
 
-client = Client(token=config.API_TOKEN, poll_interval=config.HCLOUD_POOL_INTERVAL)
-
-hcloud_automation.delete_all_snapshots_for_token(
-    client,
-    snapshot_token=config.IMAGE_TOKEN,
-    keep_snapshots=None)
+# kept for existing setups, see cli.py delete-snapshots
+sys.exit(cli.main(["delete-snapshots"] + sys.argv[1:]))
@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+from hcloud import Client
+import hcloud_actions
+import hcloud_automation
+import hcloud_calendar
+import hcloud_journal
+import hcloud_lifecycle
+import hcloud_logging
+import hcloud_metrics
+import hcloud_reconcile
+import hcloud_tracing
+import config
+import time
+import os
+
+import logging
+
+logger = logging.getLogger("Application")
+
+
+class FleetEntry:
+    """State of one calendar/server entry of config.FLEET"""
+
+    def __init__(self, entry: dict, client: Client, cache_token: str,
+                 lifecycle_executor: hcloud_lifecycle.LifecycleExecutor = None, journal: hcloud_journal.Journal = None):
+        self.entry = entry
+        self.token = hcloud_reconcile.get_setting(entry, "IMAGE_TOKEN")
+        self.client = client
+        self.cache_token = cache_token
+        self.lifecycle_executor = lifecycle_executor
+        self.journal = journal
+        self.server_is_running = None
+        self.server_is_running_as = ''
+        self.next_tick = 0
+        self.calendar_changed = False
+        self.next_health_check = time.monotonic() + hcloud_reconcile.get_setting(
+            entry, "HEALTH_CHECK_INTERVAL", hcloud_reconcile.HEALTH_CHECK_INTERVAL)
+        self.future = None
+
+    def tick(self):
+        """Run one reconciliation for this entry. Exceptions are logged, so one entry never stops the others"""
+        try:
+            if self.server_is_running is None and self.journal is not None:
+                # get server-state during Start from the journal, if it is recent enough and nothing was interrupted
+                observed = self.journal.get_observed(self.token, max_age=hcloud_reconcile.get_setting(
+                    self.entry, "HEALTH_CHECK_INTERVAL", hcloud_reconcile.HEALTH_CHECK_INTERVAL))
+                if observed is not None:
+                    self.server_is_running, self.server_is_running_as = observed
+            if self.server_is_running is None:
+                # get server-state during Start
+                self.server_is_running, self.server_is_running_as = \
+                    hcloud_automation.first_server_is_running_or_starting(self.client, snapshot_token=self.token)
+
+            health_check = time.monotonic() >= self.next_health_check
+            if health_check:
+                self.next_health_check = time.monotonic() + hcloud_reconcile.get_setting(
+                    self.entry, "HEALTH_CHECK_INTERVAL", hcloud_reconcile.HEALTH_CHECK_INTERVAL)
+
+            self.server_is_running, self.server_is_running_as, seconds_until_next_tick = hcloud_reconcile.reconcile(
+                self.client,
+                entry=self.entry,
+                server_is_running=self.server_is_running,
+                server_is_running_as=self.server_is_running_as,
+                cache_token=self.cache_token,
+                health_check=health_check,
+                executor=self.lifecycle_executor,
+                journal=self.journal)
+            self.next_tick = min(time.monotonic() + seconds_until_next_tick, self.next_health_check)
+            hcloud_metrics.write(config)
+        except Exception:
+            logger.exception("'" + self.token + "' Something during processing went wrong")
+            self.next_tick = time.monotonic() + 60
+
+
+def get_fleet_entries(lifecycle_executor: hcloud_lifecycle.LifecycleExecutor = None,
+                      journal: hcloud_journal.Journal = None) -> list:
+    """Build all FleetEntry objects from config.FLEET
+
+    Entries with the same API_TOKEN share one hcloud.Client and entries with the same ICAL_URL share one cache_file,
+    so the calendar is downloaded only once.
+    If config.FLEET is not set, the single IMAGE_TOKEN/ICAL_URL of config.py is used.
+
+    :param lifecycle_executor: shared by all entries to run their lifecycle operations, None runs them in the tick
+    :param journal: shared by all entries to record their state, None records nothing
+    :return: list of FleetEntry
+    :rtype: list
+    """
+    fleet = getattr(config, "FLEET", None)
+    if not fleet:
+        fleet = [{"IMAGE_TOKEN": config.IMAGE_TOKEN, "ICAL_URL": config.ICAL_URL}]
+
+    clients = {}
+    cache_tokens = {}
+    fleet_entries = []
+    for entry in fleet:
+        api_token = hcloud_reconcile.get_setting(entry, "API_TOKEN")
+        if api_token not in clients:
+            poll_interval = hcloud_reconcile.get_setting(entry, "HCLOUD_POOL_INTERVAL")
+            clients[api_token] = hcloud_metrics.instrument_client(Client(token=api_token, poll_interval=poll_interval))
+            # the actions of all entries of this client are polled together, at most every poll_interval seconds
+            hcloud_actions.get_tracker(clients[api_token], max_interval=poll_interval)
+
+        ical_url = hcloud_reconcile.get_setting(entry, "ICAL_URL")
+        if ical_url not in cache_tokens:
+            cache_tokens[ical_url] = hcloud_reconcile.get_setting(entry, "IMAGE_TOKEN")
+
+        fleet_entries.append(FleetEntry(entry, client=clients[api_token], cache_token=cache_tokens[ical_url],
+                                        lifecycle_executor=lifecycle_executor, journal=journal))
+    return fleet_entries
+
+
+if __name__ == "__main__":
+    hcloud_logging.setup(config)
+    logger.info("start processing fleet...")
+    logger.info("working-directory is " + os.getcwd())
+
+    print("start processing fleet...")
+    print("working-directory is " + os.getcwd())
+
+    lifecycle_executor = None
+    if getattr(config, "LIFECYCLE_NON_BLOCKING", True):
+        fleet_size = len(getattr(config, "FLEET", None) or [None])
+        lifecycle_executor = hcloud_lifecycle.LifecycleExecutor(
+            max_workers=getattr(config, "LIFECYCLE_MAX_WORKERS", min(fleet_size, 8)))
+
+    fleet_entries = get_fleet_entries(lifecycle_executor, journal=hcloud_journal.open_journal(config))
+    hcloud_metrics.start(config)
+    hcloud_tracing.configure(config)
+    max_workers = getattr(config, "FLEET_MAX_WORKERS", min(len(fleet_entries), 8))
+    logger.info("fleet has " + str(len(fleet_entries)) + " entries, using " + str(max_workers) + " workers")
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fleet")
+    try:
+        while True:
+            if hcloud_calendar.calendar_changed.is_set():
+                logger.debug("calendar-source changed, reconciling all entries")
+                hcloud_calendar.calendar_changed.clear()
+                for fleet_entry in fleet_entries:
+                    fleet_entry.calendar_changed = True
+
+            now = time.monotonic()
+            for fleet_entry in fleet_entries:
+                # a running tick (e.g. a slow destroy_first_server) only blocks its own entry
+                if fleet_entry.future is not None and not fleet_entry.future.done():
+                    continue
+                if now >= fleet_entry.next_tick or fleet_entry.calendar_changed:
+                    fleet_entry.calendar_changed = False
+                    fleet_entry.next_tick = float("inf")
+                    fleet_entry.future = executor.submit(fleet_entry.tick)
+            hcloud_calendar.calendar_changed.wait(timeout=1)
+
+    except SystemExit:
+        logger.info("stopped processing")
+        print("stopped.")
+
+    except KeyboardInterrupt:
+        logger.info("stopped processing")
+        print("stopped.")
+
+    except:
+        logger.error("Something during processing went wrong")
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if lifecycle_executor is not None:
+            logger.info("waiting for running lifecycle jobs...")
+            lifecycle_executor.shutdown(wait=True)
@@ -0,0 +1,248 @@
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from hcloud.actions.client import BoundAction
+from hcloud.actions.domain import ActionFailedException, ActionTimeoutException
+from hcloud import Client
+import config
+import threading
+import time
+import logging
+
+logger = logging.getLogger("Application")
+
+MIN_POLL_INTERVAL = 1
+''' default for config.ACTION_MIN_POLL_INTERVAL: seconds between two polls, while actions make progress '''
+MAX_POLL_INTERVAL = 10
+''' default for config.HCLOUD_POOL_INTERVAL: seconds between two polls, while no action makes progress '''
+MAX_IDS_PER_REQUEST = 50
+''' maximum ids of one GET /actions request (maximum per_page of the api) '''
+_trackers = {}
+''' one ActionTracker per hcloud.Client '''
+_trackers_lock = threading.Lock()
+
+
+class ActionTracker:
+    """
+    Polls all in-flight actions of one hcloud.Client together, with one GET /actions?id=... per interval
+
+    Each tracked action resolves a Future. Servers waited for to reach a status, e.g. off after a shutdown, are
+    polled along, with one GET /servers?status=... per interval and status. The interval adapts to the progress of the actions: it is estimated from
+    their progress rate, between min_interval and max_interval, and grows while nothing progresses.
+    """
+
+    def __init__(self, client: Client, min_interval: float = MIN_POLL_INTERVAL, max_interval: float = None):
+        """
+        :param client: instance of hcloud.client()
+        :param min_interval: shortest seconds between two polls
+        :param max_interval: longest seconds between two polls, defaults to HCLOUD_POOL_INTERVAL from config.py
+        """
+        self.client = client
+        if max_interval is None:
+            max_interval = getattr(config, "HCLOUD_POOL_INTERVAL", MAX_POLL_INTERVAL)
+        self.max_interval = max_interval
+        self.min_interval = min(min_interval, max_interval)
+        self.interval = self.min_interval
+        self.pending = {}
+        ''' action id -> [Future, last progress, time of last progress] '''
+        self.watches = {}
+        ''' server id -> [Future, wanted status] '''
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def track(self, action) -> Future:
+        """
+        Track the given action
+
+        :param action: BoundAction or Action
+        :return: Future, resolved with the finished BoundAction or failed with ActionFailedException
+        """
+        future = Future()
+        if action.status == "success":
+            future.set_result(action)
+            return future
+        if action.status == "error":
+            future.set_exception(ActionFailedException(action=action))
+            return future
+
+        with self.condition:
+            if action.id in self.pending:
+                return self.pending[action.id][0]
+            self.pending[action.id] = [future, action.progress or 0, time.monotonic()]
+            self._wake()
+        return future
+
+    def watch(self, server, status: str) -> Future:
+        """
+        Track the status of the given server
+
+        :param server: BoundServer or Server
+        :param status: wanted status, e.g. "off"
+        :return: Future, resolved with True once server has status
+        """
+        with self.condition:
+            if server.id in self.watches and self.watches[server.id][1] == status:
+                return self.watches[server.id][0]
+            future = Future()
+            self.watches[server.id] = [future, status]
+            self._wake()
+        return future
+
+    def _wake(self):
+        # called with self.condition held
+        self.interval = self.min_interval
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name="hcloud-actions", daemon=True)
+            self.thread.start()
+        self.condition.notify()
+
+    def wait(self, action, timeout: float = None) -> BoundAction:
+        """
+        Block until the given action is finished
+
+        :param action: BoundAction or Action
+        :param timeout: seconds to wait at most, None waits forever
+        :return: the finished BoundAction
+        :raise: ActionFailedException if the action failed, ActionTimeoutException if it is still running at timeout
+        """
+        future = self.track(action)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            with self.condition:
+                if self.pending.get(action.id, [None])[0] is future:
+                    del self.pending[action.id]
+            raise ActionTimeoutException(action=action)
+
+    def wait_for_status(self, server, status: str, timeout: float = None) -> bool:
+        """
+        Block until the given server has status
+
+        :param server: BoundServer or Server
+        :param status: wanted status, e.g. "off"
+        :param timeout: seconds to wait at most, None waits forever
+        :return: True, once server has status; False, if it has not at timeout
+        """
+        future = self.watch(server, status)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            with self.condition:
+                if self.watches.get(server.id, [None])[0] is future:
+                    del self.watches[server.id]
+            return False
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.watches:
+                    # stop the thread, if nothing is tracked for a while
+                    if not self.condition.wait(timeout=60) and not self.pending and not self.watches:
+                        self.thread = None
+                        return
+                # track() lowers the interval and notifies, so a new action does not wait for a backed off poll
+                polled = time.monotonic()
+                while self.pending or self.watches:
+                    remaining = polled + self.interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(timeout=remaining)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Polling actions failed")
+                with self.condition:
+                    self.interval = self.max_interval
+
+    def poll(self):
+        """
+        Reload all pending actions and watched servers and resolve the finished ones
+        """
+        with self.condition:
+            ids = list(self.pending)
+            statuses = set(status for future, status in self.watches.values())
+        if not ids and not statuses:
+            return
+
+        now = time.monotonic()
+        intervals = []
+        for idx in range(0, len(ids), MAX_IDS_PER_REQUEST):
+            chunk = ids[idx:idx + MAX_IDS_PER_REQUEST]
+            response = self.client.request("GET", "/actions", params={"id": chunk, "per_page": MAX_IDS_PER_REQUEST})
+            for data in response["actions"]:
+                action = BoundAction(self.client.actions, data)
+                with self.condition:
+                    entry = self.pending.get(action.id)
+                    if entry is None:
+                        continue
+                    if action.status == "running":
+                        progress = action.progress or 0
+                        if progress > entry[1]:
+                            # estimate the remaining time from the progress rate since the last progress
+                            rate = (progress - entry[1]) / max(now - entry[2], 0.001)
+                            intervals.append((100 - progress) / rate)
+                            entry[1] = progress
+                            entry[2] = now
+                        continue
+                    del self.pending[action.id]
+                if action.status == "error":
+                    entry[0].set_exception(ActionFailedException(action=action))
+                else:
+                    entry[0].set_result(action)
+
+        for status in statuses:
+            for server in self.client.servers.get_all(status=[status]):
+                with self.condition:
+                    watch = self.watches.get(server.id)
+                    if watch is None or watch[1] != status:
+                        continue
+                    del self.watches[server.id]
+                watch[0].set_result(True)
+
+        with self.condition:
+            if intervals:
+                self.interval = min(max(min(intervals), self.min_interval), self.max_interval)
+            else:
+                # no progress, back off
+                self.interval = min(self.interval * 2, self.max_interval)
+
+
+def get_tracker(client: Client, max_interval: float = None) -> ActionTracker:
+    """
+    :param client: instance of hcloud.client()
+    :param max_interval: longest seconds between two polls, if the tracker of client is created; defaults to
+    HCLOUD_POOL_INTERVAL from config.py
+    :return: the ActionTracker shared by all callers of client
+    """
+    with _trackers_lock:
+        if id(client) not in _trackers or _trackers[id(client)].client is not client:
+            _trackers[id(client)] = ActionTracker(
+                client, min_interval=getattr(config, "ACTION_MIN_POLL_INTERVAL", MIN_POLL_INTERVAL),
+                max_interval=max_interval)
+        return _trackers[id(client)]
+
+
+def wait_until_finished(client: Client, action, max_retries: int = 300) -> BoundAction:
+    """
+    Replacement of BoundAction.wait_until_finished, which shares one poll with all in-flight actions of client
+
+    :param client: instance of hcloud.client()
+    :param action: BoundAction or Action
+    :param max_retries: the timeout is max_retries times HCLOUD_POOL_INTERVAL, like BoundAction's
+    :return: the finished BoundAction
+    :raise: ActionFailedException, ActionTimeoutException
+    """
+    tracker = get_tracker(client)
+    return tracker.wait(action, timeout=max_retries * tracker.max_interval)
+
+
+def wait_until_status(client: Client, server, status: str, timeout: float) -> bool:
+    """
+    Wait until server has status, polled together with all in-flight actions of client
+
+    :param client: instance of hcloud.client()
+    :param server: BoundServer or Server
+    :param status: wanted status, e.g. "off"
+    :param timeout: seconds to wait at most
+    :return: True, once server has status; False, if it has not at timeout
+    """
+    return get_tracker(client).wait_for_status(server, status, timeout=timeout)
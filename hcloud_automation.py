@@ -1,7 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
 from hcloud.actions.domain import ActionFailedException, ActionTimeoutException
 from hcloud.images.domain import Image
-from hcloud import Client
+from hcloud import APIException, Client
+import hcloud_actions
+import hcloud_history
+import hcloud_lifecycle
+import hcloud_metrics
+import hcloud_tracing
 import config
+import datetime
+import threading
+import time
 import logging
 
 logging.basicConfig(filename='error.log',
@@ -12,8 +21,150 @@ logger = logging.getLogger("Application")
 API_TOKEN = config.API_TOKEN
 IMAGE_TOKEN = config.IMAGE_TOKEN
 
+_lookup_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hcloud-lookup")
+''' runs independent api lookups concurrently '''
+_catalog_cache = {}
+''' server_types and locations never change, they are cached for the process lifetime '''
+_catalog_cache_lock = threading.Lock()
+_cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hcloud-cleanup")
+''' runs snapshot cleanups after a teardown, outside of destroy_first_server '''
+SHUTDOWN_TIMEOUT = 120
+''' default for config.SHUTDOWN_TIMEOUT: seconds the os gets to shut down gracefully, before the server is powered off '''
 
-def create_snapshot_for_first_server(client: Client, snapshot_token: str = IMAGE_TOKEN) -> tuple:
+
+class ResourceState:
+    """Servers, snapshots, floating ips and ssh keys for one token
+
+    Every resource list is loaded with one api call on first use and kept until it is invalidated.
+    Share one instance between the calls of one tick or lifecycle operation to avoid redundant round-trips;
+    functions which change a resource invalidate it themselves.
+    """
+
+    def __init__(self, client: Client, snapshot_token: str = IMAGE_TOKEN):
+        """
+        :param client: instance of hcloud.client()
+        :type client: hcloud.Client()
+        :param snapshot_token: unique token which identify all your resources
+        :type snapshot_token: str
+        """
+        self.client = client
+        self.snapshot_token = snapshot_token
+        self._resources = {}
+
+    def _get(self, name: str, loader):
+        if name not in self._resources:
+            self._resources[name] = loader(label_selector="token=" + self.snapshot_token)
+        return self._resources[name]
+
+    @property
+    def servers(self) -> list:
+        return self._get("servers", self.client.servers.get_all)
+
+    @property
+    def images(self) -> list:
+        """all snapshots for the token, youngest first"""
+        return self._get("images", lambda label_selector: self.client.images.get_all(type="snapshot",
+                                                                                     label_selector=label_selector,
+                                                                                     sort="created:desc"))
+
+    @property
+    def floating_ips(self) -> list:
+        return self._get("floating_ips", self.client.floating_ips.get_all)
+
+    @property
+    def ssh_keys(self) -> list:
+        return self._get("ssh_keys", self.client.ssh_keys.get_all)
+
+    def load(self, *names: str):
+        """Load the given resource lists (e.g. "images", "ssh_keys") concurrently, if not loaded yet"""
+        futures = [_lookup_executor.submit(getattr, self, name) for name in names if name not in self._resources]
+        for future in futures:
+            future.result()
+
+    def invalidate(self, *names: str):
+        """Forget the given resource lists (e.g. "servers", "images"), or all of them if no name is given"""
+        if not names:
+            self._resources.clear()
+        for name in names:
+            self._resources.pop(name, None)
+
+
+def get_location_name(server) -> str:
+    """Location name of a server, older hcloud-python versions only know it through the datacenter
+
+    :param server: BoundServer
+    :return: e.g. nbg1
+    """
+    location = getattr(server, "location", None)
+    if location is None:
+        location = server.datacenter.location
+    return location.name
+
+
+def wait_for_background_cleanups():
+    """Block until all snapshot cleanups started by destroy_first_server are finished"""
+    _cleanup_executor.submit(lambda: None).result()
+
+
+def _record_duration(phase: str, started: float, server=None, server_type: str = "", location: str = ""):
+    """Record the duration since started in hcloud_history, server_type and location are taken from server if given"""
+    try:
+        if server is not None:
+            server_type = server.server_type.name
+            location = get_location_name(server)
+        hcloud_history.record_duration(phase, time.monotonic() - started, server_type=str(server_type),
+                                       location=str(location))
+    except Exception:
+        # measuring must never break a lifecycle operation
+        logger.warning("could not record duration of " + phase)
+
+
+def _report_progress(progress, state: str, **details):
+    """Report the next step of a lifecycle job, see hcloud_lifecycle.LifecycleJob.progress"""
+    if progress is not None:
+        progress(state, **details)
+
+
+def _get_catalog_entry(kind: str, name: str, loader):
+    with _catalog_cache_lock:
+        if (kind, name) in _catalog_cache:
+            return _catalog_cache[(kind, name)]
+    entry = loader(name)
+    if entry is not None:
+        with _catalog_cache_lock:
+            _catalog_cache[(kind, name)] = entry
+    return entry
+
+
+def get_server_type(client: Client, name: str):
+    """Get server_type by name, cached for the process lifetime
+
+    :param client: instance of hcloud.client()
+    :param name: e.g. cx21
+    :return: BoundServerType or None
+    """
+    return _get_catalog_entry("server_type", name, client.server_types.get_by_name)
+
+
+def get_location(client: Client, name: str):
+    """Get location by name, cached for the process lifetime
+
+    :param client: instance of hcloud.client()
+    :param name: e.g. nbg1
+    :return: BoundLocation or None
+    """
+    return _get_catalog_entry("location", name, client.locations.get_by_name)
+
+
+def _get_resources(client: Client, snapshot_token: str, resources: ResourceState = None) -> ResourceState:
+    if resources is None or resources.snapshot_token != snapshot_token:
+        return ResourceState(client, snapshot_token=snapshot_token)
+    return resources
+
+
+@hcloud_tracing.traced
+def create_snapshot_for_first_server(client: Client, snapshot_token: str = IMAGE_TOKEN,
+                                     resources: ResourceState = None, progress=None) -> tuple:
     """Creates a snapshot for the first server
 
     :param client: instance of hcloud.client()
@@ -22,11 +173,14 @@ def create_snapshot_for_first_server(client: Client, snapshot_token: str = IMAGE
     which identify all your resources. this is mainly because one project can contain multiple servers and resources
     at once
     :type snapshot_token: str
+    :param resources: ResourceState to share api results with other calls
+    :param progress: optional callable of the lifecycle job, action_id and image_id of the snapshot are reported to it
     :return: bool: success state / int: id of created image, None in case of error
     :rtype: tuple
     """
     try:
-        response_server = client.servers.get_all(label_selector="token=" + snapshot_token)
+        resources = _get_resources(client, snapshot_token, resources)
+        response_server = resources.servers
 
         if len(response_server) >= 1:
             server = response_server[0]
@@ -44,9 +198,10 @@ def create_snapshot_for_first_server(client: Client, snapshot_token: str = IMAGE
 
         if "server_location" not in server_labels:
             server_labels.update(
-                server_location=server.datacenter.location.name
+                server_location=get_location_name(server)
             )
 
+        started = time.monotonic()
         response = server.create_image(
             description="creation was automated for token " + snapshot_token,
             type="snapshot",
@@ -54,22 +209,43 @@ def create_snapshot_for_first_server(client: Client, snapshot_token: str = IMAGE
 
         # response is BoundAction, we also need image.id - lets find
         image_id = response.image.id
+        resources.invalidate("images")
+        # journaled, so a restart waits for the snapshot instead of creating another one
+        _report_progress(progress, hcloud_lifecycle.SNAPSHOTTING, action_id=response.action.id, image_id=image_id)
 
         try:
-            client.actions.get_by_id(response.action.id).wait_until_finished(max_retries=300)
+            with hcloud_metrics.ACTION_WAIT_SECONDS.time(phase="snapshot"):
+                hcloud_actions.wait_until_finished(client, response.action, max_retries=300)
+            _record_duration("snapshot", started, server=server)
+            hcloud_metrics.OPERATIONS.inc(operation="snapshot", token=snapshot_token, result="success")
             logger.info("Snapshot for server '" + server.name + "' and token '" + snapshot_token + "' created.")
             return True, image_id
 
         except (ActionFailedException, ActionTimeoutException):
+            hcloud_metrics.OPERATIONS.inc(operation="snapshot", token=snapshot_token, result="failure")
             logger.error("Snapshot for server '" + server.name + "' and token '" + snapshot_token + "' failed.")
             return False, None
     except:
         return False, None
 
 
-def delete_all_snapshots_for_token(client: Client, snapshot_token: str = IMAGE_TOKEN,
-                                   keep_snapshots: list = []) -> bool:
-    """Delete all snapshots for the given snapshot_token, except all the snapshot_ids in keep_snapshot
+def _delete_snapshot(client: Client, image_id: int) -> bool:
+    try:
+        client.images.delete(Image(image_id))
+        return True
+    except Exception:
+        logger.error("delete snapshot " + str(image_id) + " not possible")
+        return False
+
+
+@hcloud_tracing.traced
+def cleanup_snapshots_for_token(client: Client, snapshot_token: str = IMAGE_TOKEN, keep_snapshots: list = None,
+                                keep_last: int = 0, keep_newer_than: datetime.timedelta = None,
+                                max_workers: int = 4, resources: ResourceState = None) -> bool:
+    """Delete snapshots for the given snapshot_token in parallel, following the given retention policy
+
+    Snapshots are never deleted, if they are protected, their description does not contain snapshot_token
+    or their id is in keep_snapshots.
 
     :param client: instance of hcloud.client()
     :type client: hcloud.Client()
@@ -79,30 +255,105 @@ def delete_all_snapshots_for_token(client: Client, snapshot_token: str = IMAGE_T
     :type snapshot_token: str
     :param keep_snapshots: list of snapshot.ids which should not be deleted
     :type keep_snapshots: list
+    :param keep_last: number of youngest snapshots which are kept, in addition to the ones kept anyway
+    :type keep_last: int
+    :param keep_newer_than: snapshots created within this timespan are kept
+    :type keep_newer_than: datetime.timedelta
+    :param max_workers: maximum number of concurrent deletions
+    :type max_workers: int
+    :param resources: ResourceState to share api results with other calls
     :return: False in case of any error, otherwise True
     :rtype: bool
     """
     try:
-        response = client.images.get_all(type="snapshot", label_selector="token=" + snapshot_token)
-        for resp in response:
+        resources = _get_resources(client, snapshot_token, resources)
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        delete_snapshots = []
+        kept_last = 0
+        # resources.images is sorted youngest first
+        for resp in resources.images:
             # snapshot.token        in description
             # snapshot.id           not in keep_snapshots
             # snapshot.protection   not True
-
             if snapshot_token not in resp.description or resp.protection['delete']:
                 continue
-            if keep_snapshots is None:
-                client.images.delete(Image(resp.id))
-            elif resp.id not in keep_snapshots:
-                client.images.delete(Image(resp.id))
-        logger.info("delete all snapshots for token success")
-        return True
+            if keep_snapshots is not None and resp.id in keep_snapshots:
+                continue
+            # only snapshots, which could be deleted, count for keep_last
+            if kept_last < keep_last:
+                kept_last += 1
+                continue
+            if keep_newer_than is not None and resp.created is not None and now - resp.created < keep_newer_than:
+                continue
+            delete_snapshots.append(resp.id)
+
+        logger.debug("deleting " + str(len(delete_snapshots)) + " snapshots for token " + snapshot_token)
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1), thread_name_prefix="hcloud-delete") as executor:
+            results = list(executor.map(lambda image_id: _delete_snapshot(client, image_id), delete_snapshots))
+        resources.invalidate("images")
+
+        if all(results):
+            logger.info("cleanup snapshots for token success")
+            return True
+        logger.error("cleanup snapshots for token incomplete")
+        return False
     except:
-        logger.error("delete all snapshots for token not possible")
+        logger.error("cleanup snapshots for token not possible")
         return False
 
 
-def first_server_power_off(client: Client, snapshot_token: str = IMAGE_TOKEN) -> bool:
+def _get_setting(entry: dict, name: str, default):
+    """Setting of one FLEET entry, falling back to config.py, like hcloud_reconcile.get_setting"""
+    if entry is not None and name in entry:
+        return entry[name]
+    return getattr(config, name, default)
+
+
+def cleanup_snapshots_for_token_in_background(client: Client, snapshot_token: str = IMAGE_TOKEN,
+                                              keep_snapshots: list = None, entry: dict = None):
+    """Run cleanup_snapshots_for_token in background, with the retention policy from entry or config.py
+
+    :param entry: dict with optional overrides of SNAPSHOT_KEEP_LAST, SNAPSHOT_KEEP_NEWER_THAN_HOURS and
+    SNAPSHOT_CLEANUP_MAX_WORKERS in config.py, e.g. one item of config.FLEET
+    :return: Future of the cleanup
+    """
+    keep_newer_than = None
+    keep_newer_than_hours = _get_setting(entry, "SNAPSHOT_KEEP_NEWER_THAN_HOURS", 0)
+    if keep_newer_than_hours > 0:
+        keep_newer_than = datetime.timedelta(hours=keep_newer_than_hours)
+    return _cleanup_executor.submit(cleanup_snapshots_for_token, client,
+                                    snapshot_token=snapshot_token,
+                                    keep_snapshots=keep_snapshots,
+                                    keep_last=_get_setting(entry, "SNAPSHOT_KEEP_LAST", 0),
+                                    keep_newer_than=keep_newer_than,
+                                    max_workers=_get_setting(entry, "SNAPSHOT_CLEANUP_MAX_WORKERS", 4))
+
+
+def delete_all_snapshots_for_token(client: Client, snapshot_token: str = IMAGE_TOKEN,
+                                   keep_snapshots: list = [], resources: ResourceState = None) -> bool:
+    """Delete all snapshots for the given snapshot_token, except all the snapshot_ids in keep_snapshot
+
+    :param client: instance of hcloud.client()
+    :type client: hcloud.Client()
+    :param snapshot_token: unique token
+    which identify all your resources. this is mainly because one project can contain multiple servers and resources
+    at once
+    :type snapshot_token: str
+    :param keep_snapshots: list of snapshot.ids which should not be deleted
+    :type keep_snapshots: list
+    :param resources: ResourceState to share api results with other calls
+    :return: False in case of any error, otherwise True
+    :rtype: bool
+    """
+    return cleanup_snapshots_for_token(client, snapshot_token=snapshot_token, keep_snapshots=keep_snapshots,
+                                       max_workers=getattr(config, "SNAPSHOT_CLEANUP_MAX_WORKERS", 4),
+                                       resources=resources)
+
+
+@hcloud_tracing.traced
+def first_server_power_off(client: Client, snapshot_token: str = IMAGE_TOKEN, resources: ResourceState = None,
+                           progress=None) -> bool:
     """Shutdown the first server for the given snapshot_token
 
     :param client: instance of hcloud.client()
@@ -111,16 +362,35 @@ def first_server_power_off(client: Client, snapshot_token: str = IMAGE_TOKEN) ->
     which identify all your resources. this is mainly because one project can contain multiple servers and resources
     at once
     :type snapshot_token: str
+    :param resources: ResourceState to share api results with other calls
+    :param progress: optional callable, called with the hcloud_lifecycle state before each step; it may raise
+    hcloud_lifecycle.LifecycleCancelled to stop before the step
     :return: False in case of any error, otherwise True
     :rtype: bool
     """
+    _report_progress(progress, hcloud_lifecycle.STOPPING)
     try:
-        server = client.servers.get_all(label_selector="token=" + snapshot_token)[0]
+        resources = _get_resources(client, snapshot_token, resources)
+        server = resources.servers[0]
 
         if server.status != "off":
             try:
                 logger.debug("Shutting down server...")
-                server.shutdown().wait_until_finished(max_retries=300)
+                started = time.monotonic()
+                action = server.shutdown()
+                resources.invalidate("servers")
+                with hcloud_metrics.ACTION_WAIT_SECONDS.time(phase="power_off"):
+                    hcloud_actions.wait_until_finished(client, action, max_retries=300)
+                    # the shutdown action is finished, once the ACPI request is sent, not once the server is off
+                    if not hcloud_actions.wait_until_status(client, server, "off",
+                                                            getattr(config, "SHUTDOWN_TIMEOUT", SHUTDOWN_TIMEOUT)):
+                        logger.warning("Server '" + server.name + "' did not shut down, powering it off")
+                        action = server.power_off()
+                        hcloud_actions.wait_until_finished(client, action, max_retries=300)
+                        if not hcloud_actions.wait_until_status(client, server, "off",
+                                                                getattr(config, "SHUTDOWN_TIMEOUT", SHUTDOWN_TIMEOUT)):
+                            return False
+                _record_duration("power_off", started, server=server)
             except (ActionFailedException, ActionTimeoutException):
                 return False
         return True
@@ -128,7 +398,9 @@ def first_server_power_off(client: Client, snapshot_token: str = IMAGE_TOKEN) ->
         return False
 
 
-def first_server_power_on(client: Client, snapshot_token: str = IMAGE_TOKEN) -> bool:
+@hcloud_tracing.traced
+def first_server_power_on(client: Client, snapshot_token: str = IMAGE_TOKEN, resources: ResourceState = None,
+                          progress=None) -> bool:
     """Power on the first server for the given snapshot_token
 
     :param client: instance of hcloud.client() :type client: hcloud.Client()
@@ -136,24 +408,35 @@ def first_server_power_on(client: Client, snapshot_token: str = IMAGE_TOKEN) ->
     which identify all your resources. this is mainly because one project can contain multiple servers and resources
     at once
     :type snapshot_token: str
+    :param resources: ResourceState to share api results with other calls
+    :param progress: optional callable, called with the hcloud_lifecycle state before each step; it may raise
+    hcloud_lifecycle.LifecycleCancelled to stop before the step
     :return: False in case of any error, otherwise True
     :rtype: bool
     """
+    _report_progress(progress, hcloud_lifecycle.STARTING)
     try:
-        server = client.servers.get_all(label_selector="token=" + snapshot_token)[0]
+        resources = _get_resources(client, snapshot_token, resources)
+        server = resources.servers[0]
 
         if server.status != "running":
             try:
-                server.power_on().wait_until_finished(max_retries=300)
+                action = server.power_on()
+                resources.invalidate("servers")
+                with hcloud_metrics.ACTION_WAIT_SECONDS.time(phase="power_on"):
+                    hcloud_actions.wait_until_finished(client, action, max_retries=300)
                 return True
 
             except (ActionFailedException, ActionTimeoutException):
                 return False
+        return True
     except:
         return False
 
 
-def delete_first_server(client: Client, snapshot_token: str = IMAGE_TOKEN) -> object:
+@hcloud_tracing.traced
+def delete_first_server(client: Client, snapshot_token: str = IMAGE_TOKEN, resources: ResourceState = None,
+                        progress=None) -> object:
     """Delete the first server found for given snapshot_token
 
     :param client: instance of hcloud.client()
@@ -162,12 +445,17 @@ def delete_first_server(client: Client, snapshot_token: str = IMAGE_TOKEN) -> ob
     which identify all your resources. this is mainly because one project can contain multiple servers and resources
     at once
     :type snapshot_token: str
+    :param resources: ResourceState to share api results with other calls
+    :param progress: optional callable, called with the hcloud_lifecycle state before each step; it may raise
+    hcloud_lifecycle.LifecycleCancelled to stop before the step
     :return: False in case of any error, otherwise True
     :rtype: bool
     """
+    _report_progress(progress, hcloud_lifecycle.DELETING)
     try:
         # get first server
-        response = client.servers.get_all(label_selector="token=" + snapshot_token)
+        resources = _get_resources(client, snapshot_token, resources)
+        response = resources.servers
 
         if len(response) > 0:
             server = response[0]
@@ -175,7 +463,10 @@ def delete_first_server(client: Client, snapshot_token: str = IMAGE_TOKEN) -> ob
         else:
             logger.info("delete_first_server no server left. done")
             return True
+        started = time.monotonic()
         client.servers.delete(server)
+        resources.invalidate("servers")
+        _record_duration("delete", started, server=server)
         logger.info("delete_first_server success")
         return True
     except (ActionFailedException, ActionTimeoutException):
@@ -183,7 +474,103 @@ def delete_first_server(client: Client, snapshot_token: str = IMAGE_TOKEN) -> ob
         return False
 
 
-def create_server_from_snapshot(client: Client, snapshot_token=IMAGE_TOKEN, override_server_type: str = '') -> bool:
+@hcloud_tracing.traced
+def rescale_first_server(client: Client, snapshot_token: str = IMAGE_TOKEN, server_type: str = '',
+                         upgrade_disk: bool = False, resources: ResourceState = None, progress=None) -> bool:
+    """Change the server_type of the first server in place: power off, change type, power on
+
+    Unlike destroy_first_server and create_server_from_snapshot, no snapshot is created. Without upgrade_disk, the
+    disk keeps its size, so the server can be scaled down again later.
+
+    :param client: instance of hcloud.client()
+    :type client: hcloud.Client()
+    :param snapshot_token: unique token
+    which identify all your resources. this is mainly because one project can contain multiple servers and resources
+    at once
+    :type snapshot_token: str
+    :param server_type: the new server_type, '' means the server_type of the server's label
+    :param upgrade_disk: if True, the disk is resized to the new server_type and can not be scaled down afterwards
+    :param resources: ResourceState to share api results with other calls
+    :param progress: optional callable, called with the hcloud_lifecycle state before each step; it may raise
+    hcloud_lifecycle.LifecycleCancelled to stop before the step
+    :return: False in case of any error, otherwise True
+    :rtype: bool
+    """
+    started = time.monotonic()
+    try:
+        resources = _get_resources(client, snapshot_token, resources)
+        server = resources.servers[0]
+        if server_type == '':
+            server_type = server.labels['server_type']
+        if server.server_type.name == server_type:
+            return True
+
+        server_type_future = _lookup_executor.submit(get_server_type, client, server_type)
+        logger.info("Rescaling server '" + server.name + "' from " + server.server_type.name + " to " + server_type)
+
+        _report_progress(progress, hcloud_lifecycle.STOPPING)
+        if not first_server_power_off(client, snapshot_token=snapshot_token, resources=resources):
+            logger.error("Rescaling server '" + server.name + "' failed: could not power off")
+            return False
+
+        _report_progress(progress, hcloud_lifecycle.RESCALING)
+        if not _change_server_type(client, server, server_type_future.result(), upgrade_disk=upgrade_disk,
+                                   resources=resources):
+            logger.error("Rescaling server '" + server.name + "' failed, powering on with the old server_type")
+            first_server_power_on(client, snapshot_token=snapshot_token, resources=resources)
+            return False
+
+        _report_progress(progress, hcloud_lifecycle.STARTING)
+        if not first_server_power_on(client, snapshot_token=snapshot_token, resources=resources):
+            logger.error("Rescaling server '" + server.name + "' failed: could not power on")
+            return False
+        _record_duration("rescale", started, server_type=server_type, location=get_location_name(server))
+        logger.info("Server '" + server.name + "' for token '" + snapshot_token + "' rescaled to " + server_type)
+        return True
+    except hcloud_lifecycle.LifecycleCancelled:
+        raise
+    except:
+        logger.error("Something went wrong during rescaling server")
+        return False
+
+
+def _change_server_type(client: Client, server, server_type, upgrade_disk: bool = False,
+                        resources: ResourceState = None) -> bool:
+    """Change the server_type of a powered off server
+
+    A server with another server_type than its label is labeled rescaled=true, so destroy_first_server scales it back
+    before the snapshot instead of treating it as non-persistable.
+
+    :param client: instance of hcloud.client()
+    :param server: BoundServer, powered off
+    :param server_type: BoundServerType
+    :param upgrade_disk: if True, the disk is resized to the new server_type
+    :param resources: ResourceState, its servers are invalidated
+    :return: False in case of any error, otherwise True
+    """
+    try:
+        action = server.change_type(server_type, upgrade_disk=upgrade_disk)
+        if resources is not None:
+            resources.invalidate("servers")
+        with hcloud_metrics.ACTION_WAIT_SECONDS.time(phase="rescale"):
+            hcloud_actions.wait_until_finished(client, action, max_retries=300)
+
+        labels = dict(server.labels)
+        if server_type.name == labels.get('server_type'):
+            labels.pop('rescaled', None)
+        else:
+            labels['rescaled'] = "true"
+        if labels != server.labels:
+            server.update(labels=labels)
+        return True
+    except Exception:
+        logger.exception("Changing server_type of server '" + server.name + "' failed")
+        return False
+
+
+@hcloud_tracing.traced
+def create_server_from_snapshot(client: Client, snapshot_token=IMAGE_TOKEN, override_server_type: str = '',
+                                resources: ResourceState = None, progress=None) -> bool:
     """Create a new server from first found snapshot for given snapshot_token
 
     :param override_server_type: if given, the server_type from snapshot label is not used
@@ -193,18 +580,29 @@ def create_server_from_snapshot(client: Client, snapshot_token=IMAGE_TOKEN, over
     which identify all your resources. this is mainly because one project can contain multiple servers and resources
     at once
     :type snapshot_token: str
+    :param resources: ResourceState to share api results with other calls
+    :param progress: optional callable, called with the hcloud_lifecycle state before each step; it may raise
+    hcloud_lifecycle.LifecycleCancelled to stop before the step
     :return: False in case of any error, otherwise True
     :raise: Error if no snapshot image found
     :rtype: bool
     """
+    _report_progress(progress, hcloud_lifecycle.CREATING)
+    started = time.monotonic()
+    resources = _get_resources(client, snapshot_token, resources)
+
+    server_type_future = None
+    if override_server_type != "":
+        server_type_future = _lookup_executor.submit(get_server_type, client, override_server_type)
+
+    # grab image, floating ip and ssh_keys at once
+    resources.load("images", "floating_ips", "ssh_keys")
     # grab image for server from first youngest snapshot
-    response_image = client.images.get_all(type="snapshot",
-                                           label_selector="token=" + snapshot_token,
-                                           sort="created:desc")
+    response_image = resources.images
     # grab floating ip
-    response_floating_ip = client.floating_ips.get_all(label_selector="token=" + snapshot_token)
+    response_floating_ip = resources.floating_ips
     # grab ssh_keys
-    response_ssh_keys = client.ssh_keys.get_all(label_selector="token=" + snapshot_token)
+    response_ssh_keys = resources.ssh_keys
 
     # No Image -> Cry
     if len(response_image) < 1:
@@ -222,6 +620,9 @@ def create_server_from_snapshot(client: Client, snapshot_token=IMAGE_TOKEN, over
 
     if override_server_type != "":
         server_type = override_server_type
+    else:
+        server_type_future = _lookup_executor.submit(get_server_type, client, server_type)
+    location = get_location(client, image.labels['server_location'])
 
     logger.info("Creating Server...")
     logger.info("Use :                 " + image.description)
@@ -236,16 +637,22 @@ def create_server_from_snapshot(client: Client, snapshot_token=IMAGE_TOKEN, over
     try:
         response = client.servers.create(
             name=image.labels['server_name'],
-            server_type=client.server_types.get_by_name(server_type),
-            image=client.images.get_by_id(image.id),
+            server_type=server_type_future.result(),
+            image=image,
             user_data=user_data,
-            location=client.locations.get_by_name(image.labels['server_location']),
+            location=location,
             start_after_create=True,
             ssh_keys=ssh_keys,
             labels=image.labels)
+        resources.invalidate("servers")
+        # journaled, so a restart waits for the server instead of creating another one
+        _report_progress(progress, hcloud_lifecycle.CREATING, action_id=response.action.id,
+                         server_id=response.server.id)
 
         # wait until server complete
-        client.actions.get_by_id(response.action.id).wait_until_finished(max_retries=300)
+        with hcloud_metrics.ACTION_WAIT_SECONDS.time(phase="create"):
+            hcloud_actions.wait_until_finished(client, response.action, max_retries=300)
+        _record_duration("create", started, server_type=server_type, location=image.labels['server_location'])
         logger.info("Server '" + image.labels['server_name'] + "' for token '" + snapshot_token + "' created - Type is " + server_type)
 
     except (ActionFailedException, ActionTimeoutException) as e:
@@ -255,11 +662,16 @@ def create_server_from_snapshot(client: Client, snapshot_token=IMAGE_TOKEN, over
     try:
         # assign floating ip
         if len(response_floating_ip) >= 1:
+            _report_progress(progress, hcloud_lifecycle.ASSIGNING_IP)
             floating_ip = response_floating_ip[0]
-            logger.info("client.floating_ips.assign " +
-                        floating_ip.ip +
-                        " - " +
-                        str(client.floating_ips.assign(floating_ip, response.server).wait_until_finished(max_retries=300)))
+            started = time.monotonic()
+            action = client.floating_ips.assign(floating_ip, response.server)
+            with hcloud_metrics.ACTION_WAIT_SECONDS.time(phase="assign_floating_ip"):
+                result = hcloud_actions.wait_until_finished(client, action, max_retries=300)
+            logger.info("client.floating_ips.assign " + floating_ip.ip + " - " + str(result.status))
+            resources.invalidate("floating_ips")
+            _record_duration("assign_floating_ip", started, server_type=server_type,
+                             location=image.labels['server_location'])
         return True
 
     except (ActionFailedException, ActionTimeoutException) as e:
@@ -267,7 +679,9 @@ def create_server_from_snapshot(client: Client, snapshot_token=IMAGE_TOKEN, over
         return False
 
 
-def first_server_assign_floating_ip(client: Client, snapshot_token=IMAGE_TOKEN) -> bool:
+@hcloud_tracing.traced
+def first_server_assign_floating_ip(client: Client, snapshot_token=IMAGE_TOKEN, resources: ResourceState = None,
+                                    progress=None) -> bool:
     """Assig floating ip for first found server for given snapshot_token
 
     :param client: instance of hcloud.client()
@@ -276,29 +690,115 @@ def first_server_assign_floating_ip(client: Client, snapshot_token=IMAGE_TOKEN)
     which identify all your resources. this is mainly because one project can contain multiple servers and resources
     at once
     :type snapshot_token: str
+    :param resources: ResourceState to share api results with other calls
+    :param progress: optional callable, called with the hcloud_lifecycle state before each step; it may raise
+    hcloud_lifecycle.LifecycleCancelled to stop before the step
     :return: False in case of any error, otherwise True
     :raise: Error if no snapshot image found
     :rtype: bool
     """
-    # grab image for server from first youngest snapshot
-    response_image = client.images.get_all(type="snapshot",
-                                           label_selector="token=" + snapshot_token,
-                                           sort="created:desc")
+    _report_progress(progress, hcloud_lifecycle.ASSIGNING_IP)
+    resources = _get_resources(client, snapshot_token, resources)
     # grab floating ip
-    response_floating_ip = client.floating_ips.get_all(label_selector="token=" + snapshot_token)
+    response_floating_ip = resources.floating_ips
 
-    server = client.servers.get_all(label_selector="token=" + snapshot_token)[0]
+    server = resources.servers[0]
     # assign floating ip
     if len(response_floating_ip) >= 1:
         floating_ip = response_floating_ip[0]
-        logger.info("client.floating_ips.assign " +
-                    floating_ip.ip +
-                    " - " +
-                    str(client.floating_ips.assign(floating_ip, server).wait_until_finished(max_retries=300)))
+        action = client.floating_ips.assign(floating_ip, server)
+        with hcloud_metrics.ACTION_WAIT_SECONDS.time(phase="assign_floating_ip"):
+            result = hcloud_actions.wait_until_finished(client, action, max_retries=300)
+        logger.info("client.floating_ips.assign " + floating_ip.ip + " - " + str(result.status))
+        resources.invalidate("floating_ips")
     return True
 
 
-def first_server_is_running_or_starting(client: Client, snapshot_token=IMAGE_TOKEN) -> bool:
+def wait_for_action(client: Client, action_id: int) -> bool:
+    """Wait for an action, which was started before a restart, e.g. the snapshot of an interrupted destroy
+
+    :param client: instance of hcloud.client()
+    :type client: hcloud.Client()
+    :param action_id: id of the action, as journaled by the lifecycle job
+    :return: True, if the action finished successfully
+    :rtype: bool
+    """
+    try:
+        hcloud_actions.wait_until_finished(client, client.actions.get_by_id(action_id), max_retries=300)
+        return True
+    except (ActionFailedException, ActionTimeoutException):
+        logger.error("Action " + str(action_id) + " of an interrupted job failed")
+        return False
+    except APIException:
+        logger.error("Action " + str(action_id) + " of an interrupted job not found")
+        return False
+
+
+@hcloud_tracing.traced
+def resume_destroy(client: Client, snapshot_token: str = IMAGE_TOKEN, snapshot_id: int = None,
+                   action_id: int = None, resources: ResourceState = None, entry: dict = None,
+                   progress=None) -> bool:
+    """Finish a destroy, which was interrupted by a restart while snapshotting or deleting
+
+    :param client: instance of hcloud.client()
+    :type client: hcloud.Client()
+    :param snapshot_token: unique token
+    which identify all your resources. this is mainly because one project can contain multiple servers and resources
+    at once
+    :type snapshot_token: str
+    :param snapshot_id: id of the snapshot of the interrupted destroy
+    :param action_id: if given, the snapshot was still being created, its action is waited for first
+    :param resources: ResourceState to share api results with other calls
+    :param entry: dict with optional overrides of the snapshot retention in config.py, e.g. one item of config.FLEET
+    :param progress: optional callable, called with the hcloud_lifecycle state before each step; it may raise
+    hcloud_lifecycle.LifecycleCancelled to stop before the step
+    :return: False, if the snapshot failed, otherwise True
+    :rtype: bool
+    """
+    resources = _get_resources(client, snapshot_token, resources)
+    if action_id is not None:
+        _report_progress(progress, hcloud_lifecycle.SNAPSHOTTING, action_id=action_id, image_id=snapshot_id)
+        if not wait_for_action(client, action_id):
+            return False
+        resources.invalidate("images")
+    _report_progress(progress, hcloud_lifecycle.DELETING, snapshot_id=snapshot_id)
+    # the snapshot must still exist, all other snapshots of the token are deleted by the cleanup
+    if snapshot_id is not None and any(image.id == snapshot_id for image in resources.images):
+        cleanup_snapshots_for_token_in_background(client, snapshot_token=snapshot_token, keep_snapshots=[snapshot_id],
+                                                  entry=entry)
+    return delete_first_server(client, snapshot_token=snapshot_token, resources=resources)
+
+
+@hcloud_tracing.traced
+def resume_start(client: Client, snapshot_token: str = IMAGE_TOKEN, action_id: int = None,
+                 resources: ResourceState = None, progress=None) -> bool:
+    """Finish a start, which was interrupted by a restart while creating the server or assigning the floating ip
+
+    :param client: instance of hcloud.client()
+    :type client: hcloud.Client()
+    :param snapshot_token: unique token
+    which identify all your resources. this is mainly because one project can contain multiple servers and resources
+    at once
+    :type snapshot_token: str
+    :param action_id: if given, the server was still being created, its action is waited for first
+    :param resources: ResourceState to share api results with other calls
+    :param progress: optional callable, called with the hcloud_lifecycle state before each step; it may raise
+    hcloud_lifecycle.LifecycleCancelled to stop before the step
+    :return: False, if the server could not be created, otherwise True
+    :rtype: bool
+    """
+    resources = _get_resources(client, snapshot_token, resources)
+    if action_id is not None:
+        _report_progress(progress, hcloud_lifecycle.CREATING, action_id=action_id)
+        if not wait_for_action(client, action_id):
+            return False
+        resources.invalidate("servers")
+    return first_server_assign_floating_ip(client, snapshot_token=snapshot_token, resources=resources,
+                                           progress=progress)
+
+
+@hcloud_tracing.traced
+def first_server_is_running_or_starting(client: Client, snapshot_token=IMAGE_TOKEN, resources: ResourceState = None) -> bool:
     """Check if first found server for given snapshot_token is either starting or running
 
     :param client: instance of hcloud.client()
@@ -307,21 +807,45 @@ def first_server_is_running_or_starting(client: Client, snapshot_token=IMAGE_TOK
     which identify all your resources. this is mainly because one project can contain multiple servers and resources
     at once
     :type snapshot_token: str
+    :param resources: ResourceState to share api results with other calls
     :return: True if server is running or starting, otherwise False; in addition: server_type
     :raise: Error if no snapshot image found
     :rtype: bool
     """
     server_status = ["initializing", "starting", "running"]
-    response_server = client.servers.get_all(label_selector="token=" + snapshot_token, status=server_status)
+    resources = _get_resources(client, snapshot_token, resources)
+    response_server = [server for server in resources.servers if server.status in server_status]
 
     if len(response_server) >= 1:
         return True, response_server[0].server_type.name
     else:
         return False, ''
 
-def destroy_first_server(client: Client, snapshot_token=IMAGE_TOKEN) -> bool:
+@hcloud_tracing.traced
+def first_server_is_powered_off(client: Client, snapshot_token=IMAGE_TOKEN, resources: ResourceState = None) -> bool:
+    """Check if the first found server for given snapshot_token exists, but is powered off (e.g. hibernated)
+
+    :param client: instance of hcloud.client()
+    :type client: hcloud.Client()
+    :param snapshot_token: unique token
+    which identify all your resources. this is mainly because one project can contain multiple servers and resources
+    at once
+    :type snapshot_token: str
+    :param resources: ResourceState to share api results with other calls
+    :return: True if the server is off
+    :rtype: bool
+    """
+    resources = _get_resources(client, snapshot_token, resources)
+    servers = resources.servers
+    return len(servers) >= 1 and servers[0].status == "off"
+
+
+@hcloud_tracing.traced
+def destroy_first_server(client: Client, snapshot_token=IMAGE_TOKEN, resources: ResourceState = None,
+                         entry: dict = None, progress=None) -> bool:
     """Power off first server, create a snapshot, cleanup unused snapshots and lastly delete your server
     Snapshot is only created, if the Server Type and the Label of the Server are identical.
+    A server rescaled in place (see rescale_first_server) is scaled back to the Server Type of its Label before.
 
     :param client: instance of hcloud.client()
     :type client: hcloud.Client()
@@ -329,42 +853,65 @@ def destroy_first_server(client: Client, snapshot_token=IMAGE_TOKEN) -> bool:
     which identify all your resources. this is mainly because one project can contain multiple servers and resources
     at once
     :type snapshot_token: str
+    :param resources: ResourceState to share api results with other calls
+    :param entry: dict with optional overrides of the snapshot retention in config.py, e.g. one item of config.FLEET
+    :param progress: optional callable, called with the hcloud_lifecycle state before each step; it may raise
+    hcloud_lifecycle.LifecycleCancelled to stop before the step
     :return: True on Success
     :raise: Error in case of any error
     :rtype: bool
     """
     try:
+        resources = _get_resources(client, snapshot_token, resources)
 
         create_snapshot = True
-        if first_server_power_off(client, snapshot_token=snapshot_token):
+        details = {}
+        _report_progress(progress, hcloud_lifecycle.STOPPING)
+        if first_server_power_off(client, snapshot_token=snapshot_token, resources=resources):
 
             # if this is a time-limited, non-persistable server, don't create a snapshot (see #8 for details)
             # if the label server_type and your real server type is not the same, we threat this server as non-persistable
             # a snapshot is only created, if your server type and server label are identical
-            servers = client.servers.get_all(label_selector="token=" + snapshot_token)
+            servers = resources.servers
             if len(servers) >= 1:
                 server = servers[0]
                 server_server_type = server.server_type.name
                 label_server_type = server.labels['server_type']
 
                 if server_server_type != label_server_type:
-                    create_snapshot = False
+                    if server.labels.get('rescaled') != "true":
+                        create_snapshot = False
+                    else:
+                        # rescaled in place, it is persistable with the server_type of its label
+                        _report_progress(progress, hcloud_lifecycle.RESCALING)
+                        if not _change_server_type(client, server, get_server_type(client, label_server_type),
+                                                   resources=resources):
+                            logger.warning("Could not scale server '" + server.name + "' back to " +
+                                           label_server_type + ", its snapshot keeps " + server_server_type)
 
             logger.debug("create_snapshot: " + str(create_snapshot))
 
             if create_snapshot:
 
-                snapshot_created, image_id = create_snapshot_for_first_server(client, snapshot_token=snapshot_token)
+                _report_progress(progress, hcloud_lifecycle.SNAPSHOTTING)
+                snapshot_created, image_id = create_snapshot_for_first_server(client, snapshot_token=snapshot_token,
+                                                                              resources=resources, progress=progress)
 
                 if snapshot_created:
+                    details["snapshot_id"] = image_id
                     keep_snapshots = [image_id]
 
-                    delete_all_snapshots_for_token(client, snapshot_token=snapshot_token, keep_snapshots=keep_snapshots)
+                    # cleanup is not needed to finish the teardown, so it does not block it
+                    cleanup_snapshots_for_token_in_background(client, snapshot_token=snapshot_token,
+                                                              keep_snapshots=keep_snapshots, entry=entry)
 
-            delete_first_server(client, snapshot_token=snapshot_token)
+            _report_progress(progress, hcloud_lifecycle.DELETING, **details)
+            delete_first_server(client, snapshot_token=snapshot_token, resources=resources)
 
         logger.info("Server destroyed")
         return True
+    except hcloud_lifecycle.LifecycleCancelled:
+        raise
     except:
         logger.error("Something went wrong during destroying server")
         raise Exception("Something went wrong during destroying server")
\ No newline at end of file
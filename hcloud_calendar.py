@@ -1,12 +1,24 @@
+import array
+import base64
 import datetime
+import gzip
+import hashlib
+import http.client
+import io
+import json
 import os
+import re
+import struct
+from collections import OrderedDict
 from urllib.error import URLError
 
 from dateutil import tz
-import icalendar
-import recurring_ical_events
-import urllib.request
+import urllib.parse
 from pathlib import Path
+import hcloud_logging
+import hcloud_metrics
+import hcloud_tracing
+import threading
 import logging
 
 logging.basicConfig(filename='error.log',
@@ -14,6 +26,53 @@ logging.basicConfig(filename='error.log',
                     format='[%(filename)s:%(lineno)s - %(funcName)20s() ] %(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("Application")
 
+_cache_file_locks = {}
+''' one lock per cache_file, so concurrent callers (e.g. fleet.py) sharing a cache_file do not read and write it at once '''
+_cache_file_locks_lock = threading.Lock()
+_background_refreshes = {}
+''' cache_file -> thread of its running background refresh '''
+HTTP_TIMEOUT = 30
+''' seconds until a request to the calendar-source is aborted '''
+_http_connections = {}
+''' keep-alive connections to calendar-sources, keyed by scheme and host '''
+calendar_changed = threading.Event()
+''' set, whenever a fetch stored a changed calendar-source in a cache_file '''
+_http_connection_locks = {}
+''' one lock per keep-alive connection, a connection handles one request at once '''
+
+
+CACHE_SIZE = 16
+''' number of parsed calendars and expanded event lists kept in memory '''
+EVENT_EXPANSION_WINDOW = datetime.timedelta(days=2)
+''' events are expanded this far ahead of a grid start, so following ticks can reuse the expansion '''
+PREFILTER_MARGIN = datetime.timedelta(days=2)
+''' one-off events ending more than this before the expansion start are dropped before parsing '''
+PREFILTER_KEEP_PROPERTIES = (b"RRULE", b"RDATE", b"EXRULE", b"RECURRENCE-ID", b"DURATION")
+''' events with any of these properties are always kept by filter_ical_data '''
+_calendar_cache = OrderedDict()
+''' parsed calendars, keyed by hash of ical_data and the date filter_ical_data was used with '''
+_event_span_cache = OrderedDict()
+''' expanded events, keyed by hash of ical_data and the grid parameters '''
+_rolling_schedules = {}
+''' RollingSchedules, keyed by name and timeslice_grid_interval; one per server, rebuilt when its other grid parameters
+change '''
+COMPILED_MAGIC = b"HCSC"
+COMPILED_VERSION = 2
+''' format version of compiled schedule files, files of another version are ignored '''
+_COMPILED_HEADER = struct.Struct("<4sHI")
+''' magic, version, length of the json metadata '''
+_COMPILED_SPAN = struct.Struct("<qqqqHI")
+''' one span, see _get_event_span; the server_type as index into the server_types and its UID group as index into
+the groups of the metadata '''
+_cache_lock = threading.Lock()
+
+
+def _get_cache_file_lock(cache_file: str) -> threading.Lock:
+    with _cache_file_locks_lock:
+        if cache_file not in _cache_file_locks:
+            _cache_file_locks[cache_file] = threading.Lock()
+        return _cache_file_locks[cache_file]
+
 
 def ceil(dt: datetime, interval: int) -> datetime:
     """
@@ -48,123 +107,985 @@ def get_server_type_from_description(description: str = "") -> str:
     except:
         return ""
 
-def get_datetime_and_timeslice_grid_for_now(ical_data: bytes = None, timezone_name: str = "Europe/Berlin",
-                                            timeslice_grid_interval: int = 15, start_advanced_time: int = 15,
-                                            end_lag_time: int = 30):
+def get_ical_hash(ical_data: bytes) -> str:
     """
-    
-    :param timezone_name:
-    :param ical_data:
-    :type timeslice_grid_interval: object
-    :rtype: object
+    Hash the given ical data, used as cache key for parsed calendars and expanded events
+
+    :param ical_data: binary reprasentation of ical data
+    :return: hex digest
     """
-    t = ""
-    ''' timeslice_grid_interval is the size in minutes of the time-chunks your timeslice-grid has'''
-    timezone = tz.gettz(timezone_name)
-    # todo: fix static timezone to dynamic or based on config
+    return hashlib.sha256(ical_data).hexdigest()
 
-    start_date = datetime.datetime.now(timezone).replace(second=0, microsecond=0)
-    ''' start_date is always round down to nearest timeslice_grid_interval'''
-    # round down to timeslice_grid_intervall
-    discard_start = datetime.timedelta(minutes=start_date.minute % timeslice_grid_interval,
-                                       seconds=start_date.second,
-                                       microseconds=start_date.microsecond)
-    start_date -= discard_start
-
-    end_date = start_date + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
-    ''' end_date is: (start_date + 23 Hour + 59 Minutes + 59 Seconds)'''
-    timedelta = datetime.timedelta(minutes=timeslice_grid_interval).total_seconds()
-    ''' timedelta is used to init grid_datetime - it represents the number of secondes between each timeslice'''
-
-    # Init all the grids
-    grid_datetime = [x for x in range(int(start_date.timestamp()), int(end_date.timestamp()), int(timedelta))]
-    ''' hold the timeinformation '''
-    grid_timeslice = [False] * len(grid_datetime)
-    ''' hold the run/not run information'''
-    grid_server_type = [''] * len(grid_datetime)
-    ''' hold the server_type information'''
+
+def write_compiled_spans(path: str, key: tuple, cached: tuple):
+    """
+    Store expanded event spans in a compact binary file, so a restart does not parse and expand the calendar again
+
+    The file holds a header, json metadata (key, expanded window, server_types, UID groups) and one fixed-size record
+    per span.
+
+    :param path: e.g. IMAGE_TOKEN.schedule, next to the cache_file of the calendar-source
+    :param key: hash of ical_data and the grid parameters, see get_event_spans
+    :param cached: start and end timestamp of the expanded window, the spans and their UID groups, see get_event_spans
+    """
+    start_ts, end_ts, spans, groups = cached
+    server_types = ['']
+    records = []
+    if groups is None:
+        grouped = [(0, spans)]
+    else:
+        grouped = enumerate(group_spans for fingerprint, group_spans in groups.values())
+    for group, group_spans in grouped:
+        for event_start_ts, event_end_ts, span_start_ts, span_end_ts, server_type in group_spans:
+            if server_type not in server_types:
+                server_types.append(server_type)
+            records.append(_COMPILED_SPAN.pack(event_start_ts, event_end_ts, span_start_ts, span_end_ts,
+                                               server_types.index(server_type), group))
+    metadata = json.dumps({"key": key, "start": start_ts, "end": end_ts, "server_types": server_types,
+                           "groups": None if groups is None else [[uid, fingerprint] for uid, (fingerprint, group_spans)
+                                                                  in groups.items()]}).encode()
     try:
-        calendar = icalendar.Calendar.from_ical(ical_data)
-        # todo: add timezone if calender has missing timezone info, for now, we raise an error
+        tmp_file = path + ".tmp"
+        Path(tmp_file).write_bytes(_COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION, len(metadata)) +
+                                   metadata + b"".join(records))
+        os.replace(tmp_file, path)
+    except OSError:
+        logger.warning("could not write compiled schedule " + path)
 
-        events = recurring_ical_events.of(a_calendar=calendar).between(start=start_date, stop=end_date)
-    except:
-        raise Exception("Error during ical conversion - please check your calendar-source")
 
-    # mark every start in timeslice
-    for event in events:
+def read_compiled_spans(path: str, key: tuple):
+    """
+    Load expanded event spans stored by write_compiled_spans with a single read
 
-        start = event["DTSTART"].dt
+    :param path: e.g. IMAGE_TOKEN.schedule
+    :param key: hash of ical_data and the grid parameters, see get_event_spans
+    :return: hash of the ical_data the file was written for and start and end timestamp of the expanded window, the
+    spans and their UID groups; None, if there is no file, or it was written for other grid parameters or in another
+    format version
+    """
+    try:
+        data = Path(path).read_bytes()
+        magic, version, metadata_length = _COMPILED_HEADER.unpack_from(data)
+        if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+            return None
+        offset = _COMPILED_HEADER.size + metadata_length
+        metadata = json.loads(data[_COMPILED_HEADER.size:offset])
+        # keys are compared as json, tuples of the key are lists in the metadata
+        if metadata["key"][1:] != json.loads(json.dumps(key[1:])):
+            return None
+        server_types = metadata["server_types"]
+        spans = []
+        groups = None
+        if metadata["groups"] is not None:
+            groups = {uid: (fingerprint, []) for uid, fingerprint in metadata["groups"]}
+            group_spans = [group[1] for group in groups.values()]
+        for event_start_ts, event_end_ts, span_start_ts, span_end_ts, server_type, group \
+                in _COMPILED_SPAN.iter_unpack(memoryview(data)[offset:]):
+            span = (event_start_ts, event_end_ts, span_start_ts, span_end_ts, server_types[server_type])
+            spans.append(span)
+            if groups is not None:
+                group_spans[group].append(span)
+        return metadata["key"][0], (metadata["start"], metadata["end"], spans, groups)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, IndexError, TypeError, struct.error):
+        logger.warning("ignoring unreadable compiled schedule " + path)
+        return None
 
-        if "DESCRIPTION" in event:
-            description = event["DESCRIPTION"]
-        else:
-            description = ""
 
-        server_type = get_server_type_from_description(description)
+def _cache_get(cache: OrderedDict, key):
+    with _cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        return None
 
-        if "SUMMARY" in event:
-            summary = event["SUMMARY"]
-        else:
-            summary = ""
-
-        if start_advanced_time > 0:
-            discard = datetime.timedelta(minutes=start_advanced_time)
-            start -= discard
-
-        # Round start down to nearest grid_interval
-        discard_start = datetime.timedelta(minutes=start.minute % timeslice_grid_interval,
-                                           seconds=start.second,
-                                           microseconds=start.microsecond)
-        start -= discard_start
-
-        end = event["DTEND"].dt
-        if end_lag_time > 0:
-            discard = datetime.timedelta(minutes=end_lag_time)
-            end += discard
-
-        # Round end up to nearest grid_interval
-        end = ceil(end, timeslice_grid_interval)
-        # find index for start
-        start_ts = int(start.timestamp())
-        end_ts = int(end.timestamp())
-        if start_ts not in grid_datetime and end_ts not in grid_datetime:
+
+def _cache_put(cache: OrderedDict, key, value):
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def clear_caches():
+    """
+    Forget all parsed calendars and expanded events, e.g. to measure a cold start
+    """
+    with _cache_lock:
+        _calendar_cache.clear()
+        _event_span_cache.clear()
+        _rolling_schedules.clear()
+
+
+def _get_event_end_date(properties: dict):
+    """
+    :param properties: unfolded property lines of a VEVENT, keyed by name
+    :return: date of DTEND (or DTSTART without DTEND) as YYYYMMDD int, None if unknown
+    """
+    line = properties.get(b"DTEND", properties.get(b"DTSTART"))
+    if line is None:
+        return None
+    value = line.rsplit(b":", 1)[-1].strip()
+    if len(value) < 8 or not value[:8].isdigit():
+        return None
+    return int(value[:8])
+
+
+def _get_event_properties(event: list) -> dict:
+    """
+    :param event: raw lines of a VEVENT
+    :return: unfolded property lines, keyed by name; the first line of each name wins
+    """
+    properties = {}
+    unfolded = b""
+    for event_line in event:
+        if event_line[:1] in (b" ", b"\t"):
+            unfolded += event_line[1:].rstrip(b"\r\n")
             continue
+        if unfolded:
+            name = unfolded.split(b":", 1)[0].split(b";", 1)[0].upper()
+            properties.setdefault(name, unfolded)
+        unfolded = event_line.rstrip(b"\r\n")
+    return properties
+
+
+def filter_ical_data(ical_data: bytes, not_before: datetime.date) -> bytes:
+    """
+    Drop one-off events which ended before not_before from the raw ical data, without parsing it
 
-        if start_ts in grid_datetime:
-            idx_start = grid_datetime.index(start_ts)
+    The data is read line by line; everything outside of VEVENTs (e.g. VTIMEZONEs) is kept, as well as recurring
+    events, overridden occurrences and every event whose dates could not be read.
+
+    :param ical_data: binary reprasentation of ical data
+    :param not_before: events ending before this date are dropped
+    :return: filtered ical data
+    """
+    not_before = int(not_before.strftime("%Y%m%d"))
+    filtered = []
+    event = None
+    dropped = 0
+    for line in io.BytesIO(ical_data):
+        if event is None:
+            if line.rstrip(b"\r\n").upper() == b"BEGIN:VEVENT":
+                event = [line]
+            else:
+                filtered.append(line)
+            continue
+
+        event.append(line)
+        if line.rstrip(b"\r\n").upper() != b"END:VEVENT":
+            continue
+
+        # unfold the property lines to find DTSTART/DTEND and the properties of recurring events
+        properties = _get_event_properties(event)
+        end_date = _get_event_end_date(properties)
+        if any(name in properties for name in PREFILTER_KEEP_PROPERTIES) or end_date is None or end_date >= not_before:
+            filtered += event
         else:
-            idx_start = 0
+            dropped += 1
+        event = None
+
+    if event is not None:
+        # unterminated event, let the parser decide
+        filtered += event
+    logger.debug("Dropped " + str(dropped) + " events before parsing")
+    return b"".join(filtered)
+
+
+def _get_property_value(line: bytes) -> str:
+    """
+    :param line: unfolded property line, e.g. b"UID:abc"
+    :return: its value with ical text escapes resolved
+    """
+    value = line.split(b":", 1)[-1].decode("utf-8", "replace")
+    return re.sub(r"\\([\\;,nN])", lambda match: "\n" if match.group(1) in "nN" else match.group(1), value)
+
+
+def get_event_index(ical_data: bytes):
+    """
+    Split the raw ical data into its events grouped by UID, without parsing it
+
+    A recurring series and its overridden occurrences share their UID and have to be expanded together, so a group
+    holds all events of one UID. Every event is indexed by RECURRENCE-ID with its SEQUENCE, LAST-MODIFIED and a hash
+    of its lines; the fingerprint of a group changes, whenever one of its events is added, removed or modified, or
+    anything outside of the events (e.g. a VTIMEZONE) changes.
+
+    :param ical_data: binary reprasentation of ical data
+    :return: lines outside of events without END:VCALENDAR and dict UID -> (fingerprint, lines of its events) in
+    order of appearance; None, if the data could not be split
+    """
+    preamble = []
+    groups = {}
+    ''' UID -> [index entries, lines] '''
+    event = None
+    for line in io.BytesIO(ical_data):
+        stripped = line.rstrip(b"\r\n").upper()
+        if event is None:
+            if stripped == b"BEGIN:VEVENT":
+                event = [line]
+            elif stripped != b"END:VCALENDAR":
+                preamble.append(line)
+            continue
+
+        event.append(line)
+        if stripped != b"END:VEVENT":
+            continue
+        properties = _get_event_properties(event)
+        uid = _get_property_value(properties[b"UID"]) if b"UID" in properties else ""
+        if uid not in groups:
+            groups[uid] = [[], []]
+        groups[uid][0].append([properties.get(b"RECURRENCE-ID", b"").decode("utf-8", "replace"),
+                               _get_property_value(properties.get(b"SEQUENCE", b"0")),
+                               _get_property_value(properties.get(b"LAST-MODIFIED", b"")),
+                               hashlib.sha256(b"".join(event)).hexdigest()])
+        groups[uid][1] += event
+        event = None
+
+    if event is not None:
+        # unterminated event
+        return None
+    preamble = b"".join(preamble)
+    preamble_hash = hashlib.sha256(preamble).hexdigest()
+    return preamble, {uid: (hashlib.sha256(json.dumps([preamble_hash, uid, sorted(entries)]).encode()).hexdigest(),
+                            b"".join(lines))
+                      for uid, (entries, lines) in groups.items()}
+
 
-        # Ende bestimmen
-        if end_ts in grid_datetime:
-            idx_end = grid_datetime.index(end_ts)
+def get_calendar(ical_data: bytes, ical_hash: str = None, not_before: datetime.date = None) -> "icalendar.Calendar":
+    """
+    Parse the given ical data; the result is cached by content hash, so unchanged data is only parsed once
+
+    :param ical_data: binary reprasentation of ical data
+    :param ical_hash: hash of ical_data, if already known
+    :param not_before: if set, events which ended before this date are dropped before parsing, see filter_ical_data
+    :return: parsed calendar
+    """
+    if ical_hash is None:
+        ical_hash = get_ical_hash(ical_data)
+    calendar = _cache_get(_calendar_cache, (ical_hash, not_before))
+    if calendar is None:
+        logger.debug("Parsing calendar-source " + ical_hash)
+        with hcloud_metrics.CALENDAR_PARSE_SECONDS.time(), hcloud_tracing.span("hcloud_calendar.parse"):
+            if not_before is not None:
+                ical_data = filter_ical_data(ical_data, not_before)
+            # imported on first use, one-shot invocations (cli.py tick) often do not parse at all
+            import icalendar
+            calendar = icalendar.Calendar.from_ical(ical_data)
+        _cache_put(_calendar_cache, (ical_hash, not_before), calendar)
+    return calendar
+
+
+def get_start_advanced_time_for(start_advanced_time, server_type: str = '') -> int:
+    """
+    :param start_advanced_time: minutes or dict server_type -> minutes, key '' is used for unknown server_types
+    :param server_type: server_type of the event
+    :return: minutes the event is started earlier
+    """
+    if isinstance(start_advanced_time, dict):
+        return start_advanced_time.get(server_type, start_advanced_time.get('', 0))
+    return start_advanced_time
+
+
+def _get_event_span(event, timeslice_grid_interval: int, start_advanced_time, end_lag_time: int) -> tuple:
+    """
+    Map one expanded event to the timeslice grid
+
+    :return: event start timestamp, event end timestamp, start timestamp and end timestamp mapped to the grid
+    (including start_advanced_time and end_lag_time), server_type
+    """
+    start = event["DTSTART"].dt
+    end = event["DTEND"].dt
+    event_start_ts = int(start.timestamp())
+    event_end_ts = int(end.timestamp())
+
+    if "DESCRIPTION" in event:
+        description = event["DESCRIPTION"]
+    else:
+        description = ""
+
+    server_type = get_server_type_from_description(description)
+    start_advanced_time = get_start_advanced_time_for(start_advanced_time, server_type)
+
+    if start_advanced_time > 0:
+        discard = datetime.timedelta(minutes=start_advanced_time)
+        start -= discard
+
+    # Round start down to nearest grid_interval
+    discard_start = datetime.timedelta(minutes=start.minute % timeslice_grid_interval,
+                                       seconds=start.second,
+                                       microseconds=start.microsecond)
+    start -= discard_start
+
+    if end_lag_time > 0:
+        discard = datetime.timedelta(minutes=end_lag_time)
+        end += discard
+
+    # Round end up to nearest grid_interval
+    end = ceil(end, timeslice_grid_interval)
+
+    return event_start_ts, event_end_ts, int(start.timestamp()), int(end.timestamp()), server_type
+
+
+def _get_expansion_margins(timeslice_grid_interval: int, start_advanced_time, end_lag_time: int) -> tuple:
+    """
+    Events are expanded beyond the window of their spans: an event which ended before the window can still be
+    within its END_LAG_TIME, one which starts after the window can be started in advance
+
+    :return: timedeltas to expand before and after the window
+    """
+    if isinstance(start_advanced_time, dict):
+        start_advanced_time = max(list(start_advanced_time.values()) + [0])
+    return (datetime.timedelta(minutes=max(end_lag_time, 0) + timeslice_grid_interval),
+            datetime.timedelta(minutes=max(start_advanced_time, 0) + timeslice_grid_interval))
+
+
+def _get_spans_by_uid(events, timeslice_grid_interval: int, start_advanced_time, end_lag_time: int) -> dict:
+    """
+    Map expanded events to the timeslice grid
+
+    :return: dict UID -> list of tuples, see _get_event_span
+    """
+    spans_by_uid = {}
+    for event in events:
+        try:
+            span = _get_event_span(event, timeslice_grid_interval, start_advanced_time, end_lag_time)
+        except Exception:
+            logger.warning("Skipping event without usable DTSTART/DTEND: " + str(event.get("SUMMARY", "")))
+            continue
+        spans_by_uid.setdefault(str(event.get("UID", "")), []).append(span)
+    return spans_by_uid
+
+
+def _find_base_expansion(key: tuple, start_ts: int, end_ts: int, groups: dict, candidates: list):
+    """
+    Find the expansion of a previous version of the calendar-source to update incrementally
+
+    :param key: key of the wanted expansion, see get_event_spans
+    :param groups: UID groups of the current version, see get_event_index
+    :param candidates: further expansions with the same grid parameters, e.g. from the compiled schedule file
+    :return: the expansion with the same grid parameters, covering start_ts till end_ts, which shares the most UID
+    groups with the current version; None if there is none
+    """
+    with _cache_lock:
+        candidates = candidates + [cached for cached_key, cached in _event_span_cache.items()
+                                   if cached_key[1:] == key[1:]]
+    base = None
+    shared = 0
+    for cached in candidates:
+        if cached[3] is None or start_ts < cached[0] or end_ts > cached[1]:
+            continue
+        count = sum(1 for uid, (fingerprint, lines) in groups.items()
+                    if cached[3].get(uid, (None,))[0] == fingerprint)
+        if count > shared:
+            base = cached
+            shared = count
+    return base
+
+
+def _expand_incrementally(base: tuple, index: tuple, start_date: datetime.datetime, timeslice_grid_interval: int,
+                          start_advanced_time, end_lag_time: int) -> tuple:
+    """
+    Update the expansion of a previous version of the calendar-source: only the UID groups, which were added or
+    modified, are parsed and expanded, the spans of removed groups are dropped and all others are reused
+
+    :param base: expansion of the previous version, see _find_base_expansion
+    :param index: lines outside of events and UID groups of the current version, see get_event_index
+    :return: start and end timestamp of the expanded window (the window of base), the spans and their UID groups
+    :raise: Error if the changed events could not be parsed or expanded
+    """
+    preamble, groups = index
+    base_groups = base[3]
+    changed = [uid for uid, (fingerprint, lines) in groups.items()
+               if base_groups.get(uid, (None,))[0] != fingerprint]
+    added = sum(1 for uid in changed if uid not in base_groups)
+    removed = sum(1 for uid in base_groups if uid not in groups)
+    logger.info("Calendar-source changed: " + str(added) + " added, " + str(len(changed) - added) + " modified, " +
+                str(removed) + " removed of " + str(len(groups)) + " UIDs")
+
+    spans_by_uid = {}
+    if changed:
+        # the changed groups alone, with the VTIMEZONEs and properties of the calendar
+        ical_data = preamble + b"".join(groups[uid][1] for uid in changed) + b"END:VCALENDAR\r\n"
+        with hcloud_metrics.CALENDAR_PARSE_SECONDS.time(), hcloud_tracing.span("hcloud_calendar.parse"):
+            import icalendar
+            calendar = icalendar.Calendar.from_ical(ical_data)
+        import recurring_ical_events
+        margin_before, margin_after = _get_expansion_margins(timeslice_grid_interval, start_advanced_time,
+                                                             end_lag_time)
+        with hcloud_metrics.CALENDAR_EXPAND_SECONDS.time(mode="incremental"), \
+                hcloud_tracing.span("hcloud_calendar.expand"):
+            events = recurring_ical_events.of(a_calendar=calendar).between(
+                start=datetime.datetime.fromtimestamp(base[0], tz=start_date.tzinfo) - margin_before,
+                stop=datetime.datetime.fromtimestamp(base[1], tz=start_date.tzinfo) + margin_after)
+        spans_by_uid = _get_spans_by_uid(events, timeslice_grid_interval, start_advanced_time, end_lag_time)
+        if any(uid not in groups for uid in spans_by_uid):
+            raise Exception("Expanded events do not match the UIDs of the calendar-source")
+
+    changed = set(changed)
+    expanded = {uid: (fingerprint, spans_by_uid.get(uid, []) if uid in changed else base_groups[uid][1])
+                for uid, (fingerprint, lines) in groups.items()}
+    return base[0], base[1], [span for fingerprint, spans in expanded.values() for span in spans], expanded
+
+
+@hcloud_tracing.traced
+def get_event_spans(ical_data: bytes, start_date: datetime.datetime, end_date: datetime.datetime,
+                    timezone_name: str = "Europe/Berlin", timeslice_grid_interval: int = 15,
+                    start_advanced_time: int = 15, end_lag_time: int = 30, compiled_file: str = None,
+                    by_event_times: bool = False) -> list:
+    """
+    Get all events between start_date and end_date, mapped to the timeslice grid
+
+    start_advanced_time can be a dict server_type -> minutes, see get_start_advanced_time_for.
+    Parsing and recurrence expansion are cached by a hash of ical_data plus the grid parameters.
+    Events are expanded for EVENT_EXPANSION_WINDOW ahead, so between changes of the calendar-source
+    a tick only moves its window forward over the already expanded events.
+    When the calendar-source changes, only the events of added or modified UIDs are expanded again, the expansion
+    of the previous version is reused for all others (see get_event_index).
+    With compiled_file, the expansion is also stored on disk (see write_compiled_spans) and reused after a restart.
+
+    :param compiled_file: path of the compiled schedule file, None keeps the expansion in memory only
+    :param by_event_times: if True, spans are selected by the times of their events instead of their own times, as
+    before the RollingSchedule: an event which ended before start_date is left out, even while it is within its
+    end_lag_time. The compatibility layer (get_schedule_for_now) keeps its former answers this way.
+    :return: list of tuples, see _get_event_span
+    :raise: Error if ical_data could not be parsed or expanded
+    """
+    ical_hash = get_ical_hash(ical_data)
+    if isinstance(start_advanced_time, dict):
+        start_advanced_time_key = tuple(sorted(start_advanced_time.items()))
+    else:
+        start_advanced_time_key = start_advanced_time
+    key = (ical_hash, timeslice_grid_interval, start_advanced_time_key, end_lag_time, timezone_name)
+    start_ts = int(start_date.timestamp())
+    end_ts = int(end_date.timestamp())
+
+    cached = _cache_get(_event_span_cache, key)
+    candidates = []
+    if (cached is None or start_ts < cached[0] or end_ts > cached[1]) and compiled_file is not None:
+        compiled = read_compiled_spans(compiled_file, key)
+        if compiled is not None and compiled[0] == ical_hash and compiled[1][0] <= start_ts and \
+                end_ts <= compiled[1][1]:
+            hcloud_metrics.COMPILED_SCHEDULE_REQUESTS.inc(result="hit")
+            cached = compiled[1]
+            _cache_put(_event_span_cache, key, cached)
         else:
-            idx_end = len(grid_timeslice)
+            hcloud_metrics.COMPILED_SCHEDULE_REQUESTS.inc(result="miss")
+            if compiled is not None:
+                candidates.append(compiled[1])
+
+    if cached is None or start_ts < cached[0] or end_ts > cached[1]:
+        index = get_event_index(ical_data)
+        cached = None
+        base = None if index is None else _find_base_expansion(key, start_ts, end_ts, index[1], candidates)
+        if base is not None:
+            try:
+                cached = _expand_incrementally(base, index, start_date, timeslice_grid_interval,
+                                               start_advanced_time, end_lag_time)
+            except Exception:
+                logger.exception("Incremental expansion failed, expanding the whole calendar-source")
+
+        if cached is None:
+            expansion_end_date = start_date + EVENT_EXPANSION_WINDOW
+            if expansion_end_date < end_date + datetime.timedelta(days=1):
+                # longer windows are expanded one day further, so the next ticks can reuse the expansion as well
+                expansion_end_date = end_date + datetime.timedelta(days=1)
+            try:
+                # past one-off events can not be within the window, they are not parsed at all
+                calendar = get_calendar(ical_data, ical_hash=ical_hash,
+                                        not_before=(start_date - PREFILTER_MARGIN).date())
+                # todo: add timezone if calender has missing timezone info, for now, we raise an error
+
+                import recurring_ical_events
+                margin_before, margin_after = _get_expansion_margins(timeslice_grid_interval, start_advanced_time,
+                                                                     end_lag_time)
+                with hcloud_metrics.CALENDAR_EXPAND_SECONDS.time(mode="full"), \
+                        hcloud_tracing.span("hcloud_calendar.expand"):
+                    events = recurring_ical_events.of(a_calendar=calendar).between(
+                        start=start_date - margin_before, stop=expansion_end_date + margin_after)
+            except:
+                raise Exception("Error during ical conversion - please check your calendar-source")
+
+            spans_by_uid = _get_spans_by_uid(events, timeslice_grid_interval, start_advanced_time, end_lag_time)
+            groups = None
+            if index is not None and all(uid in index[1] for uid in spans_by_uid):
+                # the spans are kept by UID group, so the next change can be expanded incrementally
+                groups = {uid: (fingerprint, spans_by_uid.get(uid, []))
+                          for uid, (fingerprint, lines) in index[1].items()}
+                spans = [span for fingerprint, group_spans in groups.values() for span in group_spans]
+            else:
+                spans = [span for group_spans in spans_by_uid.values() for span in group_spans]
+            cached = (start_ts, int(expansion_end_date.timestamp()), spans, groups)
+
+        _cache_put(_event_span_cache, key, cached)
+        if compiled_file is not None:
+            write_compiled_spans(compiled_file, key, cached)
+
+    if by_event_times:
+        # only events, which are overlapping the requested window
+        return [span for span in cached[2]
+                if span[0] < end_ts and (span[1] > start_ts or span[0] >= start_ts)]
+    # only spans (including start_advanced_time and end_lag_time), which are overlapping the requested window
+    return [span for span in cached[2] if span[2] < end_ts and span[3] >= start_ts]
+
+
+class Schedule:
+    """
+    Compact run/not run schedule on a timeslice grid
+
+    A slot is addressed by its start timestamp; its index is computed arithmetically from the grid start,
+    so lookups cost O(1) instead of scanning a list of timestamps.
+    """
+
+    def __init__(self, start_ts: int, end_ts: int, timeslice_grid_interval: int = 15):
+        """
+        :param start_ts: timestamp of the first slot
+        :param end_ts: timestamp after the last slot (exclusive)
+        :param timeslice_grid_interval: size of one slot in minutes
+        """
+        self.interval = int(datetime.timedelta(minutes=timeslice_grid_interval).total_seconds())
+        self.datetime = range(start_ts, end_ts, self.interval)
+        ''' slot start timestamps, a range behaves like the former grid_datetime list with O(1) in/index '''
+        self.timeslice = bytearray(len(self.datetime))
+        ''' hold the run/not run information, 1 = run '''
+        self.server_type = array.array("H", bytes(2 * len(self.datetime)))
+        ''' hold the server_type information as index into server_types '''
+        self.server_types = ['']
+        ''' all server_types used in this schedule, index 0 is the default '' '''
+
+    def __len__(self) -> int:
+        return len(self.datetime)
+
+    def index_of(self, ts: int):
+        """
+        :param ts: timestamp
+        :return: index of the slot starting exactly at ts or None if ts is no slot start
+        """
+        offset = ts - self.datetime.start
+        if offset < 0 or ts >= self.datetime.stop or offset % self.interval:
+            return None
+        return offset // self.interval
+
+    def _server_type_index(self, server_type: str) -> int:
+        if server_type not in self.server_types:
+            self.server_types.append(server_type)
+        return self.server_types.index(server_type)
+
+    def mark(self, start_ts: int, end_ts: int, server_type: str = ''):
+        """
+        Mark an event from start_ts till end_ts (both including) as running
+
+        Events which neither start nor end on a slot of this schedule are ignored.
+        """
+        idx_start = self.index_of(start_ts)
+        idx_end = self.index_of(end_ts)
+        if idx_start is None and idx_end is None:
+            return
+
+        if idx_start is None:
+            idx_start = 0
 
         # Fix for end of day, cause 00:00 is new day
-        if idx_end >= len(grid_timeslice):
-            idx_end = len(grid_timeslice) - 1
-
-        # Mark event from start till end in timeslice grid
-        idx = None
-        for idx in range(idx_start, idx_end + 1, 1):
-            grid_timeslice[idx] = True
-            grid_server_type[idx] = server_type
-
-    # TODO: write code to fix the grid in a way, if there is only one not-run-slot between two running-slots
-    #   eg. 11011 -> 11111
-    #   unshure if this is a good idea. adds too much complexity. if there is one fixed, maybe another is open and so on
-    logger.debug("grid_datetime")
-    logger.debug(grid_datetime)
-    logger.debug("grid_timeslice")
-    logger.debug(grid_timeslice)
-    logger.debug("grid_server_type")
-    logger.debug(grid_server_type)
+        if idx_end is None or idx_end >= len(self):
+            idx_end = len(self) - 1
+
+        length = idx_end + 1 - idx_start
+        if length <= 0:
+            return
+        self.timeslice[idx_start:idx_end + 1] = b"\x01" * length
+        self.server_type[idx_start:idx_end + 1] = array.array("H", [self._server_type_index(server_type)]) * length
+
+    def mark_covered(self, start_ts: int, end_ts: int, server_type: str = '', idx_from: int = 0, idx_to: int = None):
+        """
+        Mark every slot, which starts from start_ts till end_ts (both including), as running
+
+        Unlike mark, events which start before and end after this schedule or are not aligned to its slots are marked
+        as well.
+
+        :param idx_from: only slots from this index are marked
+        :param idx_to: only slots before this index are marked, defaults to all
+        """
+        if idx_to is None:
+            idx_to = len(self)
+        idx_start = max(-(-(start_ts - self.datetime.start) // self.interval), idx_from)
+        idx_end = min((end_ts - self.datetime.start) // self.interval + 1, idx_to)
+        length = idx_end - idx_start
+        if length <= 0:
+            return
+        self.timeslice[idx_start:idx_end] = b"\x01" * length
+        self.server_type[idx_start:idx_end] = array.array("H", [self._server_type_index(server_type)]) * length
+
+    def is_running_at(self, ts: int) -> tuple:
+        """
+        :param ts: timestamp of a slot start
+        :return: True if server should run in this slot, otherwise False; in addition: server_type
+        """
+        idx = self.index_of(ts)
+        if idx is None:
+            return False, ''
+        return bool(self.timeslice[idx]), self.server_types[self.server_type[idx]]
+
+    def next_transition(self, ts: int):
+        """
+        Find the next change of run/not run state or server_type after ts
+
+        :param ts: timestamp
+        :return: timestamp of the first slot after ts which differs from the slot of ts,
+        or None if nothing changes until the end of this schedule
+        """
+        if ts < self.datetime.start:
+            return self.datetime.start
+        idx = (ts - self.datetime.start) // self.interval
+        if idx >= len(self) - 1:
+            return None
+
+        running = self.timeslice[idx]
+        idx_change = self.timeslice.find(b"\x00" if running else b"\x01", idx + 1)
+        if idx_change < 0:
+            idx_change = len(self)
+        if running:
+            # a change of server_type is a transition too
+            server_type = self.server_type[idx]
+            for idx_server_type in range(idx + 1, idx_change):
+                if self.server_type[idx_server_type] != server_type:
+                    idx_change = idx_server_type
+                    break
+        if idx_change >= len(self):
+            return None
+        return self.datetime.start + idx_change * self.interval
+
+    def run_periods(self) -> list:
+        """
+        :return: list of (first index, index after the last) of every run period
+        """
+        periods = []
+        idx_start = self.timeslice.find(b"\x01")
+        while idx_start >= 0:
+            idx_end = self.timeslice.find(b"\x00", idx_start + 1)
+            if idx_end < 0:
+                idx_end = len(self)
+            periods.append((idx_start, idx_end))
+            idx_start = self.timeslice.find(b"\x01", idx_end + 1)
+        return periods
+
+    def smooth(self, min_gap_slots: int = 0, min_run_slots: int = 0, unify_server_type: bool = False):
+        """
+        Avoid short stops and starts of the server; only adds running slots, never removes one
+
+        Run periods shorter than min_run_slots are extended, gaps shorter than min_gap_slots between two run periods
+        are filled (e.g. 11011 -> 11111 for min_gap_slots 2), both with the server_type of the slot before.
+        Periods and gaps at the start of the schedule are kept as they are, their real length is unknown.
+
+        :param min_gap_slots: gaps of less slots are filled
+        :param min_run_slots: every run period runs at least this many slots
+        :param unify_server_type: if True, every run period gets one server_type: its first one which is not ''
+        """
+        if min_run_slots > 1:
+            for idx_start, idx_end in self.run_periods():
+                if idx_start > 0 and idx_end - idx_start < min_run_slots:
+                    self._fill(idx_end, min(idx_start + min_run_slots, len(self)))
+
+        if min_gap_slots > 1:
+            periods = self.run_periods()
+            for (idx_start, idx_end), (idx_next_start, idx_next_end) in zip(periods, periods[1:]):
+                if idx_next_start - idx_end < min_gap_slots:
+                    self._fill(idx_end, idx_next_start)
+
+        if unify_server_type:
+            for idx_start, idx_end in self.run_periods():
+                server_type = next((idx for idx in self.server_type[idx_start:idx_end] if idx != 0), 0)
+                self.server_type[idx_start:idx_end] = array.array("H", [server_type]) * (idx_end - idx_start)
+
+    def _fill(self, idx_start: int, idx_end: int):
+        """Mark the slots from idx_start till idx_end (exclusive) as running, with the server_type of the slot before"""
+        length = idx_end - idx_start
+        if length <= 0:
+            return
+        self.timeslice[idx_start:idx_end] = b"\x01" * length
+        self.server_type[idx_start:idx_end] = array.array("H", [self.server_type[idx_start - 1]]) * length
+
+    def smoothed(self, start_ts: int, min_gap_slots: int = 0, min_run_slots: int = 0,
+                 unify_server_type: bool = False) -> "Schedule":
+        """
+        :param start_ts: first slot of the result, slots before are only used to smooth the schedule
+        :return: smoothed copy of this schedule from start_ts, see smooth
+        """
+        schedule = Schedule.__new__(Schedule)
+        schedule.interval = self.interval
+        schedule.datetime = self.datetime
+        schedule.timeslice = bytearray(self.timeslice)
+        schedule.server_type = array.array("H", self.server_type)
+        schedule.server_types = list(self.server_types)
+        schedule.smooth(min_gap_slots=min_gap_slots, min_run_slots=min_run_slots,
+                        unify_server_type=unify_server_type)
+
+        drop = max((start_ts - self.datetime.start) // self.interval, 0)
+        del schedule.timeslice[:drop]
+        del schedule.server_type[:drop]
+        schedule.datetime = range(self.datetime.start + drop * self.interval, self.datetime.stop, self.interval)
+        return schedule
+
+    def next_run_start(self, ts: int):
+        """
+        Find the start of the next run period after the slot of ts
+
+        :param ts: timestamp
+        :return: timestamp of the first running slot after the slot of ts which follows a not running slot,
+        or None if there is none until the end of this schedule
+        """
+        idx = max((ts - self.datetime.start) // self.interval, 0)
+        if idx >= len(self):
+            return None
+        idx_stop = idx if not self.timeslice[idx] else self.timeslice.find(b"\x00", idx + 1)
+        if idx_stop < 0:
+            return None
+        idx_start = self.timeslice.find(b"\x01", idx_stop + 1)
+        if idx_start < 0:
+            return None
+        return self.datetime.start + idx_start * self.interval
+
+    def get_grids(self) -> tuple:
+        """
+        :return: grid_datetime, grid_timeslice and grid_server_type as used by check_should_run_now
+        """
+        grid_timeslice = [bool(slot) for slot in self.timeslice]
+        grid_server_type = [self.server_types[idx] for idx in self.server_type]
+        return self.datetime, grid_timeslice, grid_server_type
+
+
+class RollingSchedule(Schedule):
+    """
+    Schedule over a horizon of several days, which moves forward with time
+
+    Each update drops expired slots and only marks the newly entered ones. It is rebuilt, when the calendar-source
+    changes. Slots are marked with Schedule.mark_covered.
+    """
+
+    def __init__(self, start_ts: int, end_ts: int, timeslice_grid_interval: int = 15, ical_hash: str = None,
+                 parameters: tuple = None):
+        super().__init__(start_ts, end_ts, timeslice_grid_interval=timeslice_grid_interval)
+        self.ical_hash = ical_hash
+        ''' hash of the calendar-source this schedule was built from '''
+        self.parameters = parameters
+        ''' grid parameters (timezone, lead and lag times, horizon, lookback) this schedule was built with '''
+        self.lock = threading.Lock()
+
+    def reset(self, start_ts: int, end_ts: int, ical_hash: str, parameters: tuple = None):
+        """
+        Clear all slots and move the schedule to start_ts till end_ts, e.g. for a changed calendar-source or changed
+        grid parameters
+        """
+        Schedule.__init__(self, start_ts, end_ts, timeslice_grid_interval=self.interval // 60)
+        self.ical_hash = ical_hash
+        self.parameters = parameters
+
+    def build(self, spans: list):
+        """
+        Mark all slots from the given event spans (see get_event_spans)
+        """
+        for event_start_ts, event_end_ts, start_ts, end_ts, server_type in spans:
+            self.mark_covered(start_ts, end_ts, server_type)
+
+    def advance(self, start_ts: int, end_ts: int, spans: list):
+        """
+        Move the schedule to start at start_ts and end at end_ts
+
+        :param start_ts: new first slot, must be a slot of this schedule
+        :param end_ts: new end (exclusive)
+        :param spans: event spans covering at least the newly entered slots
+        """
+        drop = (start_ts - self.datetime.start) // self.interval
+        old_length = len(self) - drop
+        del self.timeslice[:drop]
+        del self.server_type[:drop]
+
+        self.datetime = range(start_ts, end_ts, self.interval)
+        append = len(self) - old_length
+        if append <= 0:
+            return
+        self.timeslice.extend(bytes(append))
+        self.server_type.extend(array.array("H", bytes(2 * append)))
+        # every span starting before the old end was marked already (see get_event_spans), so only the newly entered
+        # slots are marked, by all spans covering them in the order of a full build
+        ts_from = self.datetime[old_length]
+        for event_start_ts, event_end_ts, span_start_ts, span_end_ts, server_type in spans:
+            if span_end_ts >= ts_from:
+                self.mark_covered(span_start_ts, span_end_ts, server_type, idx_from=old_length)
+
+
+def get_grid_start(timezone_name: str = "Europe/Berlin", timeslice_grid_interval: int = 15) -> datetime.datetime:
+    """
+    :return: now, round down to nearest timeslice_grid_interval
+    """
+    timezone = tz.gettz(timezone_name)
+    start_date = datetime.datetime.now(timezone).replace(second=0, microsecond=0)
+    discard_start = datetime.timedelta(minutes=start_date.minute % timeslice_grid_interval)
+    return start_date - discard_start
+
+
+def get_smoothing_slots(timeslice_grid_interval: int, min_gap: int = 0, min_run: int = 0) -> tuple:
+    """
+    :param timeslice_grid_interval: size in minutes of the time-chunks of the grid
+    :param min_gap: minutes, shorter gaps between two events are filled
+    :param min_run: minutes every run period lasts at least
+    :return: min_gap and min_run in slots; in addition: slots before now needed to smooth the schedule
+    :rtype: tuple
+    """
+    min_gap_slots = -(-min_gap // timeslice_grid_interval)
+    min_run_slots = -(-min_run // timeslice_grid_interval)
+    return min_gap_slots, min_run_slots, max(min_gap_slots, min_run_slots)
+
+
+def get_schedule_for_now(ical_data: bytes = None, timezone_name: str = "Europe/Berlin",
+                         timeslice_grid_interval: int = 15, start_advanced_time: int = 15,
+                         end_lag_time: int = 30, min_gap: int = 0, min_run: int = 0,
+                         unify_server_type: bool = False, compiled_file: str = None) -> Schedule:
+    """
+    Build the Schedule for the next 24 hours, starting now
+
+    :param ical_data: binary reprasentation of ical data
+    :param timezone_name: name of the timezone the grid is aligned to
+    :param timeslice_grid_interval: size in minutes of the time-chunks of the grid
+    :param start_advanced_time: minutes every event is started earlier,
+    or dict server_type -> minutes (see get_start_advanced_time_for)
+    :param end_lag_time: minutes every event is stopped later
+    :param min_gap: minutes, shorter gaps between two events are filled (see Schedule.smooth)
+    :param min_run: minutes every run period lasts at least (see Schedule.smooth)
+    :param unify_server_type: if True, every run period gets one server_type (see Schedule.smooth)
+    :param compiled_file: path of the compiled schedule file (see get_event_spans)
+    :return: Schedule
+    """
+    grid_start_date = get_grid_start(timezone_name=timezone_name, timeslice_grid_interval=timeslice_grid_interval)
+
+    end_date = grid_start_date + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
+    ''' end_date is: (start_date + 23 Hour + 59 Minutes + 59 Seconds)'''
+
+    # smoothing needs to know, whether the server was running just before now
+    min_gap_slots, min_run_slots, lookback_slots = get_smoothing_slots(timeslice_grid_interval, min_gap, min_run)
+    start_date = grid_start_date - datetime.timedelta(minutes=lookback_slots * timeslice_grid_interval)
+
+    schedule = Schedule(int(start_date.timestamp()), int(end_date.timestamp()),
+                        timeslice_grid_interval=timeslice_grid_interval)
+
+    spans = get_event_spans(ical_data, start_date=start_date, end_date=end_date, timezone_name=timezone_name,
+                            timeslice_grid_interval=timeslice_grid_interval,
+                            start_advanced_time=start_advanced_time, end_lag_time=end_lag_time,
+                            compiled_file=compiled_file, by_event_times=True)
+
+    # mark every event in timeslice
+    with hcloud_metrics.SCHEDULE_BUILD_SECONDS.time(kind="full"):
+        for event_start_ts, event_end_ts, start_ts, end_ts, server_type in spans:
+            schedule.mark(start_ts, end_ts, server_type)
+
+    if lookback_slots or unify_server_type:
+        schedule = schedule.smoothed(int(grid_start_date.timestamp()), min_gap_slots=min_gap_slots,
+                                     min_run_slots=min_run_slots, unify_server_type=unify_server_type)
+    return schedule
+
+
+@hcloud_tracing.traced
+def get_rolling_schedule(ical_data: bytes = None, name: str = "", timezone_name: str = "Europe/Berlin",
+                         timeslice_grid_interval: int = 15, start_advanced_time: int = 15, end_lag_time: int = 30,
+                         horizon_days: int = 1, min_gap: int = 0, min_run: int = 0,
+                         unify_server_type: bool = False, compiled_file: str = None) -> Schedule:
+    """
+    Get the RollingSchedule from now until horizon_days ahead
+
+    The schedule is kept in memory per name and timeslice_grid_interval; between changes of ical_data or of the other
+    grid parameters (e.g. a start_advanced_time learned from measured durations) an update only moves it forward,
+    otherwise it is rebuilt in place.
+
+    :param ical_data: binary reprasentation of ical data
+    :param name: identifies the schedule, e.g. IMAGE_TOKEN
+    :param timezone_name: name of the timezone the grid is aligned to
+    :param timeslice_grid_interval: size in minutes of the time-chunks of the grid
+    :param start_advanced_time: minutes every event is started earlier,
+    or dict server_type -> minutes (see get_start_advanced_time_for)
+    :param end_lag_time: minutes every event is stopped later
+    :param horizon_days: days the schedule looks ahead
+    :param min_gap: minutes, shorter gaps between two events are filled (see Schedule.smooth)
+    :param min_run: minutes every run period lasts at least (see Schedule.smooth)
+    :param unify_server_type: if True, every run period gets one server_type (see Schedule.smooth)
+    :param compiled_file: path of the compiled schedule file (see get_event_spans)
+    :return: RollingSchedule; if smoothed, a smoothed copy of it
+    """
+    ical_hash = get_ical_hash(ical_data)
+    if isinstance(start_advanced_time, dict):
+        start_advanced_time_key = tuple(sorted(start_advanced_time.items()))
+    else:
+        start_advanced_time_key = start_advanced_time
+    # smoothing needs to know, whether the server was running just before now
+    min_gap_slots, min_run_slots, lookback_slots = get_smoothing_slots(timeslice_grid_interval, min_gap, min_run)
+    parameters = (timezone_name, start_advanced_time_key, end_lag_time, horizon_days, lookback_slots)
+
+    grid_start_date = get_grid_start(timezone_name=timezone_name, timeslice_grid_interval=timeslice_grid_interval)
+    start_date = grid_start_date - datetime.timedelta(minutes=lookback_slots * timeslice_grid_interval)
+    end_date = grid_start_date + datetime.timedelta(days=horizon_days) - datetime.timedelta(seconds=1)
+    start_ts = int(start_date.timestamp())
+    end_ts = int(end_date.timestamp())
+
+    spans = get_event_spans(ical_data, start_date=start_date, end_date=end_date, timezone_name=timezone_name,
+                            timeslice_grid_interval=timeslice_grid_interval,
+                            start_advanced_time=start_advanced_time, end_lag_time=end_lag_time,
+                            compiled_file=compiled_file)
+
+    with _cache_lock:
+        schedule = _rolling_schedules.get((name, timeslice_grid_interval))
+        if schedule is None:
+            schedule = RollingSchedule(start_ts, end_ts, timeslice_grid_interval=timeslice_grid_interval)
+            _rolling_schedules[(name, timeslice_grid_interval)] = schedule
+
+    with schedule.lock:
+        if schedule.ical_hash != ical_hash or schedule.parameters != parameters or \
+                schedule.index_of(start_ts) is None:
+            logger.debug("Building schedule '" + name + "'...")
+            with hcloud_metrics.SCHEDULE_BUILD_SECONDS.time(kind="full"):
+                schedule.reset(start_ts, end_ts, ical_hash, parameters=parameters)
+                schedule.build(spans)
+        elif schedule.datetime.start != start_ts or schedule.datetime.stop != end_ts:
+            with hcloud_metrics.SCHEDULE_BUILD_SECONDS.time(kind="advance"):
+                schedule.advance(start_ts, end_ts, spans)
+
+        if lookback_slots or unify_server_type:
+            return schedule.smoothed(int(grid_start_date.timestamp()), min_gap_slots=min_gap_slots,
+                                     min_run_slots=min_run_slots, unify_server_type=unify_server_type)
+    return schedule
+
+
+@hcloud_tracing.traced
+def get_datetime_and_timeslice_grid_for_now(ical_data: bytes = None, timezone_name: str = "Europe/Berlin",
+                                            timeslice_grid_interval: int = 15, start_advanced_time: int = 15,
+                                            end_lag_time: int = 30, min_gap: int = 0, min_run: int = 0,
+                                            unify_server_type: bool = False):
+    """
+    Compatibility layer for get_schedule_for_now
+
+    :param timezone_name:
+    :param ical_data:
+    :type timeslice_grid_interval: object
+    :return: grid_datetime (range of timestamps), grid_timeslice, grid_server_type
+    :rtype: tuple
+    """
+    schedule = get_schedule_for_now(ical_data=ical_data, timezone_name=timezone_name,
+                                    timeslice_grid_interval=timeslice_grid_interval,
+                                    start_advanced_time=start_advanced_time, end_lag_time=end_lag_time,
+                                    min_gap=min_gap, min_run=min_run, unify_server_type=unify_server_type)
+    grid_datetime, grid_timeslice, grid_server_type = schedule.get_grids()
+
+    # the grids are large, they are only dumped every LOG_GRID_DUMP_INTERVAL seconds
+    if hcloud_logging.should_dump_grid("grid"):
+        logger.debug("grid_datetime")
+        logger.debug(grid_datetime)
+        logger.debug("grid_timeslice")
+        logger.debug(grid_timeslice)
+        logger.debug("grid_server_type")
+        logger.debug(grid_server_type)
 
     return grid_datetime, grid_timeslice, grid_server_type
 
 
+@hcloud_tracing.traced
 def check_should_run_now(grid_datetime, grid_timeslice, grid_server_type, timezone_name: str = "Europe/Berlin",
                          timeslice_grid_interval: int = 15):
     """
@@ -173,14 +1094,10 @@ def check_should_run_now(grid_datetime, grid_timeslice, grid_server_type, timezo
     :raise error if grids are not or wrong initialised
     """
     if len(grid_timeslice) > 0 and len(grid_datetime) > 0 and len(grid_server_type) > 0:
-        timezone = tz.gettz(timezone_name)
-        now = datetime.datetime.now(timezone).replace(second=0, microsecond=0)
-        ''' start_date is always round down to nearest timeslice_grid_interval'''
-        # round down to timeslice_grid_intervall
-        discard_start = datetime.timedelta(minutes=now.minute % timeslice_grid_interval)
-        now -= discard_start
-        now_ts = int(now.timestamp())
+        now_ts = int(get_grid_start(timezone_name=timezone_name,
+                                    timeslice_grid_interval=timeslice_grid_interval).timestamp())
 
+        # grid_datetime is a range (O(1) lookup) when it comes from get_datetime_and_timeslice_grid_for_now
         if now_ts in grid_datetime:
             idx = grid_datetime.index(now_ts)
             return grid_timeslice[idx], grid_server_type[idx]
@@ -191,10 +1108,186 @@ def check_should_run_now(grid_datetime, grid_timeslice, grid_server_type, timezo
         raise Exception("Your grids are not initialised or empty")
 
 
+@hcloud_tracing.traced
+def check_schedule_should_run_now(schedule: Schedule, timezone_name: str = "Europe/Berlin",
+                                  timeslice_grid_interval: int = 15) -> tuple:
+    """
+    Check schedule if server should run now and which server-type should be used
+    Default is False and ''
+    :raise error if schedule is empty
+    """
+    if len(schedule) > 0:
+        now_ts = int(get_grid_start(timezone_name=timezone_name,
+                                    timeslice_grid_interval=timeslice_grid_interval).timestamp())
+        return schedule.is_running_at(now_ts)
+    else:
+        logger.error("schedule is not initialised or empty")
+        raise Exception("Your schedule is not initialised or empty")
+
+
+def _get_http_connection_lock(scheme: str, netloc: str) -> threading.Lock:
+    with _cache_file_locks_lock:
+        if (scheme, netloc) not in _http_connection_locks:
+            _http_connection_locks[(scheme, netloc)] = threading.Lock()
+        return _http_connection_locks[(scheme, netloc)]
+
+
+def _get_http_connection(scheme: str, netloc: str) -> http.client.HTTPConnection:
+    key = (scheme, netloc)
+    if key not in _http_connections:
+        if scheme == "https":
+            _http_connections[key] = http.client.HTTPSConnection(netloc, timeout=HTTP_TIMEOUT)
+        elif scheme == "http":
+            _http_connections[key] = http.client.HTTPConnection(netloc, timeout=HTTP_TIMEOUT)
+        else:
+            raise URLError("unsupported url scheme " + scheme)
+    return _http_connections[key]
+
+
+def _http_get(url: str, headers: dict, max_redirects: int = 5) -> tuple:
+    """
+    GET the given url, reusing one keep-alive connection per host. gzip responses are decompressed.
+
+    :return: status, response headers, body
+    :raise: URLError if calendar-source is not reachable
+    """
+    for redirect in range(max_redirects + 1):
+        parsed_url = urllib.parse.urlsplit(url)
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        request_headers = dict(headers)
+        if parsed_url.username is not None:
+            credentials = (urllib.parse.unquote(parsed_url.username) + ":" +
+                           urllib.parse.unquote(parsed_url.password or ""))
+            request_headers["Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode()
+        netloc = parsed_url.hostname + (":" + str(parsed_url.port) if parsed_url.port else "")
+
+        with _get_http_connection_lock(parsed_url.scheme, netloc):
+            # retry once with a fresh connection, in case the server closed our keep-alive connection
+            for attempt in range(2):
+                connection = _get_http_connection(parsed_url.scheme, netloc)
+                try:
+                    connection.request("GET", path, headers=request_headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    connection.close()
+                    del _http_connections[(parsed_url.scheme, netloc)]
+                    if attempt > 0:
+                        raise URLError(e)
+
+        if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+            url = urllib.parse.urljoin(url, response.getheader("Location"))
+            continue
+
+        if response.getheader("Content-Encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        return response.status, response, body
+
+    raise URLError("too many redirects for calendar-source")
+
+
+def _read_cache_meta(cache_file: str) -> dict:
+    try:
+        return json.loads(Path(cache_file + ".meta").read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _fetch_calendar_source(url: str, cache_file: str = None) -> bytes:
+    """
+    Fetch the calendar-source; with a cache_file, ETag/Last-Modified are stored next to it and sent as
+    If-None-Match/If-Modified-Since, so an unchanged calendar only costs a 304
+
+    :param url: url to the ical-data (must be public-accessable)
+    :param cache_file: path of the local copy or None
+    :return: binary reprasentation of ical data
+    :raise: URLError if calendar-source is not reachable
+    """
+    headers = {"Accept-Encoding": "gzip", "Connection": "keep-alive"}
+
+    meta = {}
+    if cache_file is not None and Path(cache_file).exists():
+        meta = _read_cache_meta(cache_file)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with hcloud_metrics.CALENDAR_FETCH_SECONDS.time():
+        status, response, body = _http_get(url, headers)
+
+    if cache_file is None:
+        if status != 200:
+            raise URLError("calendar-source returned HTTP " + str(status))
+        return body
+
+    with _get_cache_file_lock(cache_file):
+        if status == 304:
+            logger.debug("Calendar-source is not modified - Keeping cached copy...")
+            # reset the age of our local copy
+            os.utime(cache_file)
+            return Path(cache_file).read_bytes()
+        if status != 200:
+            raise URLError("calendar-source returned HTTP " + str(status))
+
+        logger.debug("Storing a fresh copy of calendar-source in cache...")
+        if Path(cache_file).exists() and Path(cache_file).read_bytes() != body:
+            calendar_changed.set()
+        tmp_file = cache_file + ".tmp"
+        Path(tmp_file).write_bytes(body)
+        os.replace(tmp_file, cache_file)
+        Path(cache_file + ".meta").write_text(json.dumps({
+            "etag": response.getheader("ETag"),
+            "last_modified": response.getheader("Last-Modified")
+        }))
+        return body
+
+
+def _refresh_in_background(url: str, cache_file: str):
+    """
+    Refresh cache_file in a background thread; only one refresh per cache_file runs at once
+    """
+    def refresh():
+        try:
+            logger.debug("Trying to fetch a fresh copy of calendar-source in background...")
+            _fetch_calendar_source(url, cache_file)
+        except Exception:
+            logger.warning("Calendar-source is not reachable - Keeping cached calendar-source...")
+        finally:
+            with _cache_file_locks_lock:
+                _background_refreshes.pop(cache_file, None)
+
+    with _cache_file_locks_lock:
+        if cache_file in _background_refreshes:
+            return
+        thread = threading.Thread(target=refresh, name="refresh " + cache_file, daemon=True)
+        _background_refreshes[cache_file] = thread
+    thread.start()
+
+
+def wait_for_background_refreshes(timeout: float = HTTP_TIMEOUT):
+    """
+    Block until all background refreshes of cache_files are finished, e.g. before a one-shot invocation exits
+
+    :param timeout: seconds to wait at most per refresh
+    """
+    with _cache_file_locks_lock:
+        threads = list(_background_refreshes.values())
+    for thread in threads:
+        thread.join(timeout=timeout)
+
+
+@hcloud_tracing.traced
 def get_ical_data(url: str = "", token: str = None) -> bytes:
     """
     get ical data from given url
 
+    A cached copy older than max_age is still returned, while a fresh copy is fetched in background.
+    Only if there is no cached copy, or it is older than max_age_in_case_of_error, we fetch synchronously.
+
     :param url: url to the ical-data (must be public-accessable)
     :param token: some toke, to identify the cache file. should be the same as IMAGE_TOKEN
     :return: binary reprasentation of ical data
@@ -209,7 +1302,7 @@ def get_ical_data(url: str = "", token: str = None) -> bytes:
     if token == "" or token is None:
         try:
             logger.debug("Fetching a fresh copy of calendar-source, because we got no token...")
-            return urllib.request.urlopen(url).read()
+            return _fetch_calendar_source(url)
         except:
             logger.error("Error fetching calendar-source")
             raise Exception("Error fetching calendar-source")
@@ -217,36 +1310,26 @@ def get_ical_data(url: str = "", token: str = None) -> bytes:
         cache_file = token + ".cache"
         ''' cache_file is stored in current directory, naming is: 'token.cache' '''
         try:
-            # check if we have a local copy
-            if Path(cache_file).exists():
-                cache_file_age = datetime.datetime.now().timestamp() - Path(cache_file).stat().st_mtime
-                if cache_file_age > max_age:
-                    logger.debug("Trying to fetch a fresh copy of calendar-source, because max_age reached...")
-                    try:
-                        logger.debug("Trying to get calendar-source...")
-                        ical_request = urllib.request.urlopen(url)
-                        logger.debug("Calendar-source is reachable - Using a fresh copy...")
-                        ical_string = ical_request.read()
-                        logger.debug("Storing a fresh copy of calendar-source in cache...")
-                        Path(cache_file).write_bytes(ical_string)
-                    # if calendar source is not reachable, try to handle this...
-                    except URLError:
-                        if cache_file_age < max_age_in_case_of_error:
-                            logger.debug("Calendar-source is not reachable - " +
-                                         "Using cached calendar-source within max_age_in_case_of_error...")
-                            ical_string = Path(cache_file).read_bytes()
+            with _get_cache_file_lock(cache_file):
+                if Path(cache_file).exists():
+                    cache_file_age = datetime.datetime.now().timestamp() - Path(cache_file).stat().st_mtime
+                    if cache_file_age <= max_age_in_case_of_error:
+                        if cache_file_age > max_age:
+                            hcloud_metrics.CALENDAR_CACHE_REQUESTS.inc(result="stale")
+                            _refresh_in_background(url, cache_file)
                         else:
-                            logger.error("Calendar-source is not reachable and max_age_in_case_of_error is reached")
-                            raise Exception("Calendar-source is not reachable and max_age_in_case_of_error is reached")
-                else:
-                    logger.debug("Using cached calendar-source...")
-                    ical_string = Path(cache_file).read_bytes()
-            # no local copy
-            else:
-                logger.debug("Fetching a fresh copy of calendar-source, because we have no local copy...")
-                ical_string = urllib.request.urlopen(url).read()
-                Path(cache_file).write_bytes(ical_string)
-            return ical_string
+                            hcloud_metrics.CALENDAR_CACHE_REQUESTS.inc(result="hit")
+                        logger.debug("Using cached calendar-source...")
+                        return Path(cache_file).read_bytes()
+
+            # no local copy or too old to be used
+            hcloud_metrics.CALENDAR_CACHE_REQUESTS.inc(result="miss")
+            logger.debug("Fetching a fresh copy of calendar-source, because we have no usable local copy...")
+            try:
+                return _fetch_calendar_source(url, cache_file)
+            except URLError:
+                logger.error("Calendar-source is not reachable and max_age_in_case_of_error is reached")
+                raise Exception("Calendar-source is not reachable and max_age_in_case_of_error is reached")
         except:
             logger.error("Error fetching-calendar-source")
             raise Exception("Error fetching calendar-source")
@@ -0,0 +1,130 @@
+import json
+import math
+import os
+import threading
+from pathlib import Path
+import logging
+
+logger = logging.getLogger("Application")
+
+HISTORY_FILE = "duration_history.json"
+''' history is stored in current directory '''
+MAX_SAMPLES = 50
+''' number of durations kept per phase, server_type and location '''
+MIN_SAMPLES = 3
+''' a percentile is only used, if there are at least this many durations '''
+START_PHASES = ("create", "assign_floating_ip")
+''' phases until a server is ready for use '''
+
+_history_lock = threading.Lock()
+
+
+def _key(phase: str, server_type: str, location: str) -> str:
+    return phase + "|" + server_type + "|" + location
+
+
+def _load(history_file: str = HISTORY_FILE) -> dict:
+    try:
+        return json.loads(Path(history_file).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def record_duration(phase: str, seconds: float, server_type: str = "", location: str = "",
+                    history_file: str = HISTORY_FILE):
+    """Record the wall-clock duration of one lifecycle phase
+
+    :param phase: e.g. create, assign_floating_ip, power_off, snapshot, delete
+    :param seconds: measured duration
+    :param server_type: server_type of the server, e.g. cx21
+    :param location: location of the server, e.g. nbg1
+    :param history_file: path of the history store
+    """
+    try:
+        with _history_lock:
+            history = _load(history_file)
+            durations = history.setdefault(_key(phase, server_type, location), [])
+            durations.append(round(seconds, 3))
+            del durations[:-MAX_SAMPLES]
+            tmp_file = history_file + ".tmp"
+            Path(tmp_file).write_text(json.dumps(history))
+            os.replace(tmp_file, history_file)
+        logger.debug("duration of " + phase + " for " + server_type + "/" + location + ": " + str(round(seconds, 1)) + "s")
+    except OSError:
+        logger.warning("could not record duration of " + phase)
+
+
+def get_durations(phase: str, server_type: str = None, location: str = None, history_file: str = HISTORY_FILE) -> list:
+    """
+    :param phase: e.g. create
+    :param server_type: only durations for this server_type, None for all
+    :param location: only durations for this location, None for all
+    :return: all recorded durations in seconds
+    """
+    with _history_lock:
+        history = _load(history_file)
+    durations = []
+    for key, values in history.items():
+        key_phase, key_server_type, key_location = key.split("|")
+        if key_phase != phase:
+            continue
+        if server_type is not None and key_server_type != server_type:
+            continue
+        if location is not None and key_location != location:
+            continue
+        durations += values
+    return durations
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    :param values: list of numbers, not empty
+    :param percent: 0 till 100
+    :return: nearest-rank percentile
+    """
+    values = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def get_start_advanced_time(server_type: str = None, location: str = None, percent: float = 90,
+                            default: int = 15, history_file: str = HISTORY_FILE) -> int:
+    """Get the minutes a server needs until it is ready, learned from recorded durations
+
+    The percentile of every phase in START_PHASES is added up.
+
+    :param server_type: server_type of the server, None for all
+    :param location: location of the server, None for all
+    :param percent: percentile to use, e.g. 90
+    :param default: minutes returned, if there are not enough recorded durations
+    :return: minutes, rounded up
+    """
+    seconds = 0
+    for phase in START_PHASES:
+        durations = get_durations(phase, server_type=server_type, location=location, history_file=history_file)
+        if phase == START_PHASES[0] and len(durations) < MIN_SAMPLES:
+            return default
+        if len(durations) > 0:
+            seconds += percentile(durations, percent)
+    return math.ceil(seconds / 60)
+
+
+def get_start_advanced_times(location: str = None, percent: float = 90, default: int = 15,
+                             history_file: str = HISTORY_FILE) -> dict:
+    """Get learned start lead times for every recorded server_type
+
+    :return: dict server_type -> minutes; key '' is used for events without server_type
+    """
+    start_advanced_times = {'': get_start_advanced_time(location=location, percent=percent, default=default,
+                                                        history_file=history_file)}
+    server_types = set()
+    for key in _load(history_file):
+        key_phase, key_server_type, key_location = key.split("|")
+        if key_phase == START_PHASES[0] and key_server_type:
+            server_types.add(key_server_type)
+    for server_type in server_types:
+        start_advanced_times[server_type] = get_start_advanced_time(server_type=server_type, location=location,
+                                                                    percent=percent,
+                                                                    default=start_advanced_times[''],
+                                                                    history_file=history_file)
+    return start_advanced_times
@@ -0,0 +1,181 @@
+import hcloud_lifecycle
+import json
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger("Application")
+
+JOURNAL_FILE = "state_journal.jsonl"
+''' default for config.JOURNAL_FILE: journal is stored in current directory '''
+COMPACT_LINES = 1000
+''' the journal is rewritten with one line per token, once it has more lines than this '''
+
+
+class Journal:
+    """
+    Crash-safe record of the state of every token: desired and observed server state, the last lifecycle job
+    with its step, the last snapshot id, the hibernation flag and the last failed rescale
+
+    Every change is appended as one json line and synced to disk, so a killed process loses at most the line it
+    was writing; a torn last line is ignored on load. Each line holds the complete record of its token, the last
+    line of a token wins.
+    """
+
+    def __init__(self, path: str = JOURNAL_FILE):
+        """
+        :param path: path of the journal file
+        """
+        self.path = path
+        self.records = {}
+        ''' token -> record '''
+        self.lines = 0
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        broken = False
+        try:
+            with open(self.path) as file:
+                for line in file:
+                    self.lines += 1
+                    try:
+                        record = json.loads(line)
+                        self.records[record["token"]] = record
+                    except (ValueError, KeyError):
+                        broken = True
+                        logger.warning("ignoring broken line " + str(self.lines) + " of " + self.path)
+        except FileNotFoundError:
+            return
+        except OSError:
+            logger.warning("could not read " + self.path)
+            return
+        # a torn last line has no line break, the next append would continue it; rewrite without broken lines
+        if broken or self.lines > max(COMPACT_LINES, 2 * len(self.records)):
+            self._compact()
+
+    def _compact(self):
+        try:
+            tmp_file = self.path + ".tmp"
+            with open(tmp_file, "w") as file:
+                for record in self.records.values():
+                    file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_file, self.path)
+            self.lines = len(self.records)
+        except OSError:
+            logger.warning("could not compact " + self.path)
+
+    def _append(self, record: dict):
+        try:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self.lines += 1
+            if self.lines > max(COMPACT_LINES, 2 * len(self.records)):
+                self._compact()
+        except OSError:
+            logger.warning("could not write to " + self.path)
+
+    def get(self, token: str) -> dict:
+        """
+        :param token: IMAGE_TOKEN of the server
+        :return: copy of the record of token, an empty dict if there is none
+        """
+        with self.lock:
+            return dict(self.records.get(token, {}))
+
+    def update(self, token: str, **fields):
+        """
+        Change fields of the record of token; nothing is written, if they did not change
+
+        :param token: IMAGE_TOKEN of the server
+        :param fields: e.g. desired=[True, "cx21"]
+        """
+        with self.lock:
+            record = self.records.get(token, {"token": token})
+            if all(record.get(name) == value for name, value in fields.items()):
+                return
+            record = dict(record, **fields)
+            record["updated"] = time.time()
+            self.records[token] = record
+            self._append(record)
+
+    def record_state(self, token: str, should_run: bool, should_run_as: str, is_running: bool, is_running_as: str,
+                     confirmed: bool = False):
+        """
+        Record the desired and the observed state of one tick
+
+        :param token: IMAGE_TOKEN of the server
+        :param should_run: desired state from the schedule
+        :param should_run_as: desired server_type
+        :param is_running: observed state
+        :param is_running_as: observed server_type
+        :param confirmed: True, if the observed state was just read from the hcloud api
+        """
+        observed = [bool(is_running), is_running_as]
+        fields = {"desired": [bool(should_run), should_run_as], "observed": observed}
+        if confirmed or self.get(token).get("observed") != observed:
+            fields["observed_at"] = time.time()
+        self.update(token, **fields)
+
+    def record_job(self, job: hcloud_lifecycle.LifecycleJob):
+        """
+        Record the step of a lifecycle job, used as listener of LifecycleJob
+
+        :param job: LifecycleJob
+        """
+        fields = {"job": {"operation": job.operation, "state": job.state, "started": job.started,
+                          "running_after": job.running_after, "server_type": job.server_type,
+                          "details": dict(job.details)}}
+        if "snapshot_id" in job.details:
+            fields["last_snapshot_id"] = job.details["snapshot_id"]
+        self.update(job.token, **fields)
+
+    def get_observed(self, token: str, max_age: float):
+        """
+        :param token: IMAGE_TOKEN of the server
+        :param max_age: seconds an observed state is trusted
+        :return: observed server_is_running and server_is_running_as; None if there is none, it is too old or a job
+        was interrupted
+        """
+        record = self.get(token)
+        if "observed" not in record or self.get_interrupted_job(token) is not None:
+            return None
+        if time.time() - record.get("observed_at", 0) > max_age:
+            return None
+        return tuple(record["observed"])
+
+    def get_interrupted_job(self, token: str) -> dict:
+        """
+        :param token: IMAGE_TOKEN of the server
+        :return: the recorded job of token, if it did not reach a final state; otherwise None
+        """
+        job = self.get(token).get("job")
+        if job is None or job["state"] in hcloud_lifecycle.FINAL_STATES:
+            return None
+        return job
+
+    def abandon_job(self, token: str):
+        """
+        Mark the interrupted job of token as failed, after it was not resumed
+
+        :param token: IMAGE_TOKEN of the server
+        """
+        job = self.get_interrupted_job(token)
+        if job is not None:
+            self.update(token, job=dict(job, state=hcloud_lifecycle.FAILED))
+
+
+def open_journal(config):
+    """
+    :param config: the config module
+    :return: Journal of JOURNAL_FILE from config; None if it is set to None or ""
+    """
+    path = getattr(config, "JOURNAL_FILE", JOURNAL_FILE)
+    if not path:
+        return None
+    return Journal(path)
@@ -0,0 +1,216 @@
+from concurrent.futures import ThreadPoolExecutor
+import hcloud_metrics
+import threading
+import time
+import logging
+
+logger = logging.getLogger("Application")
+
+QUEUED = "queued"
+STOPPING = "stopping"
+SNAPSHOTTING = "snapshotting"
+DELETING = "deleting"
+CREATING = "creating"
+ASSIGNING_IP = "assigning_ip"
+STARTING = "starting"
+RESCALING = "rescaling"
+''' steps of a job, reported by the hcloud_automation functions through their progress callback '''
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+''' final states of a job '''
+FINAL_STATES = (DONE, FAILED, CANCELLED)
+MAX_WORKERS = 4
+''' default for config.LIFECYCLE_MAX_WORKERS: lifecycle jobs running at the same time '''
+POLL_INTERVAL = 5
+''' default for config.LIFECYCLE_POLL_INTERVAL: seconds between two ticks, while a job of the token is running '''
+
+
+class LifecycleCancelled(Exception):
+    """Raised by LifecycleJob.progress, if the job was cancelled before its next step"""
+
+
+class LifecycleJob:
+    """
+    One lifecycle operation (start, destroy, hibernate, resume, rescale) of one token, run by a LifecycleExecutor
+
+    The job moves through the steps reported by progress, e.g. stopping, snapshotting, deleting for a destroy, and
+    ends as done, failed or cancelled. A cancelled job stops before its next step; the server is left as it is after
+    the last finished step and the next reconciliation continues from there.
+    """
+
+    def __init__(self, token: str, operation: str, running_after: bool, server_type: str = '', listener=None):
+        """
+        :param token: IMAGE_TOKEN of the server
+        :param operation: name of the operation, e.g. "destroy"
+        :param running_after: True, if the server should run after the job
+        :param server_type: wanted server_type of start and rescale
+        :param listener: optional callable, called with the job after every state change, e.g. Journal.record_job
+        """
+        self.token = token
+        self.operation = operation
+        self.running_after = running_after
+        self.server_type = server_type
+        self.listener = listener
+        self.state = QUEUED
+        self.details = {}
+        ''' results of finished steps, e.g. snapshot_id '''
+        self.result = None
+        self.error = None
+        self.started = time.time()
+        self.step_started = time.monotonic()
+        self.cancel_requested = threading.Event()
+        self.future = None
+
+    def progress(self, state: str, **details):
+        """
+        Enter the next step, called by the hcloud_automation functions before each step
+
+        Called again with the current step, it only records details, e.g. the action_id of the action the step
+        waits for, so a restart can wait for the action instead of repeating it.
+
+        :param state: the next step, e.g. SNAPSHOTTING
+        :param details: results of the finished steps, e.g. snapshot_id
+        :raise: LifecycleCancelled, if the job was cancelled
+        """
+        self.details.update(details)
+        if state == self.state:
+            self._notify()
+            return
+        if self.cancel_requested.is_set():
+            raise LifecycleCancelled("'" + self.token + "' " + self.operation + " cancelled before " + state)
+        self._set_state(state)
+
+    def _set_state(self, state: str):
+        now = time.monotonic()
+        if self.state != QUEUED:
+            hcloud_metrics.LIFECYCLE_STEP_SECONDS.observe(now - self.step_started, operation=self.operation,
+                                                          step=self.state)
+        self.step_started = now
+        logger.info("'" + self.token + "' " + self.operation + ": " + self.state + " -> " + state)
+        self.state = state
+        self._notify()
+
+    def _notify(self):
+        if self.listener is not None:
+            try:
+                self.listener(self)
+            except Exception:
+                logger.exception("'" + self.token + "' listener of " + self.operation + " failed")
+
+    def cancel(self):
+        """
+        Cancel the job before its next step; a queued job does not start at all
+        """
+        self.cancel_requested.set()
+        if self.future is not None and self.future.cancel():
+            self._set_state(CANCELLED)
+
+    def done(self) -> bool:
+        """
+        :return: True, if the job is done, failed or cancelled
+        """
+        return self.state in FINAL_STATES
+
+    def finish(self, result):
+        """
+        Record the result of the operation and the final state
+
+        :param result: result of the hcloud_automation function
+        """
+        self.result = result
+        if self.cancel_requested.is_set() and not result:
+            self._set_state(CANCELLED)
+        else:
+            self._set_state(DONE if result else FAILED)
+
+    def run(self, function, **kwargs):
+        """
+        Run function with progress=self.progress and record the final state
+
+        :param function: hcloud_automation function of the operation
+        :param kwargs: arguments of function
+        """
+        try:
+            self.finish(function(progress=self.progress, **kwargs))
+        except LifecycleCancelled as e:
+            logger.info(str(e))
+            self._set_state(CANCELLED)
+        except Exception as e:
+            logger.exception("'" + self.token + "' " + self.operation + " failed in step " + self.state)
+            self.error = e
+            self._set_state(CANCELLED if self.cancel_requested.is_set() else FAILED)
+
+
+class LifecycleExecutor:
+    """
+    Runs lifecycle operations on a worker pool, at most one job per token
+
+    The control loop submits a job and keeps ticking; it finds the running job with get, can cancel it when the
+    schedule changes and collects it with pop_finished once it is over.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="lifecycle")
+        self.jobs = {}
+        ''' token -> LifecycleJob, until it is collected by pop_finished '''
+        self.lock = threading.Lock()
+
+    def submit(self, token: str, operation: str, running_after: bool, function, wanted_server_type: str = '',
+               listener=None, **kwargs) -> LifecycleJob:
+        """
+        Run function as job of token, unless there is already one
+
+        :param token: IMAGE_TOKEN of the server
+        :param operation: name of the operation, e.g. "destroy"
+        :param running_after: True, if the server should run after the job
+        :param function: hcloud_automation function with a progress parameter
+        :param wanted_server_type: wanted server_type of start and rescale
+        :param listener: optional callable, called with the job after every state change, e.g. Journal.record_job
+        :param kwargs: arguments of function
+        :return: the new job, or the job of token which was not collected yet
+        """
+        with self.lock:
+            job = self.jobs.get(token)
+            if job is not None:
+                logger.warning("'" + token + "' " + operation + " not started, " + job.operation + " is " + job.state)
+                return job
+            job = LifecycleJob(token, operation, running_after, server_type=wanted_server_type,
+                               listener=listener)
+            self.jobs[token] = job
+            job.future = self.executor.submit(job.run, function, **kwargs)
+        logger.info("'" + token + "' " + operation + " queued")
+        return job
+
+    def get(self, token: str) -> LifecycleJob:
+        """
+        :param token: IMAGE_TOKEN of the server
+        :return: the job of token, which is running or not collected yet; None if there is none
+        """
+        with self.lock:
+            return self.jobs.get(token)
+
+    def pop_finished(self, token: str) -> LifecycleJob:
+        """
+        :param token: IMAGE_TOKEN of the server
+        :return: the finished job of token, it is forgotten afterwards; None if there is none or it is still running
+        """
+        with self.lock:
+            job = self.jobs.get(token)
+            if job is None or not job.done():
+                return None
+            del self.jobs[token]
+            return job
+
+    def shutdown(self, wait: bool = True):
+        """
+        Cancel queued jobs and wait for the running ones
+
+        :param wait: if False, running jobs are left to finish in the background
+        """
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            if job.state == QUEUED:
+                job.cancel()
+        self.executor.shutdown(wait=wait)
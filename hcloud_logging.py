@@ -0,0 +1,168 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import json
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger("Application")
+
+LOG_FORMAT = '[%(filename)s:%(lineno)s - %(funcName)20s() ] %(asctime)s - %(name)s - %(levelname)s - %(message)s'
+''' format of text records, the same as of logging.basicConfig in main.py, hcloud_automation and hcloud_calendar '''
+REPEAT_WINDOW = 3600
+''' default for config.LOG_REPEAT_WINDOW: seconds an identical debug or steady info message is suppressed after it was logged '''
+GRID_DUMP_INTERVAL = 3600
+''' default for config.LOG_GRID_DUMP_INTERVAL: seconds between two dumps of the same grid, 0 dumps never '''
+_listener = None
+_repeat_filter = None
+_grid_dumps = {}
+''' name of the grid -> time of its last dump '''
+_grid_dumps_lock = threading.Lock()
+grid_dump_interval = GRID_DUMP_INTERVAL
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Collapse identical debug messages and info messages logged with extra={"steady": True}
+
+    A message is passed, if it was not logged within the last window seconds. Once its window expired, the number of
+    suppressed repetitions is emitted as a record of its own, through emit. Other records are always passed.
+    """
+
+    def __init__(self, window: float = REPEAT_WINDOW, emit=None):
+        """
+        :param window: seconds an identical message is suppressed after it was passed
+        :param emit: callable, which writes a record without filtering it, e.g. QueueHandler.emit; the suppressed
+        repetitions are not reported without it
+        """
+        super().__init__()
+        self.window = window
+        self.emit = emit
+        self.seen = {}
+        ''' (logger, level, message) -> [time of last pass, suppressed repetitions, last suppressed record] '''
+        self.next_expiry = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.window <= 0:
+            return True
+        now = time.monotonic()
+        if now >= self.next_expiry:
+            self.expire(now)
+        if record.levelno > logging.DEBUG and not getattr(record, "steady", False):
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        with self.lock:
+            seen = self.seen.get(key)
+            if seen is not None and now - seen[0] < self.window:
+                seen[1] += 1
+                seen[2] = record
+                return False
+            self.seen[key] = [now, 0, None]
+        return True
+
+    def expire(self, now: float = None):
+        """
+        Forget the messages whose window expired and emit their suppressed repetitions
+
+        :param now: time.monotonic(); None expires all messages, e.g. before stopping
+        """
+        with self.lock:
+            if now is None:
+                expired = list(self.seen.values())
+                self.seen = {}
+            else:
+                expired = [seen for seen in self.seen.values() if now - seen[0] >= self.window]
+                self.seen = {k: v for k, v in self.seen.items() if now - v[0] < self.window}
+                # expired repetitions are reported at most a tenth of the window late
+                self.next_expiry = now + self.window / 10
+        if self.emit is None:
+            return
+        for seen in expired:
+            if seen[1] > 0:
+                record = logging.makeLogRecord(seen[2].__dict__)
+                record.msg = record.getMessage() + " (repeated " + str(seen[1]) + " times)"
+                record.args = None
+                self.emit(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per record, for log collectors"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": record.filename,
+            "line": record.lineno,
+            "function": record.funcName,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+def setup(config):
+    """
+    Replace the synchronous logging to error.log with a queue, written by a background thread to a rotating file
+
+    Reads LOG_FILE, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_JSON, LOG_REPEAT_WINDOW and
+    LOG_GRID_DUMP_INTERVAL from config.
+
+    :param config: the config module
+    """
+    global _listener, _repeat_filter, grid_dump_interval
+    if _listener is not None:
+        return
+
+    handler = RotatingFileHandler(getattr(config, "LOG_FILE", "error.log"),
+                                  maxBytes=getattr(config, "LOG_MAX_BYTES", 10 * 1024 * 1024),
+                                  backupCount=getattr(config, "LOG_BACKUP_COUNT", 5))
+    if getattr(config, "LOG_JSON", False):
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    # the record is formatted by the background writer, the queue only passes the message
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    _repeat_filter = RepeatFilter(getattr(config, "LOG_REPEAT_WINDOW", REPEAT_WINDOW), emit=queue_handler.emit)
+    queue_handler.addFilter(_repeat_filter)
+    grid_dump_interval = getattr(config, "LOG_GRID_DUMP_INTERVAL", GRID_DUMP_INTERVAL)
+
+    logging.basicConfig(handlers=[queue_handler], level=getattr(config, "LOG_LEVEL", "DEBUG"), force=True)
+    _listener = QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    """
+    Write all queued records and stop the background writer
+    """
+    global _listener
+    if _listener is not None:
+        # repetitions, which are still suppressed, are not lost
+        _repeat_filter.expire()
+        _listener.stop()
+        _listener = None
+
+
+def should_dump_grid(name: str) -> bool:
+    """
+    :param name: name of the grid, e.g. IMAGE_TOKEN
+    :return: True, if debug logging is enabled and the grid was not dumped within the last grid_dump_interval seconds
+    """
+    if grid_dump_interval <= 0 or not logger.isEnabledFor(logging.DEBUG):
+        return False
+    now = time.monotonic()
+    with _grid_dumps_lock:
+        if name in _grid_dumps and now - _grid_dumps[name] < grid_dump_interval:
+            return False
+        _grid_dumps[name] = now
+    return True
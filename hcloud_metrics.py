@@ -0,0 +1,238 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+import os
+import re
+import threading
+import time
+import logging
+
+logger = logging.getLogger("Application")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+''' upper bounds in seconds of the histogram buckets '''
+_metrics = []
+''' all metrics in order of definition '''
+_lock = threading.Lock()
+_textfile_lock = threading.Lock()
+_http_server = None
+
+
+def _format_labels(labels: tuple, extra: str = '') -> str:
+    parts = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+             for name, value in labels]
+    if extra:
+        parts.append(extra)
+    if not parts:
+        return ''
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, one value per label combination"""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> list:
+        lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(self.name + _format_labels(labels) + " " + _format_value(value))
+        return lines
+
+
+class Histogram:
+    """Histogram of durations in seconds, one set of buckets per label combination"""
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.values = {}
+        ''' label combination -> [bucket counts, sum, count] '''
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry = self.values[key]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][idx] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def get_count(self, **labels) -> int:
+        entry = self.values.get(tuple(sorted(labels.items())))
+        return entry[2] if entry else 0
+
+    def render(self) -> list:
+        lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " histogram"]
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(self.name + "_bucket" + _format_labels(labels, 'le="' + _format_value(bound) + '"') +
+                             " " + str(cumulative))
+            lines.append(self.name + "_sum" + _format_labels(labels) + " " + _format_value(total))
+            lines.append(self.name + "_count" + _format_labels(labels) + " " + str(count))
+        return lines
+
+
+CALENDAR_FETCH_SECONDS = Histogram("hcloud_calendar_fetch_seconds", "Download time of the calendar-source")
+CALENDAR_CACHE_REQUESTS = Counter("hcloud_calendar_cache_requests_total",
+                                  "Reads of the calendar cache-file by result (hit, stale, miss)")
+COMPILED_SCHEDULE_REQUESTS = Counter("hcloud_compiled_schedule_requests_total",
+                                     "Reads of the compiled schedule file by result (hit, miss)")
+CALENDAR_PARSE_SECONDS = Histogram("hcloud_calendar_parse_seconds", "Parse time of the calendar-source")
+CALENDAR_EXPAND_SECONDS = Histogram("hcloud_calendar_expand_seconds",
+                                    "Recurrence expansion time of the calendar by mode (full, incremental)")
+SCHEDULE_BUILD_SECONDS = Histogram("hcloud_schedule_build_seconds", "Build time of the timeslice schedule")
+TICK_SECONDS = Histogram("hcloud_tick_seconds", "Duration of one reconciliation per token")
+API_REQUEST_SECONDS = Histogram("hcloud_api_request_seconds", "Duration of Hetzner Cloud API requests by endpoint")
+ACTION_WAIT_SECONDS = Histogram("hcloud_action_wait_seconds", "Time spent in wait_until_finished by phase")
+OPERATIONS = Counter("hcloud_operations_total", "Start, destroy, rescale and snapshot operations per token and result")
+LIFECYCLE_STEP_SECONDS = Histogram("hcloud_lifecycle_step_seconds", "Duration of the steps of lifecycle jobs by operation")
+
+
+def render() -> str:
+    """
+    :return: all metrics in the prometheus text exposition format
+    """
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str):
+    """
+    Write all metrics atomically to path, e.g. for the textfile collector of the node exporter
+
+    :param path: target file, should end with .prom
+    """
+    try:
+        with _textfile_lock:
+            with open(path + ".tmp", "w") as file:
+                file.write(render())
+            os.replace(path + ".tmp", path)
+    except:
+        logger.warning("Could not write metrics to " + path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, address: str = "127.0.0.1"):
+    """
+    Serve all metrics on http://address:port/metrics in a daemon thread
+
+    :param port: tcp port
+    :param address: address to bind to, local only by default
+    """
+    global _http_server
+    if _http_server is not None:
+        return
+    _http_server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    _http_server.daemon_threads = True
+    threading.Thread(target=_http_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("serving metrics on http://" + address + ":" + str(port) + "/metrics")
+
+
+def start(config):
+    """
+    Start the metrics endpoint, if METRICS_PORT is set in config
+
+    :param config: the config module
+    """
+    port = getattr(config, "METRICS_PORT", None)
+    if port:
+        try:
+            start_http_server(int(port), getattr(config, "METRICS_ADDRESS", "127.0.0.1"))
+        except:
+            logger.error("Could not serve metrics on port " + str(port))
+
+
+def write(config):
+    """
+    Write the metrics file, if METRICS_TEXTFILE is set in config
+
+    :param config: the config module
+    """
+    path = getattr(config, "METRICS_TEXTFILE", None)
+    if path:
+        write_textfile(path)
+
+
+_ID_PATTERN = re.compile(r"/\d+(?=/|$)")
+
+
+def get_endpoint(method: str, url: str) -> str:
+    """
+    :return: method and url with numeric ids replaced, e.g. "POST /servers/{id}/actions/poweroff"
+    """
+    return method.upper() + " " + _ID_PATTERN.sub("/{id}", url.split("?", 1)[0])
+
+
+def instrument_client(client):
+    """
+    Time every request of the given hcloud.Client by endpoint
+
+    :param client: hcloud.Client
+    :return: client
+    """
+    base = client._client
+    request = base.request
+    if getattr(request, "instrumented", False):
+        return client
+
+    def timed_request(method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            return request(method, url, **kwargs)
+        finally:
+            API_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=get_endpoint(method, url))
+
+    timed_request.instrumented = True
+    base.request = timed_request
+    return client
@@ -0,0 +1,455 @@
+from hcloud import Client
+import hcloud_automation
+import hcloud_calendar
+import hcloud_history
+import hcloud_journal
+import hcloud_lifecycle
+import hcloud_logging
+import hcloud_metrics
+import hcloud_tracing
+import config
+import datetime
+import time
+import logging
+
+logger = logging.getLogger("Application")
+
+
+MAX_SLEEP_TIME = 15 * 60
+''' default for config.MAX_SLEEP_TIME: maximum seconds between two reconciliations '''
+HEALTH_CHECK_INTERVAL = 60 * 60
+''' default for config.HEALTH_CHECK_INTERVAL: seconds between two checks of the real server state '''
+TRANSITION_DELAY = 1
+''' seconds to wait after a transition, so the new timeslice is already active '''
+
+_no_default = object()
+STOP_KEEP_RUNNING = "KEEP RUNNING"
+STOP_POWER_OFF = "POWER OFF"
+STOP_DESTROY = "DESTROY"
+''' actions of choose_stop_action '''
+_hibernating = set()
+''' IMAGE_TOKENs, whose server was powered off by choose_stop_action instead of destroyed; journaled as hibernating '''
+_failed_rescales = {}
+''' IMAGE_TOKEN -> server_type of the last failed rescale, it is not retried until another server_type is wanted;
+journaled as failed_rescale '''
+_journal_checked = set()
+''' IMAGE_TOKENs, whose journal was checked for an interrupted job since the start '''
+
+
+def get_setting(entry: dict, name: str, default=_no_default):
+    """Get a setting for one calendar/server entry, falling back to the global value in config.py
+
+    :param entry: dict with settings for one entry, e.g. one item of config.FLEET
+    :param name: name of the setting, e.g. TIMESLICE_GRID_INTERVAL
+    :param default: used if the setting is neither in entry nor in config.py
+    :return: value from entry, if present, otherwise the value from config.py
+    """
+    if entry is not None and name in entry:
+        return entry[name]
+    if default is _no_default:
+        return getattr(config, name)
+    return getattr(config, name, default)
+
+
+def choose_stop_action(seconds_until_next_start, entry: dict = None) -> str:
+    """Choose how to stop a server, which should not run now, from the gap until its next start
+
+    Gaps up to HIBERNATE_KEEP_RUNNING_GAP minutes keep the server running, gaps up to HIBERNATE_POWER_OFF_GAP minutes
+    only power it off; longer gaps, or no next start within the schedule, destroy it. Both default to 0.
+
+    :param seconds_until_next_start: seconds until the next run period starts, None if there is none
+    :param entry: dict with optional overrides of the values in config.py
+    :return: STOP_KEEP_RUNNING, STOP_POWER_OFF or STOP_DESTROY
+    :rtype: str
+    """
+    if seconds_until_next_start is None:
+        return STOP_DESTROY
+    if seconds_until_next_start <= get_setting(entry, "HIBERNATE_KEEP_RUNNING_GAP", 0) * 60:
+        return STOP_KEEP_RUNNING
+    if seconds_until_next_start <= get_setting(entry, "HIBERNATE_POWER_OFF_GAP", 0) * 60:
+        return STOP_POWER_OFF
+    return STOP_DESTROY
+
+
+def get_seconds_until_next_start(schedule: hcloud_calendar.Schedule):
+    """
+    :param schedule: Schedule
+    :return: seconds until the next run period of the schedule starts, None if there is none
+    """
+    now = int(time.time())
+    next_run_start = schedule.next_run_start(now)
+    if next_run_start is None:
+        return None
+    return max(next_run_start - now, 0)
+
+
+def get_seconds_until_next_tick(schedule: hcloud_calendar.Schedule, max_sleep_time: int = MAX_SLEEP_TIME) -> float:
+    """Get the seconds until the next transition of the schedule, but not more than max_sleep_time
+
+    :param schedule: Schedule
+    :param max_sleep_time: maximum seconds to wait
+    :return: seconds to wait until the next reconciliation is needed
+    """
+    now = time.time()
+    next_transition = schedule.next_transition(int(now))
+    if next_transition is None:
+        return max_sleep_time
+    return max(min(next_transition + TRANSITION_DELAY - now, max_sleep_time), TRANSITION_DELAY)
+
+
+def _set_hibernating(journal: hcloud_journal.Journal, snapshot_token: str, hibernating: bool):
+    """Remember, whether the server of snapshot_token was powered off instead of destroyed
+
+    :param journal: hcloud_journal.Journal, which keeps the flag over a restart, or None
+    :param snapshot_token: IMAGE_TOKEN of the server
+    :param hibernating: True, if it was powered off by choose_stop_action
+    """
+    if hibernating:
+        _hibernating.add(snapshot_token)
+    else:
+        _hibernating.discard(snapshot_token)
+    if journal is not None:
+        journal.update(snapshot_token, hibernating=hibernating)
+
+
+def _set_failed_rescale(journal: hcloud_journal.Journal, snapshot_token: str, server_type):
+    """Remember the server_type of the last failed rescale of snapshot_token, it is not retried
+
+    :param journal: hcloud_journal.Journal, which keeps the backoff over a restart, or None
+    :param snapshot_token: IMAGE_TOKEN of the server
+    :param server_type: server_type of the failed rescale; None after a successful one
+    """
+    if server_type is None:
+        _failed_rescales.pop(snapshot_token, None)
+    else:
+        _failed_rescales[snapshot_token] = server_type
+    if journal is not None:
+        journal.update(snapshot_token, failed_rescale=server_type)
+
+
+def _load_journaled_state(journal: hcloud_journal.Journal, snapshot_token: str):
+    """Restore the hibernation flag and the failed rescale of snapshot_token from journal after a restart"""
+    record = journal.get(snapshot_token)
+    if record.get("hibernating"):
+        _hibernating.add(snapshot_token)
+    if record.get("failed_rescale") is not None:
+        _failed_rescales[snapshot_token] = record["failed_rescale"]
+
+
+def _finish_operation(snapshot_token: str, operation: str, result, server_type: str = '',
+                      journal: hcloud_journal.Journal = None):
+    """Count a finished lifecycle operation and update the per token bookkeeping
+
+    :param snapshot_token: IMAGE_TOKEN of the server
+    :param operation: start, resume, rescale, hibernate or destroy
+    :param result: result of the hcloud_automation function, hcloud_lifecycle.CANCELLED for a cancelled job
+    :param server_type: wanted server_type of a rescale
+    :param journal: hcloud_journal.Journal, which keeps the bookkeeping over a restart, or None
+    """
+    if result == hcloud_lifecycle.CANCELLED:
+        hcloud_metrics.OPERATIONS.inc(operation=operation, token=snapshot_token, result="cancelled")
+        logger.info("'" + snapshot_token + "' " + operation + " cancelled")
+        return
+    hcloud_metrics.OPERATIONS.inc(operation=operation, token=snapshot_token,
+                                  result="success" if result else "failure")
+    logger.info(result)
+    if operation == "hibernate" and result:
+        _set_hibernating(journal, snapshot_token, True)
+    elif operation == "destroy":
+        _set_hibernating(journal, snapshot_token, False)
+    elif operation == "rescale":
+        _set_failed_rescale(journal, snapshot_token, None if result else server_type)
+
+
+def _run_operation(executor, journal, token: str, operation: str, running_after: bool, function,
+                   wanted_server_type: str = '', **kwargs):
+    """Run a lifecycle operation: synchronously, or as job of executor, so the tick does not wait for it
+
+    :param executor: hcloud_lifecycle.LifecycleExecutor or None
+    :param journal: hcloud_journal.Journal, which records the steps of the operation, or None
+    :param token: IMAGE_TOKEN of the server
+    :param operation: start, resume, rescale, hibernate or destroy
+    :param running_after: True, if the server should run after the operation
+    :param function: hcloud_automation function of the operation
+    :param wanted_server_type: wanted server_type of start and rescale
+    :param kwargs: arguments of function
+    :return: result of function; None, if it was submitted to executor
+    """
+    listener = journal.record_job if journal is not None else None
+    if executor is None:
+        job = hcloud_lifecycle.LifecycleJob(token, operation, running_after, server_type=wanted_server_type,
+                                            listener=listener)
+        try:
+            result = function(progress=job.progress, **kwargs)
+        except Exception:
+            job.finish(False)
+            raise
+        job.finish(result)
+        _finish_operation(token, operation, result, server_type=wanted_server_type, journal=journal)
+        return result
+    executor.submit(token, operation, running_after, function, wanted_server_type=wanted_server_type,
+                    listener=listener, **kwargs)
+    return None
+
+
+def _resume_interrupted_job(client: Client, executor, journal: hcloud_journal.Journal, snapshot_token: str,
+                            server_should_run: bool, resources: hcloud_automation.ResourceState, entry: dict = None):
+    """Continue a lifecycle job, which was interrupted by a restart, from its journaled step
+
+    A destroy interrupted while snapshotting waits for its journaled snapshot action, then it deletes the server (and
+    cleans up old snapshots), like one interrupted while deleting; a start interrupted while creating waits for its
+    journaled create action, then it assigns the floating ip, like one interrupted while assigning it. Both are only
+    continued, if the schedule still wants their outcome. All other interrupted jobs are abandoned and the normal
+    reconciliation, with a health check, repeats what is missing.
+
+    :return: None, if there was no interrupted job; True, if it is continued; False, if it was abandoned
+    """
+    interrupted = journal.get_interrupted_job(snapshot_token)
+    if interrupted is None:
+        return None
+    logger.warning("'" + snapshot_token + "' " + interrupted["operation"] + " was interrupted in step " +
+                   interrupted["state"])
+    details = interrupted["details"]
+
+    if interrupted["operation"] == "destroy" and not server_should_run and \
+            (interrupted["state"] == hcloud_lifecycle.DELETING or
+             (interrupted["state"] == hcloud_lifecycle.SNAPSHOTTING and "action_id" in details)):
+        logger.info("'" + snapshot_token + "' Action: CONTINUE destroy with " + interrupted["state"])
+        if interrupted["state"] == hcloud_lifecycle.SNAPSHOTTING:
+            snapshot_id, action_id = details.get("image_id"), details["action_id"]
+        else:
+            snapshot_id, action_id = details.get("snapshot_id"), None
+        _run_operation(executor, journal, snapshot_token, "destroy", False, hcloud_automation.resume_destroy,
+                       client=client, snapshot_token=snapshot_token, snapshot_id=snapshot_id, action_id=action_id,
+                       resources=resources, entry=entry)
+        return True
+    if interrupted["operation"] == "start" and server_should_run and \
+            (interrupted["state"] == hcloud_lifecycle.ASSIGNING_IP or
+             (interrupted["state"] == hcloud_lifecycle.CREATING and "action_id" in details)):
+        logger.info("'" + snapshot_token + "' Action: CONTINUE start with " + interrupted["state"])
+        _run_operation(executor, journal, snapshot_token, "start", True, hcloud_automation.resume_start,
+                       wanted_server_type=interrupted.get("server_type", ''), client=client,
+                       snapshot_token=snapshot_token,
+                       action_id=details["action_id"] if interrupted["state"] == hcloud_lifecycle.CREATING else None,
+                       resources=resources)
+        return True
+
+    journal.abandon_job(snapshot_token)
+    return False
+
+
+def reconcile(client: Client, entry: dict = None, server_is_running: bool = False,
+              server_is_running_as: str = '', cache_token: str = None, health_check: bool = False,
+              executor: hcloud_lifecycle.LifecycleExecutor = None, journal: hcloud_journal.Journal = None) -> tuple:
+    """Run one should-run/is-running reconciliation for one calendar/server entry
+
+    :param client: instance of hcloud.client()
+    :type client: hcloud.Client()
+    :param entry: dict with IMAGE_TOKEN, ICAL_URL and optional overrides of the values in config.py;
+    if None, config.py is used as is
+    :type entry: dict
+    :param server_is_running: last known running state of the server
+    :param server_is_running_as: last known server_type of the server
+    :param cache_token: token used to name the calendar cache file; defaults to IMAGE_TOKEN.
+    entries sharing the same calendar can share one cache file and download this way
+    :param health_check: if True, the last known state is checked against the hcloud api first
+    :param executor: if given, start, destroy, hibernate, resume and rescale run as jobs of this
+    hcloud_lifecycle.LifecycleExecutor and the tick returns at once; while a job runs, it is cancelled, if the
+    schedule no longer wants its outcome, and the tick is repeated every LIFECYCLE_POLL_INTERVAL seconds
+    :param journal: if given, desired and observed state and the steps of every lifecycle operation are recorded in
+    this hcloud_journal.Journal; on the first tick after a start, an interrupted operation is continued from it
+    :return: new server_is_running and server_is_running_as; in addition: seconds until the next reconciliation
+    :rtype: tuple
+    """
+    token = get_setting(entry, "IMAGE_TOKEN")
+    with hcloud_metrics.TICK_SECONDS.time(token=token), hcloud_tracing.tick("reconcile", token=token):
+        return _reconcile(client, entry=entry, server_is_running=server_is_running,
+                          server_is_running_as=server_is_running_as, cache_token=cache_token,
+                          health_check=health_check, executor=executor, journal=journal)
+
+
+def _reconcile(client: Client, entry: dict = None, server_is_running: bool = False,
+               server_is_running_as: str = '', cache_token: str = None, health_check: bool = False,
+               executor: hcloud_lifecycle.LifecycleExecutor = None, journal: hcloud_journal.Journal = None) -> tuple:
+    """see reconcile"""
+    snapshot_token = get_setting(entry, "IMAGE_TOKEN")
+    timeslice_grid_interval = get_setting(entry, "TIMESLICE_GRID_INTERVAL")
+    timezone_name = get_setting(entry, "TIMEZONE_NAME")
+
+    if cache_token is None:
+        cache_token = snapshot_token
+
+    ical_data = hcloud_calendar.get_ical_data(url=get_setting(entry, "ICAL_URL"), token=cache_token)
+
+    start_advanced_time = get_setting(entry, "START_ADVANCED_TIME")
+    if get_setting(entry, "ADAPTIVE_START_ADVANCED_TIME", False):
+        # learned from recorded server bring-up durations, START_ADVANCED_TIME is used until there are enough
+        start_advanced_time = hcloud_history.get_start_advanced_times(
+            location=get_setting(entry, "SERVER_LOCATION", None),
+            percent=get_setting(entry, "ADAPTIVE_START_PERCENTILE", 90),
+            default=start_advanced_time)
+
+    schedule = hcloud_calendar.get_rolling_schedule(
+        ical_data=ical_data,
+        name=snapshot_token,
+        timeslice_grid_interval=timeslice_grid_interval,
+        start_advanced_time=start_advanced_time,
+        end_lag_time=get_setting(entry, "END_LAG_TIME"),
+        timezone_name=timezone_name,
+        horizon_days=get_setting(entry, "SCHEDULE_HORIZON_DAYS", 1),
+        min_gap=get_setting(entry, "SMOOTH_MIN_GAP", 0),
+        min_run=get_setting(entry, "SMOOTH_MIN_RUN", 0),
+        unify_server_type=get_setting(entry, "SMOOTH_UNIFY_SERVER_TYPE", False),
+        # the expanded calendar is stored next to the cache_file, so a restart does not parse it again
+        compiled_file=snapshot_token + ".schedule" if get_setting(entry, "COMPILED_SCHEDULE", True) else None)
+
+    server_should_run, server_should_run_as = hcloud_calendar.check_schedule_should_run_now(
+        schedule, timezone_name=timezone_name, timeslice_grid_interval=timeslice_grid_interval)
+
+    # the schedule is large, it is only dumped every LOG_GRID_DUMP_INTERVAL seconds
+    if hcloud_logging.should_dump_grid(snapshot_token):
+        logger.debug("'%s' schedule from %s, every %s seconds: %s %s", snapshot_token,
+                     datetime.datetime.fromtimestamp(schedule.datetime.start), schedule.interval,
+                     "".join("1" if run else "0" for run in schedule.timeslice),
+                     sorted(set(schedule.server_types[idx] for idx in schedule.server_type)))
+
+    seconds_until_next_tick = get_seconds_until_next_tick(
+        schedule, max_sleep_time=get_setting(entry, "MAX_SLEEP_TIME", MAX_SLEEP_TIME))
+    lifecycle_poll_interval = get_setting(entry, "LIFECYCLE_POLL_INTERVAL", hcloud_lifecycle.POLL_INTERVAL)
+
+    if journal is not None and snapshot_token not in _journal_checked:
+        _journal_checked.add(snapshot_token)
+        _load_journaled_state(journal, snapshot_token)
+        resumed = _resume_interrupted_job(client, executor, journal, snapshot_token, server_should_run,
+                                          hcloud_automation.ResourceState(client, snapshot_token=snapshot_token),
+                                          entry=entry)
+        if resumed is not None:
+            # continued or abandoned, the server state is unknown after the restart
+            health_check = True
+            if resumed and executor is not None:
+                return server_is_running, server_is_running_as, min(seconds_until_next_tick, lifecycle_poll_interval)
+
+    if executor is not None:
+        job = executor.get(snapshot_token)
+        if job is not None and not job.done():
+            if job.running_after != server_should_run and not job.cancel_requested.is_set():
+                logger.info("'" + snapshot_token + "' server_should_run is " + str(server_should_run) +
+                            " now, Action: CANCEL " + job.operation + " (" + job.state + ")")
+                job.cancel()
+            logger.debug("'%s' Action: WAIT for %s (%s)", snapshot_token, job.operation, job.state)
+            if journal is not None:
+                journal.update(snapshot_token, desired=[bool(server_should_run), server_should_run_as])
+            return server_is_running, server_is_running_as, min(seconds_until_next_tick, lifecycle_poll_interval)
+        job = executor.pop_finished(snapshot_token)
+        if job is not None:
+            _finish_operation(snapshot_token, job.operation,
+                              hcloud_lifecycle.CANCELLED if job.state == hcloud_lifecycle.CANCELLED else job.result,
+                              server_type=job.server_type, journal=journal)
+            # the job changed the server, its state is read again
+            health_check = True
+
+    # all hcloud_automation calls of this tick share one ResourceState
+    resources = hcloud_automation.ResourceState(client, snapshot_token=snapshot_token)
+
+    if health_check:
+        logger.debug("'" + snapshot_token + "' health check of server state...")
+        server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(client, snapshot_token=snapshot_token, resources=resources)
+
+    logger.debug("server_should_run: %s", server_should_run)
+    logger.debug("server_is_running: %s", server_is_running)
+    logger.debug("server_should_run_as: %s", server_should_run_as)
+    logger.debug("server_is_running_as %s", server_is_running_as)
+
+    if server_should_run:
+        _set_hibernating(journal, snapshot_token, False)
+        if not server_is_running:
+            server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(client, snapshot_token=snapshot_token, resources=resources)
+
+            if server_is_running:
+                logger.debug("'%s' should run now, and it IS running", snapshot_token)
+                logger.debug("'%s' Action: NONE", snapshot_token)
+            elif hcloud_automation.first_server_is_powered_off(client, snapshot_token=snapshot_token, resources=resources):
+                logger.info("'" + snapshot_token + "' should run now, but it IS powered off")
+                logger.info("'" + snapshot_token + "' Action: POWER ON Server...")
+                if _run_operation(executor, journal, snapshot_token, "resume", True,
+                                  hcloud_automation.first_server_power_on, client=client, snapshot_token=snapshot_token, resources=resources) is not None:
+                    server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(
+                        client, snapshot_token=snapshot_token, resources=resources)
+            else:
+                logger.info("'" + snapshot_token + "' should run now, but it IS NOT running")
+                logger.info("'" + snapshot_token + "' Action: START Server...")
+                if _run_operation(executor, journal, snapshot_token, "start", True,
+                                  hcloud_automation.create_server_from_snapshot,
+                                  wanted_server_type=server_should_run_as,
+                                  client=client, snapshot_token=snapshot_token,
+                                  override_server_type=server_should_run_as, resources=resources) is not None:
+                    server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(
+                        client, snapshot_token=snapshot_token, resources=resources)
+        elif server_should_run_as != '' and server_should_run_as != server_is_running_as and \
+                get_setting(entry, "RESCALE_IN_PLACE", False) and \
+                _failed_rescales.get(snapshot_token) != server_should_run_as:
+            logger.info("'" + snapshot_token + "' should run as " + server_should_run_as + ", but it IS running as " + server_is_running_as)
+            logger.info("'" + snapshot_token + "' Action: RESCALE Server...")
+            if _run_operation(executor, journal, snapshot_token, "rescale", True,
+                              hcloud_automation.rescale_first_server, wanted_server_type=server_should_run_as, client=client, snapshot_token=snapshot_token,
+                              server_type=server_should_run_as,
+                              upgrade_disk=get_setting(entry, "RESCALE_UPGRADE_DISK", False),
+                              resources=resources) is not None:
+                server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(
+                    client, snapshot_token=snapshot_token, resources=resources)
+        else:
+            logger.debug("'%s' should run now, and it IS running", snapshot_token)
+            logger.debug("'%s' Action: NONE", snapshot_token)
+
+    elif not server_should_run:
+        if server_is_running:
+            server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(client, snapshot_token=snapshot_token, resources=resources)
+
+            if server_is_running:
+                logger.info("'" + snapshot_token + "' should NOT run now, but it IS running")
+                stop_action = choose_stop_action(get_seconds_until_next_start(schedule), entry=entry)
+                logger.info("'" + snapshot_token + "' Action: " + stop_action + " Server")
+
+                if stop_action == STOP_KEEP_RUNNING:
+                    pass
+                elif stop_action == STOP_POWER_OFF:
+                    if _run_operation(executor, journal, snapshot_token, "hibernate", False,
+                                      hcloud_automation.first_server_power_off, client=client,
+                                      snapshot_token=snapshot_token, resources=resources):
+                        server_is_running = False
+                        server_is_running_as = ''
+                elif _run_operation(executor, journal, snapshot_token, "destroy", False,
+                                    hcloud_automation.destroy_first_server, client=client, snapshot_token=snapshot_token, resources=resources,
+                                    entry=entry) is not None:
+                    server_is_running = False
+                    server_is_running_as = ''
+
+            else:
+                logger.debug("'%s' should NOT run now and it IS NOT running", snapshot_token)
+                logger.debug("'%s' Action: NONE", snapshot_token)
+        elif snapshot_token in _hibernating or (health_check and hcloud_automation.first_server_is_powered_off(
+                client, snapshot_token=snapshot_token, resources=resources)):
+            # a powered off server is destroyed, once the gap until its next start is too long to wait for it
+            _set_hibernating(journal, snapshot_token, True)
+            if choose_stop_action(get_seconds_until_next_start(schedule), entry=entry) == STOP_DESTROY:
+                logger.info("'" + snapshot_token + "' should NOT run now and it IS powered off")
+                logger.info("'" + snapshot_token + "' Action: DESTROY Server")
+                _run_operation(executor, journal, snapshot_token, "destroy", False,
+                               hcloud_automation.destroy_first_server, client=client, snapshot_token=snapshot_token, resources=resources,
+                               entry=entry)
+            else:
+                logger.debug("'%s' should NOT run now and it IS powered off", snapshot_token)
+                logger.debug("'%s' Action: NONE", snapshot_token)
+        else:
+            logger.debug("'%s' should NOT run now and it IS NOT running", snapshot_token)
+            logger.debug("'%s' Action: NONE", snapshot_token)
+    else:
+        logger.error("Panic")
+
+    if executor is not None and executor.get(snapshot_token) is not None:
+        # a job was submitted, its progress is checked soon
+        seconds_until_next_tick = min(seconds_until_next_tick, lifecycle_poll_interval)
+    if journal is not None:
+        journal.record_state(snapshot_token, server_should_run, server_should_run_as, server_is_running,
+                             server_is_running_as, confirmed=health_check)
+    return server_is_running, server_is_running_as, seconds_until_next_tick
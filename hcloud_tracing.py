@@ -0,0 +1,197 @@
+from contextlib import contextmanager
+import cProfile
+import functools
+import json
+import os
+import signal
+import threading
+import time
+import logging
+
+logger = logging.getLogger("Application")
+
+TRACE_FILE = None
+''' spans are appended to this file as json lines; None disables tracing '''
+PROFILE_TRIGGER_FILE = "profile.trigger"
+''' if this file exists, the next ticks are profiled; it may contain the number of ticks (default 1) '''
+PROFILE_DIRECTORY = "."
+''' profile-*.prof files are stored here, read them with python -m pstats '''
+_state = threading.local()
+''' per thread: stack of open spans and finished spans of the current trace '''
+_write_lock = threading.Lock()
+_profile_lock = threading.Lock()
+''' only one tick is profiled at once, cProfile can not profile several threads at the same time '''
+_profile_ticks = 0
+''' number of ticks still to profile '''
+_signalled_ticks = 0
+''' number of ticks requested by SIGUSR1, taken over by the next tick '''
+
+
+def configure(config):
+    """
+    Read TRACE_FILE, PROFILE_TRIGGER_FILE and PROFILE_DIRECTORY from config and profile on SIGUSR1
+
+    :param config: the config module
+    """
+    global TRACE_FILE, PROFILE_TRIGGER_FILE, PROFILE_DIRECTORY
+    TRACE_FILE = getattr(config, "TRACE_FILE", TRACE_FILE)
+    PROFILE_TRIGGER_FILE = getattr(config, "PROFILE_TRIGGER_FILE", PROFILE_TRIGGER_FILE)
+    PROFILE_DIRECTORY = getattr(config, "PROFILE_DIRECTORY", PROFILE_DIRECTORY)
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, _on_profile_signal)
+
+
+def _on_profile_signal(signum, frame):
+    global _signalled_ticks
+    # only the counter is set, logging from a signal handler can deadlock on the locks of the handlers
+    _signalled_ticks = 1
+
+
+def _new_id(length: int) -> str:
+    return os.urandom(length).hex()
+
+
+def _write(spans: list):
+    try:
+        with _write_lock:
+            with open(TRACE_FILE, "a") as file:
+                for record in spans:
+                    file.write(json.dumps(record) + "\n")
+    except:
+        logger.warning("Could not write spans to " + str(TRACE_FILE))
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Record the with-block as span; spans opened inside are its children, the outermost span starts a new trace
+
+    Records follow the OTLP span fields (traceId, spanId, parentSpanId, name, startTimeUnixNano, endTimeUnixNano,
+    attributes, status). All spans of a trace are written at once, when the outermost span ends.
+
+    :param name: name of the span, e.g. "hcloud_calendar.get_ical_data"
+    :param attributes: additional attributes, e.g. token
+    """
+    if TRACE_FILE is None:
+        yield
+        return
+
+    stack = getattr(_state, "stack", None)
+    if not stack:
+        stack = _state.stack = []
+        _state.finished = []
+        _state.trace_id = _new_id(16)
+
+    record = {
+        "traceId": _state.trace_id,
+        "spanId": _new_id(8),
+        "parentSpanId": stack[-1]["spanId"] if stack else "",
+        "name": name,
+        "startTimeUnixNano": time.time_ns(),
+        "attributes": {key: str(value) for key, value in attributes.items()},
+        "status": "OK",
+    }
+    stack.append(record)
+    try:
+        yield
+    except BaseException as e:
+        record["status"] = "ERROR"
+        record["attributes"]["exception"] = type(e).__name__
+        raise
+    finally:
+        record["endTimeUnixNano"] = time.time_ns()
+        stack.pop()
+        _state.finished.append(record)
+        if not stack:
+            _write(_state.finished)
+            _state.finished = []
+
+
+def traced(function):
+    """
+    Decorator, which records every call of function as span named module.function
+    """
+    name = function.__module__ + "." + function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if TRACE_FILE is None:
+            return function(*args, **kwargs)
+        with span(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def request_profile(ticks: int = 1):
+    """
+    Profile the next ticks
+
+    :param ticks: number of ticks to profile
+    """
+    global _profile_ticks
+    _profile_ticks = max(_profile_ticks, ticks)
+    logger.info("profiling the next " + str(ticks) + " ticks")
+
+
+def _check_signal():
+    global _signalled_ticks
+    if _signalled_ticks > 0:
+        ticks = _signalled_ticks
+        _signalled_ticks = 0
+        request_profile(ticks)
+
+
+def _check_trigger_file():
+    if not PROFILE_TRIGGER_FILE or not os.path.exists(PROFILE_TRIGGER_FILE):
+        return
+    try:
+        with open(PROFILE_TRIGGER_FILE) as file:
+            content = file.read().strip()
+        os.remove(PROFILE_TRIGGER_FILE)
+        request_profile(int(content) if content else 1)
+    except:
+        logger.warning("Could not read " + PROFILE_TRIGGER_FILE)
+
+
+@contextmanager
+def tick(name: str = "tick", **attributes):
+    """
+    Span for one tick of the control loop, profiled with cProfile if requested by request_profile, SIGUSR1 or
+    PROFILE_TRIGGER_FILE
+
+    :param name: name of the span and prefix of the profile file
+    :param attributes: additional attributes of the span, e.g. token
+    """
+    global _profile_ticks
+    _check_signal()
+    _check_trigger_file()
+
+    profile = None
+    if _profile_ticks > 0 and _profile_lock.acquire(blocking=False):
+        if _profile_ticks > 0:
+            _profile_ticks -= 1
+            profile = cProfile.Profile()
+        else:
+            _profile_lock.release()
+
+    try:
+        with span(name, **attributes):
+            if profile is None:
+                yield
+            else:
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+    finally:
+        if profile is not None:
+            path = os.path.join(PROFILE_DIRECTORY, "profile-" + name + "-" + time.strftime("%Y%m%d-%H%M%S") + "-" +
+                                str(threading.get_ident()) + ".prof")
+            try:
+                profile.dump_stats(path)
+                logger.info("profile stored in " + path)
+            except:
+                logger.warning("Could not store profile in " + path)
+            _profile_lock.release()
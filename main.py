@@ -2,6 +2,12 @@ from hcloud import Client
 import hcloud_automation
 import config
 import hcloud_calendar
+import hcloud_journal
+import hcloud_lifecycle
+import hcloud_logging
+import hcloud_metrics
+import hcloud_reconcile
+import hcloud_tracing
 import time
 import os
 
@@ -11,6 +17,7 @@ logging.basicConfig(filename='error.log',
                     level=logging.DEBUG,
                     format='[%(filename)s:%(lineno)s - %(funcName)20s() ] %(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("Application")
+hcloud_logging.setup(config)
 
 logger.info("start processing...")
 logger.info("working-directory is " + os.getcwd())
@@ -18,73 +25,47 @@ logger.info("working-directory is " + os.getcwd())
 print("start processing...")
 print("working-directory is " + os.getcwd())
 
-client = Client(token=config.API_TOKEN, poll_interval=config.HCLOUD_POOL_INTERVAL)
+client = hcloud_metrics.instrument_client(Client(token=config.API_TOKEN, poll_interval=config.HCLOUD_POOL_INTERVAL))
+hcloud_metrics.start(config)
+hcloud_tracing.configure(config)
 
-# get server-state during Start
-server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(client, snapshot_token=config.IMAGE_TOKEN)
+health_check_interval = getattr(config, "HEALTH_CHECK_INTERVAL", hcloud_reconcile.HEALTH_CHECK_INTERVAL)
+
+# get server-state during Start, from the journal if it is recent enough and nothing was interrupted
+journal = hcloud_journal.open_journal(config)
+observed = journal.get_observed(config.IMAGE_TOKEN, max_age=health_check_interval) if journal is not None else None
+if observed is not None:
+    server_is_running, server_is_running_as = observed
+    logger.info("server-state from journal: " + str(server_is_running) + " " + server_is_running_as)
+else:
+    server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(client, snapshot_token=config.IMAGE_TOKEN)
+
+# start, destroy, hibernate, resume and rescale run in the background, so the loop keeps following the calendar
+lifecycle_executor = None
+if getattr(config, "LIFECYCLE_NON_BLOCKING", True):
+    lifecycle_executor = hcloud_lifecycle.LifecycleExecutor(
+        max_workers=getattr(config, "LIFECYCLE_MAX_WORKERS", hcloud_lifecycle.MAX_WORKERS))
+
+next_health_check = time.monotonic() + health_check_interval
 
 try:
     while True:
 
-        ical_data = hcloud_calendar.get_ical_data(url=config.ICAL_URL, token=config.IMAGE_TOKEN)
-
-        grid_datetime, grid_timeslice, grid_server_type = hcloud_calendar.get_datetime_and_timeslice_grid_for_now(
-            ical_data=ical_data,
-            timeslice_grid_interval=config.TIMESLICE_GRID_INTERVAL,
-            start_advanced_time=config.START_ADVANCED_TIME,
-            end_lag_time=config.END_LAG_TIME,
-            timezone_name=config.TIMEZONE_NAME)
-
-        server_should_run, server_should_run_as = hcloud_calendar.check_should_run_now(grid_datetime=grid_datetime,
-                                                                 grid_timeslice=grid_timeslice,
-                                                                 grid_server_type=grid_server_type,
-                                                                 timeslice_grid_interval=config.TIMESLICE_GRID_INTERVAL)
-
-        logger.debug("server_should_run: " + str(server_should_run))
-        logger.debug("server_is_running: " + str(server_is_running))
-        logger.debug("server_should_run_as: " + str(server_should_run_as))
-        logger.debug('server_is_running_as ' + server_is_running_as)
-
-        if server_should_run:
-            if not server_is_running:
-                server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(client, snapshot_token=config.IMAGE_TOKEN)
-
-                if server_is_running:
-                    logger.debug("'" + config.IMAGE_TOKEN + "' should run now, and it IS running")
-                    logger.debug("'" + config.IMAGE_TOKEN + "' Action: NONE")
-                else:
-                    logger.info("'" + config.IMAGE_TOKEN + "' should run now, but it IS NOT running")
-                    logger.info("'" + config.IMAGE_TOKEN + "' Action: START Server...")
-                    logger.info(hcloud_automation.create_server_from_snapshot(client, snapshot_token=config.IMAGE_TOKEN, override_server_type=server_should_run_as))
-                    server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(
-                        client, snapshot_token=config.IMAGE_TOKEN)
-            else:
-                logger.debug("'" + config.IMAGE_TOKEN + "' should run now, and it IS running")
-                logger.debug("'" + config.IMAGE_TOKEN + "' Action: NONE")
-
-        elif not server_should_run:
-            if server_is_running:
-                server_is_running, server_is_running_as = hcloud_automation.first_server_is_running_or_starting(client, snapshot_token=config.IMAGE_TOKEN)
-
-                if server_is_running:
-                    logger.info("'" + config.IMAGE_TOKEN + "' should NOT run now, but it IS running")
-                    logger.info("'" + config.IMAGE_TOKEN + "' Action: DESTROY Server")
-
-                    logger.info(hcloud_automation.destroy_first_server(client=client, snapshot_token=config.IMAGE_TOKEN))
-                    server_is_running = False
-                    server_is_running_as = ''
-
-                else:
-                    logger.debug("'" + config.IMAGE_TOKEN + "' should NOT run now and it IS NOT running")
-                    logger.debug("'" + config.IMAGE_TOKEN + "' Action: NONE")
-            else:
-                logger.debug("'" + config.IMAGE_TOKEN + "' should NOT run now and it IS NOT running")
-                logger.debug("'" + config.IMAGE_TOKEN + "' Action: NONE")
-        else:
-            logger.error("Panic")
-
-        logger.debug("'" + config.IMAGE_TOKEN + "' wait 60 seconds...")
-        time.sleep(60)
+        health_check = time.monotonic() >= next_health_check
+        if health_check:
+            next_health_check = time.monotonic() + health_check_interval
+
+        server_is_running, server_is_running_as, seconds_until_next_tick = hcloud_reconcile.reconcile(
+            client, server_is_running=server_is_running, server_is_running_as=server_is_running_as,
+            health_check=health_check, executor=lifecycle_executor, journal=journal)
+        hcloud_metrics.write(config)
+
+        # sleep until the next transition of the schedule, a changed calendar-source or the next health check
+        seconds_until_next_tick = min(seconds_until_next_tick, max(next_health_check - time.monotonic(), 0))
+        logger.debug("'%s' wait %d seconds...", config.IMAGE_TOKEN, seconds_until_next_tick)
+        if hcloud_calendar.calendar_changed.wait(timeout=seconds_until_next_tick):
+            logger.debug("'" + config.IMAGE_TOKEN + "' calendar-source changed")
+            hcloud_calendar.calendar_changed.clear()
 
 except SystemExit:
     logger.info("stopped processing")
@@ -96,3 +77,8 @@ except KeyboardInterrupt:
 
 except:
     logger.error("Something during processing went wrong")
+
+finally:
+    if lifecycle_executor is not None:
+        logger.info("waiting for running lifecycle jobs...")
+        lifecycle_executor.shutdown(wait=True)
@@ -1,9 +1,6 @@
-from hcloud import Client
-import hcloud_automation
-import config
+import sys
 
-client = Client(token=config.API_TOKEN, poll_interval=config.HCLOUD_POOL_INTERVAL)
+import cli
 
-hcloud_automation.first_server_assign_floating_ip(
-    client,
-    snapshot_token=config.IMAGE_TOKEN)
+# kept for existing setups, see cli.py assign-floating-ip
+sys.exit(cli.main(["assign-floating-ip"]))
@@ -1,7 +1,6 @@
-from hcloud import Client
-import hcloud_automation
-import config
+import sys
 
-client = Client(token=config.API_TOKEN, poll_interval=config.HCLOUD_POOL_INTERVAL)
+import cli
 
-hcloud_automation.create_server_from_snapshot(client, snapshot_token=config.IMAGE_TOKEN)
+# kept for existing setups, see cli.py create
+sys.exit(cli.main(["create"]))
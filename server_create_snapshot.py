@@ -1,7 +1,6 @@
-from hcloud import Client
-import hcloud_automation
-import config
+import sys
 
-client = Client(token=config.API_TOKEN, poll_interval=config.HCLOUD_POOL_INTERVAL)
+import cli
 
-snapshot_created, image_id = hcloud_automation.create_snapshot_for_first_server(client, snapshot_token=config.IMAGE_TOKEN)
+# kept for existing setups, see cli.py snapshot
+sys.exit(cli.main(["snapshot"]))
@@ -1,8 +1,6 @@
-from hcloud import Client 
+import sys
 
-import hcloud_automation
-import config
+import cli
 
-client = Client(token=config.API_TOKEN, poll_interval=config.HCLOUD_POOL_INTERVAL)
-
-hcloud_automation.destroy_first_server(client, snapshot_token=config.IMAGE_TOKEN)
\ No newline at end of file
+# kept for existing setups, see cli.py destroy
+sys.exit(cli.main(["destroy"]))
@@ -1,10 +1,6 @@
-from hcloud import Client 
+import sys
 
-import hcloud_automation
-import config
+import cli
 
-client = Client(token=config.API_TOKEN, poll_interval=config.HCLOUD_POOL_INTERVAL)
-
-hcloud_automation.first_server_power_off(
-    client,
-    snapshot_token=config.IMAGE_TOKEN)
+# kept for existing setups, see cli.py shutdown
+sys.exit(cli.main(["shutdown"]))
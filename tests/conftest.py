@@ -0,0 +1,17 @@
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# the modules import config.py, which is created by install.py; the tests run against a minimal stand-in
+if "config" not in sys.modules:
+    config = types.ModuleType("config")
+    config.API_TOKEN = "fake"
+    config.IMAGE_TOKEN = "test"
+    config.HCLOUD_POOL_INTERVAL = 0.1
+    config.ACTION_MIN_POLL_INTERVAL = 0.05
+    config.SHUTDOWN_TIMEOUT = 5
+    sys.modules["config"] = config
@@ -0,0 +1,155 @@
+import gzip
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+import hcloud_calendar
+
+ICAL = b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nEND:VCALENDAR\r\n"
+ICAL_CHANGED = b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:changed\r\nEND:VCALENDAR\r\n"
+
+
+class CalendarSource:
+    """calendar-source on localhost, which answers conditional requests like a real one"""
+
+    def __init__(self):
+        self.body = ICAL
+        self.etag = '"1"'
+        self.last_modified = "Mon, 01 Jan 2024 00:00:00 GMT"
+        self.gzip = False
+        self.requests = []
+        ''' headers of every request '''
+        source = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                source.requests.append(dict(self.headers))
+                # like RFC 7232, If-Modified-Since only counts without If-None-Match
+                if self.headers.get("If-None-Match") is not None:
+                    not_modified = self.headers["If-None-Match"] == source.etag
+                else:
+                    not_modified = self.headers.get("If-Modified-Since") == source.last_modified
+                if not_modified:
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = source.body
+                self.send_response(200)
+                if source.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gzip.compress(body)
+                    self.send_header("Content-Encoding", "gzip")
+                if source.etag:
+                    self.send_header("ETag", source.etag)
+                if source.last_modified:
+                    self.send_header("Last-Modified", source.last_modified)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:" + str(self.server.server_address[1]) + "/calendar.ics"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    hcloud_calendar.calendar_changed.clear()
+    source = CalendarSource()
+    yield source
+    source.stop()
+
+
+def _unreachable_url() -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return "http://127.0.0.1:" + str(sock.getsockname()[1]) + "/calendar.ics"
+
+
+def _age(cache_file: str, seconds: float):
+    mtime = time.time() - seconds
+    os.utime(cache_file, (mtime, mtime))
+
+
+def test_fetch_stores_validators_and_reuses_copy_on_304(source):
+    assert hcloud_calendar._fetch_calendar_source(source.url, "token.cache") == ICAL
+    assert hcloud_calendar._read_cache_meta("token.cache") == {"etag": source.etag,
+                                                              "last_modified": source.last_modified}
+    _age("token.cache", 2 * 60 * 60)
+
+    assert hcloud_calendar._fetch_calendar_source(source.url, "token.cache") == ICAL
+    assert source.requests[-1]["If-None-Match"] == source.etag
+    assert source.requests[-1]["If-Modified-Since"] == source.last_modified
+    # the 304 resets the age of the cached copy
+    assert time.time() - Path("token.cache").stat().st_mtime < 60
+    assert not hcloud_calendar.calendar_changed.is_set()
+
+
+def test_fetch_revalidates_with_last_modified_only(source):
+    source.etag = None
+    hcloud_calendar._fetch_calendar_source(source.url, "token.cache")
+
+    assert hcloud_calendar._fetch_calendar_source(source.url, "token.cache") == ICAL
+    assert "If-None-Match" not in source.requests[-1]
+    assert source.requests[-1]["If-Modified-Since"] == source.last_modified
+
+
+def test_fetch_decompresses_gzip(source):
+    source.gzip = True
+    assert hcloud_calendar._fetch_calendar_source(source.url, "token.cache") == ICAL
+    assert source.requests[-1]["Accept-Encoding"] == "gzip"
+    assert Path("token.cache").read_bytes() == ICAL
+
+
+def test_fetch_sets_calendar_changed_only_for_new_content(source):
+    hcloud_calendar._fetch_calendar_source(source.url, "token.cache")
+    assert not hcloud_calendar.calendar_changed.is_set()
+
+    source.body, source.etag = ICAL_CHANGED, '"2"'
+    assert hcloud_calendar._fetch_calendar_source(source.url, "token.cache") == ICAL_CHANGED
+    assert hcloud_calendar.calendar_changed.is_set()
+    assert hcloud_calendar._read_cache_meta("token.cache")["etag"] == '"2"'
+
+
+def test_stale_copy_is_returned_and_refreshed_in_background(source):
+    Path("token.cache").write_bytes(ICAL)
+    _age("token.cache", 2 * 60 * 60)
+    source.body = ICAL_CHANGED
+
+    assert hcloud_calendar.get_ical_data(source.url, token="token") == ICAL
+    hcloud_calendar.wait_for_background_refreshes()
+    assert Path("token.cache").read_bytes() == ICAL_CHANGED
+    assert hcloud_calendar.calendar_changed.is_set()
+
+
+def test_stale_copy_is_kept_if_source_is_unreachable(source):
+    Path("token.cache").write_bytes(ICAL)
+    _age("token.cache", 2 * 60 * 60)
+
+    assert hcloud_calendar.get_ical_data(_unreachable_url(), token="token") == ICAL
+    hcloud_calendar.wait_for_background_refreshes()
+    assert Path("token.cache").read_bytes() == ICAL
+    assert not hcloud_calendar.calendar_changed.is_set()
+
+
+def test_too_old_copy_is_not_used_if_source_is_unreachable(source):
+    Path("token.cache").write_bytes(ICAL)
+    _age("token.cache", 4 * 60 * 60)
+
+    with pytest.raises(Exception):
+        hcloud_calendar.get_ical_data(_unreachable_url(), token="token")
@@ -0,0 +1,88 @@
+import time
+
+import pytest
+from hcloud import Client
+
+import hcloud_automation
+import hcloud_journal
+import hcloud_lifecycle
+import hcloud_reconcile
+from fake_hcloud_api import FakeHcloudApi
+
+LABELS = {"token": "test", "server_type": "cx11", "server_name": "app", "server_location": "nbg1"}
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = FakeHcloudApi(action_delays={"create_image": 0.5})
+    api.start()
+    yield api
+    api.stop()
+
+
+def _interrupted_job(operation: str, state: str, running_after: bool, **details) -> dict:
+    return {"operation": operation, "state": state, "started": time.time(), "running_after": running_after,
+            "server_type": "", "details": details}
+
+
+def test_journal_survives_a_restart_and_ignores_a_torn_line(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = hcloud_journal.Journal(path)
+    job = hcloud_lifecycle.LifecycleJob("test", "destroy", False, listener=journal.record_job)
+    job.progress(hcloud_lifecycle.SNAPSHOTTING, action_id=7, image_id=8)
+    with open(path, "a") as file:
+        file.write('{"token": "test", "job": ')
+
+    restarted = hcloud_journal.Journal(path)
+    interrupted = restarted.get_interrupted_job("test")
+    assert interrupted["operation"] == "destroy"
+    assert interrupted["state"] == hcloud_lifecycle.SNAPSHOTTING
+    assert interrupted["details"] == {"action_id": 7, "image_id": 8}
+
+    restarted.abandon_job("test")
+    assert hcloud_journal.Journal(path).get_interrupted_job("test") is None
+
+
+def test_finished_job_is_not_interrupted(tmp_path):
+    journal = hcloud_journal.Journal(str(tmp_path / "journal.jsonl"))
+    job = hcloud_lifecycle.LifecycleJob("test", "start", True, listener=journal.record_job)
+    job.progress(hcloud_lifecycle.CREATING, action_id=7)
+    job.finish(True)
+
+    assert journal.get_interrupted_job("test") is None
+
+
+def test_destroy_interrupted_while_snapshotting_is_continued(api, tmp_path):
+    client = Client(token="fake", api_endpoint=api.url, poll_interval=0.1)
+    api.add_server("app", dict(LABELS), status="off")
+    server = client.servers.get_all(label_selector="token=test")[0]
+    response = server.create_image(description="creation was automated for token test", type="snapshot",
+                                   labels=dict(LABELS))
+    journal = hcloud_journal.Journal(str(tmp_path / "journal.jsonl"))
+    journal.update("test", job=_interrupted_job("destroy", hcloud_lifecycle.SNAPSHOTTING, False,
+                                                action_id=response.action.id, image_id=response.image.id))
+
+    resumed = hcloud_reconcile._resume_interrupted_job(client, None, journal, "test", False,
+                                                       hcloud_automation.ResourceState(client, snapshot_token="test"))
+    hcloud_automation.wait_for_background_cleanups()
+
+    assert resumed is True
+    assert api.requests["DELETE /servers/{id}"] == 1
+    assert api.images[response.image.id]["status"] == "available"
+    assert journal.get_interrupted_job("test") is None
+    assert journal.get("test")["last_snapshot_id"] == response.image.id
+
+
+def test_interrupted_job_unwanted_by_the_schedule_is_abandoned(api, tmp_path):
+    client = Client(token="fake", api_endpoint=api.url, poll_interval=0.1)
+    api.add_server("app", dict(LABELS))
+    journal = hcloud_journal.Journal(str(tmp_path / "journal.jsonl"))
+    journal.update("test", job=_interrupted_job("destroy", hcloud_lifecycle.DELETING, False, snapshot_id=1))
+
+    resumed = hcloud_reconcile._resume_interrupted_job(client, None, journal, "test", True,
+                                                       hcloud_automation.ResourceState(client, snapshot_token="test"))
+
+    assert resumed is False
+    assert len(api.servers) == 1
+    assert journal.get("test")["job"]["state"] == hcloud_lifecycle.FAILED
@@ -0,0 +1,87 @@
+import datetime
+
+import hcloud_calendar
+
+START = 1700000000 - 1700000000 % 900
+SLOT = 15 * 60
+
+
+def _schedule(slots: int = 8) -> hcloud_calendar.Schedule:
+    return hcloud_calendar.Schedule(START, START + slots * SLOT, 15)
+
+
+def test_mark_includes_both_slots():
+    schedule = _schedule()
+    schedule.mark(START + 2 * SLOT, START + 4 * SLOT, "cx21")
+
+    assert list(schedule.timeslice) == [0, 0, 1, 1, 1, 0, 0, 0]
+    assert schedule.is_running_at(START + 3 * SLOT) == (True, "cx21")
+    assert schedule.is_running_at(START + 5 * SLOT) == (False, "")
+
+
+def test_mark_clips_events_reaching_beyond_the_schedule():
+    schedule = _schedule()
+    schedule.mark(START - 3 * SLOT, START + SLOT)
+    schedule.mark(START + 6 * SLOT, START + 10 * SLOT)
+
+    assert list(schedule.timeslice) == [1, 1, 0, 0, 0, 0, 1, 1]
+
+
+def test_mark_ignores_events_without_a_slot_of_the_schedule():
+    schedule = _schedule()
+    schedule.mark(START - 3 * SLOT, START + 10 * SLOT)
+    schedule.mark(START + 60, START + 2 * SLOT + 60)
+
+    assert not any(schedule.timeslice)
+
+
+def test_mark_covered_marks_unaligned_and_enclosing_events():
+    schedule = _schedule()
+    schedule.mark_covered(START + 60, START + 2 * SLOT + 60, "cx21")
+
+    assert list(schedule.timeslice) == [0, 1, 1, 0, 0, 0, 0, 0]
+
+    schedule = _schedule()
+    schedule.mark_covered(START - 3 * SLOT, START + 10 * SLOT)
+
+    assert list(schedule.timeslice) == [1] * 8
+
+
+def test_mark_covered_respects_index_range():
+    schedule = _schedule()
+    schedule.mark_covered(START, START + 7 * SLOT, "cx21", idx_from=2, idx_to=5)
+
+    assert list(schedule.timeslice) == [0, 0, 1, 1, 1, 0, 0, 0]
+    assert [schedule.server_types[i] for i in schedule.server_type] == [''] * 2 + ["cx21"] * 3 + [''] * 3
+
+
+def test_mark_agrees_with_mark_covered_on_aligned_events():
+    marked, covered = _schedule(), _schedule()
+    for start, end, server_type in ((1, 2, "cx21"), (4, 7, "cpx31")):
+        marked.mark(START + start * SLOT, START + end * SLOT, server_type)
+        covered.mark_covered(START + start * SLOT, START + end * SLOT, server_type)
+
+    assert marked.get_grids() == covered.get_grids()
+
+
+def _ical(start: datetime.datetime, end: datetime.datetime) -> bytes:
+    return ("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:test\r\nBEGIN:VEVENT\r\nUID:1\r\n"
+            "DTSTAMP:20240101T000000Z\r\nDTSTART:" + start.strftime("%Y%m%dT%H%M%SZ") + "\r\n"
+            "DTEND:" + end.strftime("%Y%m%dT%H%M%SZ") + "\r\nSUMMARY:cx21\r\nEND:VEVENT\r\n"
+            "END:VCALENDAR\r\n").encode()
+
+
+def test_rolling_schedule_is_replaced_when_lead_time_changes():
+    hcloud_calendar.clear_caches()
+    now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+    ical_data = _ical(now + datetime.timedelta(hours=3), now + datetime.timedelta(hours=4))
+
+    for start_advanced_time in (15, 20, 25, {"cx21": 30}, 15):
+        schedule = hcloud_calendar.get_rolling_schedule(ical_data, name="test", timezone_name="UTC",
+                                                        start_advanced_time=start_advanced_time)
+        hcloud_calendar._rolling_schedules.pop(("rebuilt", 15), None)
+        rebuilt = hcloud_calendar.get_rolling_schedule(ical_data, name="rebuilt", timezone_name="UTC",
+                                                       start_advanced_time=start_advanced_time)
+        assert schedule.get_grids() == rebuilt.get_grids()
+
+    assert [key for key in hcloud_calendar._rolling_schedules if key[0] == "test"] == [("test", 15)]